@@ -0,0 +1,855 @@
+import bisect
+import bz2
+import errno
+import gzip
+import hashlib
+import lzma
+import mmap
+import os
+import queue
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, only needed for .zst images
+    zstandard = None
+
+BLOCK_SIZE = 4096
+
+class BlockMap:
+    """
+    The parts of an image that hold data, as sorted, merged, block aligned byte ranges.
+
+    Maps are read from bmaptool-compatible `.bmap` files; a map built by scanning
+    the image is saved in the same format next to it, so the scan runs once. Saved
+    maps carry a SourceStamp (device, inode, size, mtime) of the image they were
+    built from, so an image rebuilt in place is scanned again.
+    """
+
+    def __init__(self, image_size, ranges, block_size=BLOCK_SIZE, stamp=None):
+        """
+        Args:
+            image_size (int): Size of the image in bytes.
+            ranges (list): (start, end) byte ranges holding data, end exclusive.
+            block_size (int): Granularity of the map.
+            stamp (str): file_stamp() of the image the map was built from, if known.
+        """
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges
+        self.stamp = stamp
+
+    @property
+    def mapped_size(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def runs_in(self, offset, length):
+        """Return the mapped parts of [offset, offset + length) as (start, end) relative to offset."""
+        if getattr(self, '_starts', None) is None or len(self._starts) != len(self.ranges):
+            self._starts = [start for start, _ in self.ranges]
+        index = max(bisect.bisect_right(self._starts, offset) - 1, 0)
+        runs = []
+        for start, end in self.ranges[index:]:
+            if start >= offset + length:
+                break
+            if end > offset:
+                runs.append((max(start, offset) - offset, min(end, offset + length) - offset))
+        return runs
+
+    @classmethod
+    def from_bmap(cls, path):
+        """Load a bmaptool `.bmap` file."""
+        root = ET.parse(path).getroot()
+        image_size = int(root.findtext('ImageSize').strip())
+        block_size = int(root.findtext('BlockSize').strip())
+        ranges = []
+        for element in root.find('BlockMap').iter('Range'):
+            first, _, last = element.text.strip().partition('-')
+            start = int(first) * block_size
+            end = min((int(last or first) + 1) * block_size, image_size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        stamp = root.findtext('SourceStamp')
+        return cls(image_size, ranges, block_size, stamp.strip() if stamp else None)
+
+    def save(self, path, source=None):
+        """Write the map as a bmaptool `.bmap` file (without checksums), stamped with `source` if given."""
+        blocks_count = (self.image_size + self.block_size - 1) // self.block_size
+        mapped_blocks = sum((end - start + self.block_size - 1) // self.block_size for start, end in self.ranges)
+        lines = [
+            '<?xml version="1.0" ?>',
+            '<bmap version="2.0">',
+            f'    <ImageSize> {self.image_size} </ImageSize>',
+            f'    <BlockSize> {self.block_size} </BlockSize>',
+            f'    <BlocksCount> {blocks_count} </BlocksCount>',
+            f'    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>',
+            '    <BlockMap>',
+        ]
+        for start, end in self.ranges:
+            first, last = start // self.block_size, (end - 1) // self.block_size
+            lines.append(f'        <Range> {first}-{last} </Range>' if last > first else f'        <Range> {first} </Range>')
+        lines.append('    </BlockMap>')
+        if source:
+            lines.append(f'    <SourceStamp> {file_stamp(source)} </SourceStamp>')
+        lines += ['</bmap>', '']
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            file.write("\n".join(lines))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def scan(cls, image_path, block_size=BLOCK_SIZE, read_size=4 << 20):
+        """
+        Build a map by scanning the image for all-zero blocks.
+
+        Holes of sparse files are skipped with SEEK_DATA/SEEK_HOLE; data regions are
+        compared against a zero buffer a whole read at a time, and only reads that
+        are not entirely zero are examined block by block.
+        """
+        image_size = os.path.getsize(image_path)
+        zero_read = bytes(read_size)
+        zero_block = bytes(block_size)
+        ranges = []
+
+        def add(start, end):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+
+        with open(image_path, 'rb', buffering=0) as file:
+            fd = file.fileno()
+            for data_start, data_end in _data_regions(fd, image_size):
+                offset = data_start - data_start % block_size
+                while offset < data_end:
+                    length = min(read_size, data_end - offset)
+                    chunk = os.pread(fd, length, offset)
+                    if not chunk:
+                        break
+                    if chunk != zero_read[:len(chunk)]:
+                        view = memoryview(chunk)
+                        for pos in range(0, len(chunk), block_size):
+                            block = view[pos:pos + block_size]
+                            if block != zero_block[:len(block)]:
+                                add(offset + pos, offset + pos + len(block))
+                    offset += len(chunk)
+        return cls(image_size, ranges, block_size)
+
+    @classmethod
+    def load_sidecar(cls, image_path, check_size=True):
+        """
+        Return the map in `<image>.bmap` if it still describes the image, else None.
+
+        Stamped maps must match the image's current stamp. Unstamped ones (e.g. a
+        vendor's bmap) must be at least as new as the image and, for raw images
+        (`check_size`), describe an image of the same size.
+        """
+        bmap_path = image_path + ".bmap"
+        if not os.path.exists(bmap_path):
+            return None
+        block_map = cls.from_bmap(bmap_path)
+        if block_map.stamp:
+            return block_map if block_map.stamp == file_stamp(image_path) else None
+        if os.path.getmtime(bmap_path) < os.path.getmtime(image_path):
+            return None
+        if check_size and block_map.image_size != os.path.getsize(image_path):
+            return None
+        return block_map
+
+    @classmethod
+    def for_image(cls, image_path, block_size=BLOCK_SIZE):
+        """Return the map of an image from its `<image>.bmap` sidecar, scanning it (once) if there is no valid one."""
+        block_map = cls.load_sidecar(image_path)
+        if block_map:
+            return block_map
+        block_map = cls.scan(image_path, block_size)
+        try:
+            block_map.save(image_path + ".bmap", source=image_path)
+        except OSError:
+            pass  # read-only image location, scan again next time
+        return block_map
+
+def file_stamp(path):
+    """Identify the current content of a file by device, inode, size and modification time."""
+    st = os.stat(path)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+def _data_regions(fd, size):
+    """Yield (start, end) regions of a file that may hold data, skipping filesystem holes."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # no data after offset
+                return
+            yield offset, size  # SEEK_DATA not supported
+            return
+        yield start, min(end, size)
+        offset = end
+
+def nonzero_runs(buffer, length, block_size=BLOCK_SIZE):
+    """Return the (start, end) runs of blocks in buffer[:length] that are not all zero."""
+    if buffer[:length] == bytes(length):
+        return []
+    zero_block = bytes(block_size)
+    runs = []
+    view = memoryview(buffer)
+    for pos in range(0, length, block_size):
+        end = min(pos + block_size, length)
+        if view[pos:end] != zero_block[:end - pos]:
+            if runs and runs[-1][1] == pos:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((pos, end))
+    return runs
+
+class ProgressPrinter:
+    """Default progress callback: one self-overwriting line with bytes written and throughput."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._last = 0.0
+
+    def __call__(self, written, total, throughput, done=False):
+        now = time.monotonic()
+        if not done and now - self._last < self.interval:
+            return
+        self._last = now
+        percent = f" ({written * 100 // total}%)" if total else ""
+        total = f"/{total >> 20}" if total else ""
+        print(f"\r{written >> 20}{total} MiB{percent} {throughput / (1 << 20):.1f} MiB/s", end="\n" if done else "", flush=True)
+
+COMPRESSION_MAGIC = [
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x8b', 'gz'),
+    (b'(\xb5/\xfd', 'zst'),
+    (b'BZh', 'bz2'),
+]
+
+def compression_of(header):
+    """Return the compression format ('xz', 'gz', 'zst', 'bz2') of a file header, or None for raw images."""
+    for magic, kind in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return kind
+    return None
+
+def is_compressed(image_path):
+    with open(image_path, 'rb') as file:
+        return compression_of(file.read(8)) is not None
+
+def open_decompressed(stream):
+    """
+    Wrap a binary stream supporting peek() in a reader of its decompressed content.
+
+    Raw streams are returned unchanged. zstd needs the optional `zstandard` package.
+    """
+    kind = compression_of(stream.peek(8)[:8])
+    if kind == 'xz':
+        return lzma.LZMAFile(stream)
+    if kind == 'gz':
+        return gzip.GzipFile(fileobj=stream)
+    if kind == 'bz2':
+        return bz2.BZ2File(stream)
+    if kind == 'zst':
+        if zstandard is None:
+            raise Exception("The zstandard package is required to flash .zst images")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    return stream
+
+class ReadBackVerifier:
+    """
+    Reads back what the flasher wrote on a small thread pool while later ranges
+    are still being written, and compares it with the image.
+
+    Each submitted buffer is held until its ranges have been compared and is then
+    handed to `release`, so the flasher's buffer pool bounds how far verification
+    may lag behind the writes. Reads bypass the page cache: with O_DIRECT if the
+    target allows it, else after flushing the range and dropping it from the cache.
+    """
+
+    def __init__(self, device, buffer_size, workers=2, block_size=BLOCK_SIZE):
+        """
+        Args:
+            device (str): Target that was written.
+            buffer_size (int): Largest range submitted at once.
+            workers (int): Number of read-back threads.
+            block_size (int): Granularity of the reported mismatching ranges.
+        """
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self.verified = 0
+        self.mismatches = []
+        self._error = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._direct = False
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                self._fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+                self._direct = True
+            except OSError:
+                pass
+        if not self._direct:
+            self._fd = os.open(device, os.O_RDONLY)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="flash-verify")
+
+    def submit(self, offset, buffer, runs, release):
+        """Compare the (start, end) `runs` of `buffer` with the target at image `offset`, then release(buffer)."""
+        if self._error:
+            release(buffer)
+            raise self._error
+        self._executor.submit(self._verify, offset, buffer, runs, release)
+
+    def _read(self, offset, length):
+        if not self._direct:
+            os.fdatasync(self._fd)
+            os.posix_fadvise(self._fd, offset, length, os.POSIX_FADV_DONTNEED)
+            return os.pread(self._fd, length, offset)
+        if getattr(self._local, 'buffer', None) is None:
+            self._local.buffer = mmap.mmap(-1, self.buffer_size)
+        view = memoryview(self._local.buffer)[:-(-length // 512) * 512]
+        count = os.preadv(self._fd, [view], offset)
+        return view[:min(count, length)]
+
+    def _verify(self, offset, buffer, runs, release):
+        try:
+            for start, end in runs:
+                card = self._read(offset + start, end - start)
+                expected = memoryview(buffer)[start:end]
+                # hashlib releases the GIL, unlike comparing the memoryviews, so the writer keeps going
+                if len(card) != len(expected) or hashlib.sha256(card).digest() != hashlib.sha256(expected).digest():
+                    self._record(offset + start, card, expected)
+                with self._lock:
+                    self.verified += end - start
+                del card
+        except BaseException as e:
+            self._error = e
+        finally:
+            release(buffer)
+
+    def _record(self, offset, card, expected):
+        """Add the blocks of a mismatching range that actually differ."""
+        bad = []
+        for pos in range(0, len(expected), self.block_size):
+            end = min(pos + self.block_size, len(expected))
+            if bytes(card[pos:end]) != bytes(expected[pos:end]):
+                if bad and bad[-1][1] == offset + pos:
+                    bad[-1] = (bad[-1][0], offset + end)
+                else:
+                    bad.append((offset + pos, offset + end))
+        with self._lock:
+            self.mismatches += bad
+
+    def finish(self):
+        """
+        Wait for the outstanding comparisons.
+
+        Returns:
+            list: Merged (start, end) image ranges whose content on the target differs from the image.
+        """
+        self.close()
+        if self._error:
+            raise self._error
+        merged = []
+        for start, end in sorted(self.mismatches):
+            if merged and merged[-1][1] >= start:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def close(self):
+        if self._fd is not None:
+            self._executor.shutdown(wait=True)
+            os.close(self._fd)
+            self._fd = None
+
+class BlockFlasher:
+    """
+    Writes an image to a block device, skipping the blocks that hold no data.
+
+    Reading (and decompressing) and writing overlap: a producer thread fills one
+    page-aligned buffer while the previous one is written with O_DIRECT (falling
+    back to buffered I/O if the device or filesystem refuses it), so neither the
+    page cache nor the zero-filled free space of the image costs any time.
+    With `verify` the written ranges are read back and compared on a
+    ReadBackVerifier pool while the following ones are written.
+    """
+
+    def __init__(self, device, buffer_size=4 << 20, direct=True, progress=None, buffers=2, verify=False, verify_workers=2):
+        """
+        Args:
+            device (str): Target block device (or file).
+            buffer_size (int): Size of each I/O buffer, a multiple of the page size.
+            direct (bool): Try O_DIRECT writes.
+            progress (callable): Called with (written, total, throughput[, done]); defaults to ProgressPrinter.
+            buffers (int): Number of buffers cycling between the producer and the writer.
+            verify (bool): Read back and compare every written range.
+            verify_workers (int): Number of read-back threads; each may hold two buffers.
+        """
+        self.device = device
+        self.buffer_size = buffer_size
+        self.direct = direct
+        self.progress = progress if progress is not None else ProgressPrinter()
+        self.buffers = buffers
+        self.verify = verify
+        self.verify_workers = verify_workers
+
+    def _open_device(self, direct):
+        """Open the target; returns (fd, whether O_DIRECT is actually in use)."""
+        flags = os.O_WRONLY | os.O_CREAT
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(self.device, flags | os.O_DIRECT, 0o644), True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        return os.open(self.device, flags, 0o644), False
+
+    def flash(self, image_path, block_map=None, delta=None):
+        """
+        Write an image file; compressed images are handed to flash_stream().
+
+        Args:
+            image_path (str): Raw or compressed image file.
+            block_map (BlockMap): Map of the image; BlockMap.for_image() is used if omitted.
+            delta (card_manifest.DeltaFilter): Skip the chunks the card already holds.
+
+        Returns:
+            dict: image_size, mapped_size, written, duration (s) and throughput (bytes/s),
+            plus skipped and read_back (bytes) with a delta filter, and verified (bytes)
+            and mismatches ((start, end) image ranges) with verify.
+        """
+        if is_compressed(image_path):
+            with open(image_path, 'rb') as stream:
+                return self.flash_stream(stream, block_map, image_path=image_path, delta=delta)
+        block_map = block_map or BlockMap.for_image(image_path)
+        if delta:
+            return self._flash_delta(image_path, block_map, delta)
+
+        def read_ranges(get_buffer, emit):
+            with open(image_path, 'rb', buffering=0) as image:
+                for start, end in block_map.ranges:
+                    offset = start
+                    while offset < end:
+                        buffer = get_buffer()
+                        length = min(self.buffer_size, end - offset)
+                        image.seek(offset)
+                        count = image.readinto(memoryview(buffer)[:length])
+                        if count < length:
+                            raise IOError(f"{image_path} is shorter than its block map")
+                        emit(offset, buffer, [(0, length)])
+                        offset += length
+
+        return self._run(read_ranges, block_map.image_size, block_map.mapped_size)
+
+    def _flash_delta(self, image_path, block_map, delta):
+        """Like flash(), but in whole buffer_size chunks so every chunk can be compared with the card's manifest."""
+        chunk = self.buffer_size
+
+        def read_chunks(get_buffer, emit):
+            with open(image_path, 'rb', buffering=0) as image:
+                offset = None
+                for start, end in block_map.ranges:
+                    offset = max(start - start % chunk, offset if offset is not None else 0)
+                    while offset < end:
+                        buffer = get_buffer()
+                        length = min(chunk, block_map.image_size - offset)
+                        image.seek(offset)
+                        count = image.readinto(memoryview(buffer)[:length])
+                        if count < length:
+                            raise IOError(f"{image_path} is shorter than its block map")
+                        emit(offset, buffer, delta.runs(offset, buffer, length, block_map.runs_in(offset, length)))
+                        offset += chunk
+
+        delta.manifest.begin()
+        return self._finish_delta(self._run(read_chunks, block_map.image_size, block_map.mapped_size, keep_content=True), delta)
+
+    @staticmethod
+    def _finish_delta(stats, delta):
+        delta.close()
+        if stats.get("mismatches"):
+            delta.manifest.invalidate()
+        else:
+            delta.manifest.commit(delta.hashes)
+        stats["skipped"] = delta.skipped
+        stats["read_back"] = delta.read_back
+        return stats
+
+    def flash_stream(self, stream, block_map=None, image_path=None, delta=None):
+        """
+        Write an image read sequentially from a (possibly compressed) stream.
+
+        Decompression runs on the producer thread and overlaps with the device
+        writes. Without a block map (or a valid `<image_path>.bmap` sidecar)
+        all-zero blocks are detected on the fly and skipped; the map built that
+        way is saved as the sidecar for later runs.
+
+        Args:
+            stream: Binary stream supporting peek(), e.g. a file opened with open(path, 'rb').
+            block_map (BlockMap): Map of the decompressed image, if known.
+            image_path (str): File the stream was opened from, if any; its sidecar holds the map.
+            delta (card_manifest.DeltaFilter): Skip the chunks the card already holds.
+        """
+        if block_map is None and image_path:
+            block_map = BlockMap.load_sidecar(image_path, check_size=False)
+        reader = open_decompressed(stream)
+        block_size = block_map.block_size if block_map else BLOCK_SIZE
+        found = []  # ranges of a block map built on the fly
+        size = [0]
+
+        def runs_of(offset, buffer, length):
+            if block_map:
+                return block_map.runs_in(offset, length)
+            return nonzero_runs(buffer, length, block_size)
+
+        def read_stream(get_buffer, emit):
+            offset = 0
+            while True:
+                buffer = get_buffer()
+                view = memoryview(buffer)
+                length = 0
+                while length < self.buffer_size:
+                    count = reader.readinto(view[length:])
+                    if not count:
+                        break
+                    length += count
+                del view
+                if not length:
+                    break
+                runs = runs_of(offset, buffer, length)
+                for start, end in runs:
+                    if found and found[-1][1] == offset + start:
+                        found[-1] = (found[-1][0], offset + end)
+                    else:
+                        found.append((offset + start, offset + end))
+                emit(offset, buffer, delta.runs(offset, buffer, length, runs) if delta else runs)
+                offset += length
+                size[0] = offset
+                if length < self.buffer_size:
+                    break
+
+        if delta:
+            delta.manifest.begin()
+        stats = self._run(read_stream, None, block_map.mapped_size if block_map else None, keep_content=bool(delta))
+        stats["image_size"] = size[0]
+        if os.path.isfile(self.device):
+            os.truncate(self.device, size[0])
+        stats["mapped_size"] = sum(end - start for start, end in found)
+        if block_map is None and image_path:
+            try:
+                BlockMap(size[0], found, block_size).save(image_path + ".bmap", source=image_path)
+            except OSError:
+                pass
+        return self._finish_delta(stats, delta) if delta else stats
+
+    def _run(self, produce, image_size, total, keep_content=False):
+        """
+        Drive a producer thread and write what it emits.
+
+        `produce(get_buffer, emit)` fills buffers from get_buffer() and calls
+        emit(offset, buffer, runs), runs being the (start, end) slices of the
+        buffer to write at image offset + start. File targets are emptied first
+        unless `keep_content` is set (delta flashing).
+        """
+        started = time.monotonic()
+        count = self.buffers + (2 * self.verify_workers if self.verify else 0)
+        buffers = [mmap.mmap(-1, self.buffer_size) for _ in range(count)]
+        free = queue.Queue()
+        for buffer in buffers:
+            free.put(buffer)
+        filled = queue.Queue()
+        stop = threading.Event()
+
+        def get_buffer():
+            buffer = free.get()
+            if stop.is_set():
+                raise InterruptedError("flash aborted")
+            return buffer
+
+        def producer():
+            try:
+                produce(get_buffer, lambda offset, buffer, runs: filled.put((offset, buffer, runs)))
+                filled.put(None)
+            except BaseException as e:
+                filled.put(e)
+
+        thread = threading.Thread(target=producer, name="flash-reader", daemon=True)
+        thread.start()
+
+        fd, direct = self._open_device(self.direct)
+        if os.path.isfile(self.device) and not keep_content:
+            # Flashing into an image file: unmapped ranges must read back as zeros
+            os.ftruncate(fd, 0)
+            if image_size:
+                os.ftruncate(fd, image_size)
+        verifier = ReadBackVerifier(self.device, self.buffer_size, self.verify_workers) if self.verify else None
+        written = 0
+        mismatches = []
+        try:
+            while True:
+                item = filled.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                offset, buffer, runs = item
+                for start, end in runs:
+                    # O_DIRECT needs sector aligned lengths: pad a short tail with zeros
+                    aligned = start + -(-(end - start) // 512) * 512 if direct else end
+                    if aligned != end:
+                        buffer[end:aligned] = bytes(aligned - end)
+                    try:
+                        self._write_all(fd, memoryview(buffer)[start:aligned], offset + start)
+                    except OSError as e:
+                        if not direct or e.errno != errno.EINVAL:  # O_DIRECT not supported here
+                            raise
+                        os.close(fd)
+                        fd, direct = self._open_device(False)
+                        self._write_all(fd, memoryview(buffer)[start:end], offset + start)
+                    written += end - start
+                if verifier and runs:
+                    verifier.submit(offset, buffer, runs, free.put)
+                else:
+                    free.put(buffer)
+                elapsed = time.monotonic() - started
+                self.progress(written, total, written / elapsed if elapsed else 0.0)
+            if image_size and os.path.isfile(self.device):
+                os.ftruncate(fd, image_size)  # drop the O_DIRECT padding of an unaligned tail
+            os.fsync(fd)
+            if verifier:
+                mismatches = verifier.finish()
+        finally:
+            stop.set()
+            free.put(buffers[0])  # unblock the producer if it is waiting for a buffer
+            if verifier:
+                verifier.close()
+            os.close(fd)
+            thread.join()
+
+        duration = time.monotonic() - started
+        throughput = written / duration if duration else 0.0
+        self.progress(written, total, throughput, done=True)
+        stats = {
+            "image_size": image_size,
+            "mapped_size": total,
+            "written": written,
+            "duration": duration,
+            "throughput": throughput,
+        }
+        if verifier:
+            stats["verified"] = verifier.verified
+            stats["mismatches"] = mismatches
+        return stats
+
+    @staticmethod
+    def _write_all(fd, view, offset):
+        while view:
+            count = os.pwrite(fd, view, offset)
+            view = view[count:]
+            offset += count
+
+
+class FanOutProgress:
+    """Default progress callback of FanOutFlasher: one self-overwriting line with every target."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._last = 0.0
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, device, written, total, throughput, done=False):
+        with self._lock:
+            self._state[device] = (written, throughput, done)
+            now = time.monotonic()
+            finished = all(state[2] for state in self._state.values())
+            if not finished and now - self._last < self.interval:
+                return
+            self._last = now
+            line = " | ".join(f"{os.path.basename(name)} {w >> 20} MiB {t / (1 << 20):.1f} MiB/s{' done' if d else ''}"
+                              for name, (w, t, d) in sorted(self._state.items()))
+            print(f"\r{line}", end="\n" if finished else "", flush=True)
+
+class _FanOutTarget:
+    def __init__(self, device, depth):
+        self.device = device
+        self.queue = queue.Queue(depth)
+        self.detached_at = None  # index of the first chunk the reader did not hand over
+        self.blocked = 0.0  # seconds the reader waited for this target's queue
+        self.failed = threading.Event()
+
+class FanOutFlasher:
+    """
+    Writes one image to several targets at once, reading (and decompressing) it only once.
+
+    A reader thread hands every chunk of the image to a bounded queue per target;
+    each target is written by its own BlockFlasher (O_DIRECT, read-back
+    verification and delta filter included), so per-target progress, statistics
+    and failures are kept apart. A target that fails is dropped without
+    disturbing the others. Once the reader has waited `stall_timeout` seconds in
+    total for a target's full queue, that target is detached and reads the rest
+    of a raw image on its own (from the page cache, mostly), so one slow card
+    holds the others back by at most that long. Targets of compressed images
+    cannot be detached and only apply back-pressure.
+    """
+
+    def __init__(self, devices, buffer_size=4 << 20, direct=True, progress=None, depth=8, stall_timeout=5.0, verify=False):
+        """
+        Args:
+            devices (list): Target block devices (or files).
+            buffer_size (int): Chunk size, a multiple of the page size.
+            direct (bool): Try O_DIRECT writes.
+            progress (callable): Called with (device, written, total, throughput[, done]); defaults to FanOutProgress.
+            depth (int): Chunks each target may queue ahead of its writer.
+            stall_timeout (float): Total seconds a target's full queue may block the reader before it is detached.
+            verify (bool): Read back and compare what is written to each target.
+        """
+        self.devices = list(devices)
+        self.buffer_size = buffer_size
+        self.direct = direct
+        self.progress = progress if progress is not None else FanOutProgress()
+        self.depth = depth
+        self.stall_timeout = stall_timeout
+        self.verify = verify
+
+    def flash(self, image_path, block_map=None, deltas=None):
+        """
+        Write an image file to every target.
+
+        Args:
+            image_path (str): Raw or compressed image file.
+            block_map (BlockMap): Map of the (decompressed) image; taken from its sidecar or scanned if omitted.
+            deltas (dict): device -> card_manifest.DeltaFilter for the targets that skip unchanged chunks.
+
+        Returns:
+            dict: device -> statistics as returned by BlockFlasher.flash(), or the exception that target failed with.
+        """
+        deltas = deltas or {}
+        compressed = is_compressed(image_path)
+        if block_map is None:
+            block_map = BlockMap.load_sidecar(image_path, check_size=not compressed)
+            if block_map is None and not compressed:
+                block_map = BlockMap.for_image(image_path)
+        chunk = self.buffer_size
+        chunks = None
+        if not compressed:
+            # Whole aligned chunks, so every target's delta filter can compare them with its manifest
+            chunks, offset = [], 0
+            for start, end in block_map.ranges:
+                offset = max(start - start % chunk, offset)
+                while offset < end:
+                    chunks.append(offset)
+                    offset += chunk
+        image_size = block_map.image_size if block_map else None
+        targets = [_FanOutTarget(device, self.depth) for device in self.devices]
+        source = {"error": None, "size": None}
+
+        def read_chunk(image, offset):
+            length = min(chunk, image_size - offset)
+            data = os.pread(image.fileno(), length, offset)
+            if len(data) < length:
+                raise IOError(f"{image_path} is shorter than its block map")
+            return data
+
+        def hand_over(index, item):
+            for target in targets:
+                if target.failed.is_set() or target.detached_at is not None:
+                    continue
+                while not target.failed.is_set():
+                    if chunks is not None and target.blocked >= self.stall_timeout:
+                        print(f"\n{target.device} is falling behind, it continues on its own")
+                        target.detached_at = index
+                        break
+                    started = time.monotonic()
+                    try:
+                        target.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                    finally:
+                        target.blocked += time.monotonic() - started
+
+        def reader():
+            try:
+                if chunks is not None:
+                    with open(image_path, 'rb', buffering=0) as image:
+                        for index, offset in enumerate(chunks):
+                            data = read_chunk(image, offset)
+                            hand_over(index, (offset, data, block_map.runs_in(offset, len(data))))
+                    source["size"] = image_size
+                else:
+                    with open(image_path, 'rb') as stream:
+                        decompressed = open_decompressed(stream)
+                        offset, index = 0, 0
+                        while True:
+                            data = decompressed.read(chunk)
+                            if not data:
+                                break
+                            runs = block_map.runs_in(offset, len(data)) if block_map else nonzero_runs(data, len(data))
+                            hand_over(index, (offset, data, runs))
+                            offset += len(data)
+                            index += 1
+                            if len(data) < chunk:
+                                break
+                    source["size"] = offset
+                hand_over(len(chunks) if chunks is not None else None, None)
+            except BaseException as e:
+                source["error"] = e
+
+        def writer(target):
+            flasher = BlockFlasher(target.device, chunk, self.direct, buffers=2, verify=self.verify,
+                                   progress=lambda *args, **kwargs: self.progress(target.device, *args, **kwargs))
+            delta = deltas.get(target.device)
+
+            def emit_chunk(get_buffer, emit, offset, data, runs):
+                buffer = get_buffer()
+                buffer[:len(data)] = data
+                emit(offset, buffer, delta.runs(offset, buffer, len(data), runs) if delta else runs)
+
+            def produce(get_buffer, emit):
+                while True:
+                    try:
+                        item = target.queue.get(timeout=0.5)
+                    except queue.Empty:
+                        if source["error"]:
+                            raise source["error"]
+                        if target.detached_at is not None:
+                            break
+                        continue
+                    if item is None:
+                        return
+                    emit_chunk(get_buffer, emit, *item)
+                with open(image_path, 'rb', buffering=0) as image:
+                    for offset in chunks[target.detached_at:]:
+                        data = read_chunk(image, offset)
+                        emit_chunk(get_buffer, emit, offset, data, block_map.runs_in(offset, len(data)))
+
+            if delta:
+                delta.manifest.begin()
+            stats = flasher._run(produce, image_size, block_map.mapped_size if block_map else None, keep_content=bool(delta))
+            stats["image_size"] = source["size"]
+            if os.path.isfile(target.device):
+                os.truncate(target.device, source["size"])
+            return BlockFlasher._finish_delta(stats, delta) if delta else stats
+
+        def run_target(target):
+            try:
+                return writer(target)
+            except BaseException as e:
+                target.failed.set()
+                return e
+
+        thread = threading.Thread(target=reader, name="fanout-reader", daemon=True)
+        thread.start()
+        with ThreadPoolExecutor(len(targets), thread_name_prefix="fanout-writer") as executor:
+            results = dict(zip(self.devices, executor.map(run_target, targets)))
+        thread.join()
+        return results
@@ -0,0 +1,237 @@
+import threading
+import time
+from pattern_matcher import PatternMatcher
+
+BOOT_STAGES = ("power_on", "spl", "uboot", "kernel", "init", "login", "shell")
+
+# Milestones that move the boot into a stage, as printed on the console (see typical_log).
+# The login and shell stages are entered by the configured prompts.
+STAGE_PATTERNS = {
+    "spl": ["U-Boot SPL"],
+    "uboot": ["U-Boot 20", "Hit any key to stop autoboot", "Autoboot in"],
+    "kernel": ["Starting kernel", "Linux version"],
+    "init": ["as init process", "Welcome to"],
+}
+
+# Seconds a boot may spend in a stage before it counts as stalled
+DEFAULT_STAGE_TIMEOUTS = {
+    "power_on": 30,
+    "spl": 15,
+    "uboot": 60,
+    "kernel": 60,
+    "init": 180,
+    "login": 30,
+}
+
+LOGIN_FAILURES = ["Login incorrect"]
+
+# Watchdog signatures. Fatal ones fail the boot at once; the others fail it
+# only if it makes no progress to a later stage within the grace period, since
+# e.g. the boot ROM reports "sd f!" and then boots from another medium.
+CRASH_SIGNATURES = {
+    "panic": (["Kernel panic", "kernel BUG at"], True),
+    "oops": (["Oops", "Unable to handle kernel"], False),
+    "boot media error": (["sd f!", "Wrong Image Format", "Bad Linux"], False),
+}
+
+# A bootloader milestone seen again after the boot got past it means the DUT reset
+BOOTLOADER_STAGES = ("spl", "uboot")
+
+# Stages in which a booting DUT keeps printing; silence there means a hang
+NOISY_STAGES = ("spl", "uboot", "kernel", "init")
+
+DEFAULT_WATCHDOG = {
+    "silence": 60,  # seconds without any output in a noisy stage
+    "grace": 10,  # seconds a non-fatal signature may go without progress
+    "reboots": 1,  # resets tolerated within one boot, e.g. a first-boot resize
+}
+
+CONTEXT_SIZE = 4096  # bytes of console output kept for failure reports
+
+class BootMonitor:
+    """
+    Boot progress state machine and watchdog fed by the serial stream.
+
+    Every chunk is scanned once for the stage milestones, the login,
+    password and shell prompts and the crash signatures. A boot moves forward
+    through BOOT_STAGES, but may skip stages (no SPL, or a console that is
+    already at a prompt); only a reset of the DUT takes it back to the
+    bootloader. Prompts are handed to `on_prompt` the moment they complete,
+    so credentials go out as soon as the DUT asks for them.
+
+    The boot fails fast on a panic, a boot loop, silence in a stage that
+    normally prints, or a non-fatal signature without progress; result()
+    names the failure and keeps the last console output as context.
+    """
+
+    def __init__(self, login_prompts, password_prompts, shell_prompt, timeouts=None, on_prompt=None, watchdog=None):
+        """
+        Args:
+            login_prompts (list): Prompts asking for the user name.
+            password_prompts (list): Prompts asking for the password.
+            shell_prompt (str): Prompt of a logged in shell.
+            timeouts (dict): Per-stage timeouts in seconds, merged over DEFAULT_STAGE_TIMEOUTS.
+            on_prompt (callable): Called with ('login' | 'password', prompt) when a prompt shows up.
+            watchdog (dict): silence, grace and reboots, merged over DEFAULT_WATCHDOG.
+        """
+        self.timeouts = dict(DEFAULT_STAGE_TIMEOUTS, **(timeouts or {}))
+        self.watchdog = dict(DEFAULT_WATCHDOG, **(watchdog or {}))
+        self.on_prompt = on_prompt
+        self.matcher = PatternMatcher()
+        for stage, patterns in STAGE_PATTERNS.items():
+            for pattern in patterns:
+                self.matcher.add(pattern, ('stage', stage), self._on_match)
+        for prompt in login_prompts:
+            self.matcher.add(prompt, ('login', prompt), self._on_match)
+        for prompt in password_prompts:
+            self.matcher.add(prompt, ('password', prompt), self._on_match)
+        self.matcher.add(shell_prompt, ('shell', shell_prompt), self._on_match)
+        for text in LOGIN_FAILURES:
+            self.matcher.add(text, ('failure', text), self._on_match)
+        for kind, (signatures, fatal) in CRASH_SIGNATURES.items():
+            for text in signatures:
+                self.matcher.add(text, ('crash', (kind, text, fatal)), self._on_match)
+        self.matcher.compile()
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self, power_on=None):
+        """Start over in the power_on stage, e.g. after the DUT was power cycled at monotonic time `power_on`."""
+        with self.condition:
+            self._scanner = self.matcher.scanner()
+            self._received_at = None
+            self.stage = "power_on"
+            self.stage_times = [("power_on", power_on or time.monotonic())]  # (stage, monotonic time entered)
+            self.received = 0
+            self.last_received = self.stage_times[0][1]
+            self.reboots = 0
+            self.suspect = None  # (kind, text, monotonic time) of a non-fatal signature
+            self.context = bytearray()
+            self.failure = None
+            self.error = None
+
+    def powered(self, power_on):
+        """Move the start of the timeline to `power_on`, when power came back after reset()."""
+        with self.condition:
+            started = self.stage_times[1][1] if len(self.stage_times) > 1 else power_on
+            self.stage_times[0] = ("power_on", min(power_on, started))
+            if not self.received:
+                self.last_received = power_on
+            self.condition.notify_all()
+
+    @property
+    def done(self):
+        return self.stage == "shell" or self.error is not None
+
+    def feed(self, chunk, received_at=None):
+        """
+        Scan the next chunk of serial output (bytes).
+
+        Stages are entered at `received_at`, the monotonic time the chunk
+        arrived, which defaults to now.
+        """
+        with self.condition:
+            if self.done:
+                return
+            self._received_at = self.last_received = received_at or time.monotonic()
+            self.received += len(chunk)
+            self.context += chunk
+            del self.context[:-CONTEXT_SIZE]
+            self._scanner.feed(chunk)
+            self.condition.notify_all()
+
+    def _on_match(self, key, offset):
+        kind, value = key
+        if self.done:
+            return
+        if kind == 'stage':
+            self._advance(value)
+        elif kind == 'shell':
+            self._advance('shell')
+        elif kind == 'failure':
+            self._fail('login', f"{value} at the {self.stage} prompt")
+        elif kind == 'crash':
+            crash, text, fatal = value
+            if fatal:
+                self._fail(crash, f"{text} in stage {self.stage}")
+            elif self.suspect is None:
+                self.suspect = (crash, text, self._received_at)
+        else:
+            self._advance('login')
+            if self.on_prompt:
+                self.on_prompt(kind, value)
+
+    def _advance(self, stage):
+        if BOOT_STAGES.index(stage) > BOOT_STAGES.index(self.stage):
+            self._enter(stage)
+        elif stage in BOOTLOADER_STAGES and BOOT_STAGES.index(stage) < BOOT_STAGES.index(self.stage):
+            self.reboots += 1
+            if self.reboots > self.watchdog["reboots"]:
+                self._fail("boot loop", f"DUT reset {self.reboots} times, last from stage {self.stage}")
+            else:
+                self._enter(stage)
+
+    def _enter(self, stage):
+        self.stage = stage
+        self.stage_times.append((stage, self._received_at))
+        self.suspect = None
+
+    def _fail(self, failure, error):
+        self.failure = failure
+        self.error = error
+
+    def wait(self, wake=None, wake_after=3.0):
+        """
+        Block until the shell prompt shows up or a stage times out.
+
+        Args:
+            wake (callable): Called once if nothing at all was received for
+                `wake_after` seconds, e.g. to send a newline to a console that
+                already sits at a prompt.
+
+        Returns:
+            dict: success, stage (reached, or the one that failed), failure
+            (stalled, silence, panic, oops, boot media error, boot loop or login),
+            error, context (last console output), reboots and
+            stage_times [(stage, seconds since power_on)].
+        """
+        with self.condition:
+            while not self.done:
+                now = time.monotonic()
+                entered = self.stage_times[-1][1]
+                deadline = entered + self.timeouts[self.stage]
+                if wake and not self.received:
+                    if now - entered >= wake_after:
+                        wake()
+                        wake = None
+                    else:
+                        deadline = min(deadline, entered + wake_after)
+                elif now >= deadline:
+                    self._fail("stalled", f"no progress in stage {self.stage} within {self.timeouts[self.stage]}s")
+                    break
+                if self.stage in NOISY_STAGES:
+                    silent_until = self.last_received + self.watchdog["silence"]
+                    if now >= silent_until:
+                        self._fail("silence", f"no output for {self.watchdog['silence']}s in stage {self.stage}")
+                        break
+                    deadline = min(deadline, silent_until)
+                if self.suspect:
+                    crash, text, seen = self.suspect
+                    if now >= seen + self.watchdog["grace"]:
+                        self._fail(crash, f"{text} in stage {self.stage}, no progress for {self.watchdog['grace']}s")
+                        break
+                    deadline = min(deadline, seen + self.watchdog["grace"])
+                self.condition.wait(max(deadline - now, 0))
+            return self.result()
+
+    def result(self):
+        start = self.stage_times[0][1]
+        return {
+            'success': self.stage == "shell" and self.error is None,
+            'stage': self.stage,
+            'failure': self.failure,
+            'error': self.error,
+            'context': self.context.decode('utf-8', errors='replace'),
+            'reboots': self.reboots,
+            'stage_times': [(stage, entered - start) for stage, entered in self.stage_times],
+        }
@@ -0,0 +1,130 @@
+import json
+import os
+import time
+from texttable import Texttable
+from boot_monitor import BootMonitor
+
+PHASE_NAMES = {
+    "power_on": "power-on",
+    "spl": "SPL",
+    "uboot": "U-Boot",
+    "kernel": "kernel",
+    "init": "init",
+    "login": "login",
+    "shell": "shell",
+}
+
+def boot_timeline(result):
+    """
+    Turn a BootMonitor result into a list of phases.
+
+    Each phase is a dict with phase, start (seconds since power on) and
+    duration (until the next phase was reached). The last phase reached has no
+    duration: it is the shell, or the phase the boot stalled in.
+    """
+    stage_times = result['stage_times']
+    phases = []
+    for i, (stage, start) in enumerate(stage_times):
+        duration = stage_times[i + 1][1] - start if i + 1 < len(stage_times) else None
+        phases.append({"phase": stage, "start": round(start, 3), "duration": None if duration is None else round(duration, 3)})
+    return phases
+
+def extract_timeline(chunks, login_prompts, password_prompts, shell_prompt, power_on=None):
+    """
+    Extract the boot timeline of a recorded serial stream.
+
+    Args:
+        chunks (iterable): (monotonic time received, bytes) per chunk.
+        power_on (float): Monotonic time the DUT was powered, defaults to the first chunk.
+
+    Returns:
+        list: Phases as returned by boot_timeline.
+    """
+    monitor = BootMonitor(login_prompts, password_prompts, shell_prompt)
+    for received_at, chunk in chunks:
+        if power_on is None:
+            power_on = received_at
+        if monitor.received == 0:
+            monitor.reset(power_on)
+        monitor.feed(chunk, received_at)
+    return boot_timeline(monitor.result())
+
+class BootTimelineStore:
+    """Boot timelines of every run, one JSON line per (board, OS, run), appended to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, board, os_name, run, result):
+        """Append the timeline of a BootMonitor result; returns the stored record."""
+        phases = boot_timeline(result)
+        record = {
+            "board": board,
+            "os": os_name,
+            "run": run,
+            "recorded": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "success": result['success'],
+            "stage": result['stage'],
+            "failure": result.get('failure'),
+            "error": result['error'],
+            "reboots": result.get('reboots', 0),
+            "time_to_shell": phases[-1]["start"] if result['success'] else None,
+            "phases": phases,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+        return record
+
+    def history(self, board, os_name):
+        """Return the stored records of a board and OS, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if record["board"] == board and record["os"] == os_name:
+                    records.append(record)
+        return records
+
+    def previous(self, board, os_name, run):
+        """Return the last successful boot of the board and OS before `run`, or None."""
+        earlier = [r for r in self.history(board, os_name) if r["success"] and r["run"] != run]
+        return earlier[-1] if earlier else None
+
+def format_timeline(record, previous=None, threshold=0.2, min_delta=0.5):
+    """
+    Return the boot timeline of a record as report text.
+
+    With the record of an earlier run every phase is compared against it, and
+    phases that got slower by more than `threshold` (relative) and `min_delta`
+    seconds are marked as regressions.
+    """
+    before = {phase["phase"]: phase["duration"] for phase in previous["phases"]} if previous else {}
+    table = Texttable()
+    table.set_deco(Texttable.HEADER)
+    table.add_rows([["Boot phase", "Start (s)", "Duration (s)", "Previous (s)", ""]])
+    regressions = []
+    for phase in record["phases"]:
+        duration, earlier = phase["duration"], before.get(phase["phase"])
+        flag = ""
+        if duration is not None and earlier is not None and duration - earlier > max(min_delta, earlier * threshold):
+            flag = f"REGRESSION +{duration - earlier:.1f}s"
+            regressions.append(PHASE_NAMES[phase["phase"]])
+        table.add_row([PHASE_NAMES[phase["phase"]], f"{phase['start']:.1f}",
+                       "-" if duration is None else f"{duration:.1f}",
+                       "-" if earlier is None else f"{earlier:.1f}", flag])
+    text = table.draw()
+    if record["success"]:
+        text += f"\nTime to shell: {record['time_to_shell']:.1f}s"
+        if previous:
+            text += f" (previous run {previous['run']}: {previous['time_to_shell']:.1f}s)"
+    else:
+        text += f"\nBoot failed in {PHASE_NAMES[record['stage']]} ({record.get('failure')}): {record['error']}"
+    if regressions:
+        text += f"\nBoot latency regressions: {', '.join(regressions)}"
+    return text
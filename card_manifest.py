@@ -0,0 +1,145 @@
+import hashlib
+import json
+import mmap
+import os
+import random
+import time
+
+class CardManifest:
+    """
+    Hashes of the chunks last written to one SD card, keyed by the serial of its SD mux.
+
+    The manifest only says what the card held when the flasher left it. A booted
+    DUT writes to its card (journal replay, mount counts, logs, resized root
+    partitions), so a chunk whose hash matches is merely a candidate for being
+    skipped: DeltaFilter reads it back from the card before trusting it.
+    """
+
+    def __init__(self, path, chunk_size):
+        """
+        Args:
+            path (str): JSON file holding the manifest.
+            chunk_size (int): Chunk size of the hashes; a manifest with another size is discarded.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.hashes = {}
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            if data.get("chunk_size") == chunk_size and data.get("complete"):
+                self.hashes = {int(index): digest for index, digest in data["hashes"].items()}
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    @classmethod
+    def for_card(cls, root, serial, chunk_size):
+        os.makedirs(root, exist_ok=True)
+        return cls(os.path.join(root, f"{serial}.json"), chunk_size)
+
+    def _save(self, hashes, complete):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"chunk_size": self.chunk_size, "complete": complete, "updated": time.time(),
+                       "hashes": {str(index): digest for index, digest in hashes.items()}}, file)
+        os.replace(tmp_path, self.path)
+
+    def begin(self):
+        """Mark the card as being rewritten; an interrupted flash leaves no trusted hashes behind."""
+        self._save({}, complete=False)
+
+    def commit(self, hashes):
+        """Record the chunks written by a completed flash."""
+        self.hashes = dict(hashes)
+        self._save(self.hashes, complete=True)
+
+    def invalidate(self):
+        """Forget the card's content, e.g. after it was written by something else (dd)."""
+        self.hashes = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class DeltaFilter:
+    """
+    Drops the writes of chunks that the card already holds.
+
+    Used by BlockFlasher on buffers aligned to the manifest's chunk size. A chunk
+    is skipped only if the manifest has the same hash for it and its mapped
+    ranges read back from the card match the image. With verify="sample" only a
+    random `sample` fraction of those chunks is read back, and verification of
+    all later chunks is switched on at the first mismatch; this is only safe
+    while the card has not been booted since it was flashed.
+    """
+
+    def __init__(self, device, manifest, verify="full", sample=0.05):
+        if verify not in ("full", "sample"):
+            raise Exception(f"Unknown delta verification mode {verify}")
+        self.device = device
+        self.manifest = manifest
+        self.verify = verify
+        self.sample = sample
+        self.hashes = {}
+        self.skipped = 0
+        self.read_back = 0
+        self._fd = None
+        self._direct = False
+        self._buffer = None
+
+    def _open(self):
+        if self._fd is not None:
+            return
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                self._fd = os.open(self.device, os.O_RDONLY | os.O_DIRECT)
+                self._direct = True
+                self._buffer = mmap.mmap(-1, self.manifest.chunk_size)
+                return
+            except OSError:
+                pass
+        self._fd = os.open(self.device, os.O_RDONLY)
+        # The host may still cache what it wrote before the DUT used the card
+        os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _card_matches(self, offset, buffer, runs):
+        self._open()
+        for start, end in runs:
+            if self._direct:
+                aligned = -(-(end - start) // 512) * 512
+                view = memoryview(self._buffer)[:aligned]
+                try:
+                    count = os.preadv(self._fd, [view], offset + start)
+                except OSError:
+                    return False
+                card = view[:min(count, end - start)]
+            else:
+                card = os.pread(self._fd, end - start, offset + start)
+            self.read_back += end - start
+            if card != memoryview(buffer)[start:end]:
+                return False
+        return True
+
+    def runs(self, offset, buffer, length, runs):
+        """Return the subset of `runs` (slices of `buffer` at image `offset`) that must be written."""
+        index = offset // self.manifest.chunk_size
+        digest = chunk_hash(memoryview(buffer)[:length])
+        self.hashes[index] = digest
+        if not runs or self.manifest.hashes.get(index) != digest:
+            return runs
+        if self.verify == "sample" and random.random() >= self.sample:
+            self.skipped += sum(end - start for start, end in runs)
+            return []
+        if self._card_matches(offset, buffer, runs):
+            self.skipped += sum(end - start for start, end in runs)
+            return []
+        if self.verify == "sample":
+            print(f"Card content differs from its manifest at {offset}, verifying every chunk from now on")
+            self.verify = "full"
+        return runs
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,290 @@
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+import requests
+
+DEFAULT_STORE_DIR = os.environ.get("BOARDTEST_CHUNK_STORE", "./images/chunks")
+
+class ChunkStore:
+    """
+    Deduplicating store of OS images split into content-defined chunks.
+
+    Layout of the store directory:
+        chunks/<xx>/<digest>   unique chunks, zlib compressed, named by the BLAKE2b digest of their content
+        recipes/<name>.json    size and SHA-256 of an image and the (digest, length) list of its chunks
+
+    Chunk boundaries are chosen per 4 KiB block: a chunk ends after a block
+    whose CRC-32 has its low `mask_bits` bits clear (within min/max chunk
+    sizes). Filesystem images change in whole blocks, so a boundary depends
+    only on nearby content and a change, insertion or deletion of blocks alters
+    the chunks around it while the rest of the image dedups against earlier
+    builds. Disk use therefore grows with what changed between nightlies, not
+    with their number.
+
+    A store directory served over HTTP is also a chunk index: fetch() downloads
+    a recipe from it and then only the chunks missing locally.
+
+    add() and fetch() may run concurrently from several threads or processes;
+    they hold a shared flock() on the store and gc() an exclusive one, so gc()
+    never deletes chunks of a recipe that is still being written.
+    """
+
+    def __init__(self, root=DEFAULT_STORE_DIR, block_size=4096, mask_bits=7, min_size=64 << 10, max_size=2 << 20, level=1):
+        """
+        Args:
+            root (str): Store directory.
+            block_size (int): Granularity of chunk boundaries.
+            mask_bits (int): Boundary probability per block is 2**-mask_bits (512 KiB average chunks by default).
+            min_size (int): Smallest chunk, except at the end of an image.
+            max_size (int): Largest chunk, e.g. within long runs of zeros.
+            level (int): zlib compression level of stored chunks.
+        """
+        self.root = root
+        self.block_size = block_size
+        self.mask = (1 << mask_bits) - 1
+        self.min_size = min_size
+        self.max_size = max_size
+        self.level = level
+        self.session = requests.Session()
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(root, "recipes"), exist_ok=True)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, "chunks", digest[:2], digest)
+
+    def recipe_path(self, name):
+        return os.path.join(self.root, "recipes", name + ".json")
+
+    @contextmanager
+    def _flock(self, operation):
+        with open(os.path.join(self.root, "lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _write_chunk(self, digest, compressed):
+        """Store a compressed chunk; another writer storing the same chunk first counts as success."""
+        try:
+            self._write_atomic(self.chunk_path(digest), compressed)
+        except OSError:
+            if not self.has_chunk(digest):
+                raise
+
+    def split(self, stream, read_size=8 << 20):
+        """Yield the content-defined chunks of a binary stream as bytes."""
+        zero_crc = zlib.crc32(bytes(self.block_size))  # runs of zeros end only at max_size
+        pending = bytearray()
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                break
+            view = memoryview(data)
+            start = 0
+            for pos in range(0, len(data), self.block_size):
+                block = view[pos:pos + self.block_size]
+                size = len(pending) + pos + len(block) - start
+                if size < self.min_size:
+                    continue
+                crc = zlib.crc32(block)
+                if size >= self.max_size or (not crc & self.mask and crc != zero_crc):
+                    pending += view[start:pos + len(block)]
+                    yield bytes(pending)
+                    pending.clear()
+                    start = pos + len(block)
+            pending += view[start:]
+        if pending:
+            yield bytes(pending)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    def _put_chunk(self, chunk):
+        """Store a chunk unless present; returns (digest, compressed bytes added)."""
+        digest = hashlib.blake2b(chunk, digest_size=20).hexdigest()
+        if self.has_chunk(digest):
+            return digest, 0
+        compressed = zlib.compress(chunk, self.level)
+        self._write_chunk(digest, compressed)
+        return digest, len(compressed)
+
+    def read_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as file:
+            return zlib.decompress(file.read())
+
+    def add(self, name, image_path):
+        """
+        Split an (uncompressed) image into the store under `name`.
+
+        Returns:
+            dict: size, chunks, new_chunks and new_bytes (compressed bytes added to the store).
+        """
+        sha256 = hashlib.sha256()
+        chunks = []
+        new_chunks = new_bytes = 0
+        with self._flock(fcntl.LOCK_SH), open(image_path, 'rb') as image:
+            for chunk in self.split(image):
+                sha256.update(chunk)
+                digest, added = self._put_chunk(chunk)
+                chunks.append([digest, len(chunk)])
+                if added:
+                    new_chunks += 1
+                    new_bytes += added
+            recipe = {"size": sum(length for _, length in chunks), "sha256": sha256.hexdigest(), "chunks": chunks}
+            self._write_atomic(self.recipe_path(name), json.dumps(recipe).encode())
+        return {"size": recipe["size"], "chunks": len(chunks), "new_chunks": new_chunks, "new_bytes": new_bytes}
+
+    def recipe(self, name):
+        with open(self.recipe_path(name)) as file:
+            return json.load(file)
+
+    def names(self):
+        return sorted(entry[:-len(".json")] for entry in os.listdir(os.path.join(self.root, "recipes")) if entry.endswith(".json"))
+
+    def open(self, name):
+        """Return a binary stream of the image rebuilt from its chunks (wrap it in io.BufferedReader for peek())."""
+        return RecipeReader(self, self.recipe(name)["chunks"])
+
+    def rebuild(self, name, path):
+        """Write the image to `path`, leaving all-zero chunks as holes of a sparse file."""
+        recipe = self.recipe(name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as file:
+            for digest, length in recipe["chunks"]:
+                chunk = self.read_chunk(digest)
+                if chunk == bytes(length):
+                    file.seek(length, os.SEEK_CUR)
+                else:
+                    file.write(chunk)
+            file.truncate(recipe["size"])
+        os.replace(tmp_path, path)
+        return path
+
+    def fetch(self, index_url, name=None):
+        """
+        Copy a recipe from a served store, downloading only the chunks missing here.
+
+        Args:
+            index_url (str): URL of the recipe, <store URL>/recipes/<name>.json.
+            name (str): Local name of the recipe; defaults to the remote one.
+
+        Returns:
+            tuple: (name, dict with chunks, fetched_chunks and fetched_bytes).
+
+        Raises:
+            Exception: If a chunk is corrupt or the image rebuilt from the recipe
+                does not match its size and sha256.
+        """
+        base, _, remote_name = index_url.rpartition("/recipes/")
+        if remote_name.endswith(".json"):
+            remote_name = remote_name[:-len(".json")]
+        name = name or remote_name
+        response = self.session.get(index_url, timeout=30)
+        response.raise_for_status()
+        recipe = response.json()
+        fetched_chunks = fetched_bytes = 0
+        with self._flock(fcntl.LOCK_SH):
+            for digest in dict.fromkeys(digest for digest, _ in recipe["chunks"]):
+                if self.has_chunk(digest):
+                    continue
+                response = self.session.get(f"{base}/chunks/{digest[:2]}/{digest}", timeout=30)
+                response.raise_for_status()
+                if hashlib.blake2b(zlib.decompress(response.content), digest_size=20).hexdigest() != digest:
+                    raise Exception(f"Chunk {digest} from {base} is corrupt")
+                self._write_chunk(digest, response.content)
+                fetched_chunks += 1
+                fetched_bytes += len(response.content)
+            sha256, size = hashlib.sha256(), 0
+            with RecipeReader(self, recipe["chunks"]) as reader:
+                for data in iter(lambda: reader.read(8 << 20), b''):
+                    sha256.update(data)
+                    size += len(data)
+            if size != recipe["size"] or sha256.hexdigest() != recipe["sha256"]:
+                raise Exception(f"Image {remote_name} rebuilt from {base} does not match its recipe")
+            self._write_atomic(self.recipe_path(name), json.dumps(recipe).encode())
+        return name, {"chunks": len(recipe["chunks"]), "fetched_chunks": fetched_chunks, "fetched_bytes": fetched_bytes}
+
+    def remove(self, name):
+        os.remove(self.recipe_path(name))
+
+    def gc(self):
+        """Delete the chunks no recipe refers to; returns the number of bytes freed."""
+        with self._flock(fcntl.LOCK_EX):
+            used = set()
+            for name in self.names():
+                used.update(digest for digest, _ in self.recipe(name)["chunks"])
+            freed = 0
+            chunks_dir = os.path.join(self.root, "chunks")
+            for prefix in os.listdir(chunks_dir):
+                for digest in os.listdir(os.path.join(chunks_dir, prefix)):
+                    if digest not in used:
+                        path = os.path.join(chunks_dir, prefix, digest)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+            return freed
+
+class RecipeReader(io.RawIOBase):
+    """Reads an image from the store chunk by chunk, holding one decompressed chunk at a time."""
+
+    def __init__(self, store, chunks):
+        self._store = store
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            entry = next(self._chunks, None)
+            if entry is None:
+                return 0
+            self._pending = memoryview(self._store.read_chunk(entry[0]))
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the deduplicating OS image store.")
+    parser.add_argument('--root', default=DEFAULT_STORE_DIR, help="Store directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    add_parser = commands.add_parser('add', help="Add an uncompressed image")
+    add_parser.add_argument('name')
+    add_parser.add_argument('image')
+    commands.add_parser('list', help="List the stored images")
+    remove_parser = commands.add_parser('remove', help="Remove an image and free its unshared chunks")
+    remove_parser.add_argument('name')
+    args = parser.parse_args()
+
+    store = ChunkStore(args.root)
+    if args.command == 'add':
+        stats = store.add(args.name, args.image)
+        print(f"{args.name}: {stats['size'] >> 20} MiB in {stats['chunks']} chunks, "
+              f"{stats['new_chunks']} new ({stats['new_bytes'] >> 20} MiB stored)")
+    elif args.command == 'list':
+        for name in store.names():
+            print(f"{name}\t{store.recipe(name)['size'] >> 20} MiB")
+    else:
+        store.remove(args.name)
+        print(f"Freed {store.gc() >> 20} MiB")
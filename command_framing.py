@@ -0,0 +1,175 @@
+import os
+import re
+import shlex
+import time
+
+MARKER_PREFIX = "__BT"
+
+class CommandFrame:
+    """
+    A shell command wrapped between a unique begin marker and an end marker
+    that carries the command's exit status.
+
+    The markers are written with an empty quote pair in the middle
+    ('__BT''_BEGIN_...'), so the terminal echo of the command line never
+    contains them and only the DUT's own output can complete a frame. The
+    command itself runs through `eval` of a quoted string, so a trailing `&`,
+    `;` or `# comment` cannot break (or swallow) the end marker.
+    """
+
+    def __init__(self, cmd, token=None):
+        """
+        Initialize the frame.
+
+        Args:
+            cmd (str): The shell command to run on the DUT.
+            token (str): Unique frame id, random when omitted.
+        """
+        self.cmd = cmd
+        self.token = token or os.urandom(4).hex()
+        self.begin_marker = f"{MARKER_PREFIX}_BEGIN_{self.token}__"
+        self.end_marker = f"{MARKER_PREFIX}_END_{self.token}__"
+        self._end_re = re.compile(re.escape(self.end_marker) + r":(\d+)")
+
+    def wrap(self):
+        """Return the command line to send to the DUT shell."""
+        return (f"echo '{MARKER_PREFIX}''_BEGIN_{self.token}__'; eval {shlex.quote(self.cmd)}; "
+                f"echo '{MARKER_PREFIX}''_END_{self.token}__:'$?")
+
+    def parse_end(self, line):
+        """Return (text_before_marker, exit_code) if `line` holds the end marker, else None."""
+        match = self._end_re.search(line)
+        if not match:
+            return None
+        return line[:match.start()], int(match.group(1))
+
+class FrameParser:
+    """Incrementally extracts the output and exit code of one CommandFrame from serial text."""
+
+    def __init__(self, frame, sink=None):
+        """
+        Initialize the parser.
+
+        Args:
+            frame (CommandFrame): The frame to look for.
+            sink (callable): Receives output lines as they complete; lines are
+                collected in memory when omitted.
+        """
+        self.frame = frame
+        self.sink = sink
+        self.began = False
+        self.finished = False
+        self.exit_code = None
+        self._lines = []
+        self._pending = ""
+
+    @property
+    def output(self):
+        """Output collected between the markers (only when no sink is used)."""
+        return "".join(self._lines)
+
+    def feed(self, text):
+        """Consume decoded serial text; return True once the end marker has arrived."""
+        if self.finished:
+            return True
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            if self.feed_line(line + '\n'):
+                return True
+        return False
+
+    def feed_line(self, line):
+        """Consume one complete line; return True once the end marker has arrived."""
+        if not self.began:
+            if self.frame.begin_marker in line:
+                self.began = True
+            return False
+
+        # echo always terminates the marker with a newline, so only complete lines
+        # are checked; output without a trailing newline shares the marker's line
+        end = self.frame.parse_end(line)
+        if end is not None:
+            before, self.exit_code = end
+            if before:
+                self._emit(before)
+            self.finished = True
+            return True
+
+        self._emit(line)
+        return False
+
+    def _emit(self, line):
+        if self.sink:
+            self.sink(line)
+        else:
+            self._lines.append(line)
+
+class BatchParser:
+    """Splits the combined output of several CommandFrames sent as one script back into per-frame results."""
+
+    def __init__(self, frames, sinks=None, clock=time.monotonic):
+        """
+        Initialize the parser.
+
+        Args:
+            frames (list): CommandFrames in the order they were sent.
+            sinks (list): Optional per-frame output sinks, see FrameParser.
+            clock (callable): Time source used to stamp each frame's completion.
+        """
+        sinks = sinks or [None] * len(frames)
+        self.parsers = [FrameParser(frame, sink) for frame, sink in zip(frames, sinks)]
+        self.finish_times = [None] * len(frames)
+        self.clock = clock
+        self.index = 0
+        self._pending = ""
+
+    @property
+    def finished(self):
+        return self.index >= len(self.parsers)
+
+    def feed(self, text):
+        """Consume decoded serial text; return True once every frame has completed."""
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            line += '\n'
+            while not self.finished:
+                parser = self.parsers[self.index]
+                nxt = self.parsers[self.index + 1] if self.index + 1 < len(self.parsers) else None
+                # A frame whose end marker never showed up (e.g. the command killed
+                # the echo) is closed as soon as the next frame begins.
+                if parser.began and nxt and nxt.frame.begin_marker in line:
+                    self._advance()
+                    continue
+                if parser.feed_line(line):
+                    self._advance()
+                break
+        return self.finished
+
+    def _advance(self):
+        self.finish_times[self.index] = self.clock()
+        self.index += 1
+
+def batch_lines(frames, max_line=3000):
+    """
+    Join framed commands into as few shell lines as possible.
+
+    Each line stays under `max_line` characters so it fits the tty's canonical
+    input buffer (4095 bytes on Linux).
+
+    Returns:
+        list: (line, frames_in_line) tuples.
+    """
+    batches = []
+    line, members = "", []
+    for frame in frames:
+        wrapped = frame.wrap()
+        if members and len(line) + 2 + len(wrapped) > max_line:
+            batches.append((line, members))
+            line, members = "", []
+        line = f"{line}; {wrapped}" if members else wrapped
+        members.append(frame)
+    if members:
+        batches.append((line, members))
+    return batches
@@ -0,0 +1,448 @@
+import ctypes
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+SYSFS_ROOT = "/sys"
+DEFAULT_CACHE_PATH = os.environ.get("BOARDTEST_DEVICE_CACHE", os.path.expanduser("~/.cache/boardtest/devices.json"))
+NETLINK_KOBJECT_UEVENT = 15
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+def usb_device_by_serial(serial, sysfs=SYSFS_ROOT):
+    """Return the sysfs path of the USB device with the given iSerial string, or None."""
+    devices = os.path.join(sysfs, "bus", "usb", "devices")
+    if not os.path.isdir(devices):
+        return None
+    for name in sorted(os.listdir(devices)):
+        try:
+            with open(os.path.join(devices, name, "serial")) as file:
+                if file.read().strip() == serial:
+                    return os.path.realpath(os.path.join(devices, name))
+        except OSError:
+            continue
+    return None
+
+def usb_attribute(usb_path, name):
+    """Return a sysfs attribute of a USB device (e.g. serial, idVendor), or None if it has none."""
+    try:
+        with open(os.path.join(usb_path, name)) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def is_mass_storage(usb_path):
+    """True if the USB device at `usb_path` has a mass storage interface (a card reader)."""
+    for entry in os.listdir(usb_path):
+        try:
+            with open(os.path.join(usb_path, entry, "bInterfaceClass")) as file:
+                if file.read().strip() == "08":
+                    return True
+        except OSError:
+            continue
+    return False
+
+def block_disks(sysfs=SYSFS_ROOT):
+    """Return {name: sysfs path} of the whole-disk block devices (no partitions)."""
+    block = os.path.join(sysfs, "class", "block")
+    if not os.path.isdir(block):
+        return {}
+    disks = {}
+    for name in os.listdir(block):
+        path = os.path.realpath(os.path.join(block, name))
+        if not os.path.exists(os.path.join(path, "partition")):
+            disks[name] = path
+    return disks
+
+def usb_device_of(path, sysfs=SYSFS_ROOT):
+    """Return the sysfs path of the USB device a device at `path` hangs off, or None."""
+    devices = os.path.realpath(os.path.join(sysfs, "devices"))
+    while path.startswith(devices + os.sep):
+        if os.path.exists(os.path.join(path, "busnum")):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+class UeventMonitor:
+    """
+    Listens for kernel uevents and hands them to the waiters interested in them.
+
+    Events come from a NETLINK_KOBJECT_UEVENT socket. Where netlink cannot be
+    bound (containers, restricted hosts) device node creations and removals in
+    /dev are watched with inotify instead, and the event is completed from sysfs.
+    Events are dicts with ACTION, DEVPATH, SUBSYSTEM, DEVNAME and DEVTYPE.
+    """
+
+    def __init__(self, sysfs=SYSFS_ROOT, dev_dir="/dev"):
+        self.sysfs = sysfs
+        self.dev_dir = dev_dir
+        self._waiters = []
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread:
+            return
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            target, args = self._read_netlink, (sock,)
+        except (OSError, AttributeError):
+            target, args = self._read_inotify, (self._inotify_fd(),)
+        self._thread = threading.Thread(target=target, args=args, name="uevent-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def subscribe(self, callback):
+        """Call callback(event) for every event from now on, on the monitor's thread."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def watch(self, predicate):
+        """Return a Waiter receiving the events for which predicate(event) is true; register it before acting."""
+        return Waiter(self, predicate)
+
+    def dispatch(self, event):
+        with self._lock:
+            waiters = list(self._waiters)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                # One broken subscriber must not stop the monitor every board relies on
+                print(f"uevent subscriber {callback!r} failed on {event.get('DEVPATH')}: {e}")
+        for waiter in waiters:
+            if waiter.predicate(event):
+                waiter.events.append(event)
+                waiter.ready.set()
+
+    def _read_netlink(self, sock):
+        with sock:
+            while not self._stop.is_set():
+                if not select.select([sock], [], [], 0.5)[0]:
+                    continue
+                data = sock.recv(16384)
+                if data.startswith(b"libudev"):
+                    continue
+                fields = data.split(b"\0")
+                event = dict(field.decode(errors="replace").split("=", 1) for field in fields[1:] if b"=" in field)
+                self.dispatch(event)
+
+    def _inotify_fd(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0 or libc.inotify_add_watch(fd, self.dev_dir.encode(), IN_CREATE | IN_DELETE) < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        return fd
+
+    def _read_inotify(self, fd):
+        try:
+            while not self._stop.is_set():
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                data = os.read(fd, 16384)
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, length = struct.unpack_from("iIII", data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(errors="replace")
+                    offset += 16 + length
+                    self.dispatch(self._event_from_sysfs(name, "add" if mask & IN_CREATE else "remove"))
+        finally:
+            os.close(fd)
+
+    def _event_from_sysfs(self, name, action):
+        event = {"ACTION": action, "DEVNAME": name}
+        for subsystem in ("block", "scsi_generic"):
+            path = os.path.join(self.sysfs, "class", subsystem, name)
+            if os.path.exists(path):
+                real = os.path.realpath(path)
+                event["SUBSYSTEM"] = subsystem
+                event["DEVPATH"] = real[len(os.path.realpath(self.sysfs)):]
+                if subsystem == "block":
+                    event["DEVTYPE"] = "partition" if os.path.exists(os.path.join(real, "partition")) else "disk"
+        return event
+
+class Waiter:
+    """Events matching a predicate, collected from the moment the `with` block is entered."""
+
+    def __init__(self, monitor, predicate):
+        self.monitor = monitor
+        self.predicate = predicate
+        self.events = []
+        self.ready = threading.Event()
+
+    def __enter__(self):
+        with self.monitor._lock:
+            self.monitor._waiters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.monitor._lock:
+            self.monitor._waiters.remove(self)
+
+    def wait(self, timeout):
+        """Return the first matching event, or None after `timeout` seconds."""
+        if not self.ready.wait(timeout):
+            return None
+        return self.events[0]
+
+class SysfsIndex:
+    """
+    Index of USB SD muxes by serial: the SCSI generic and block device of each.
+
+    Built once from /sys/class/scsi_generic and /sys/block, then kept current
+    by the uevents of devices coming and going, so a lookup is a dict access
+    however many muxes are switched. Only the device named by an event is
+    resolved again; the tree is rescanned only if a lookup misses.
+    """
+
+    def __init__(self, sysfs=SYSFS_ROOT, dev_dir="/dev", monitor=None):
+        self.sysfs = sysfs
+        self.dev_dir = dev_dir
+        self._lock = threading.Lock()
+        self._muxes = {}  # SCSI device path -> {"serial", "sg", "block"}
+        self._names = {}  # sgN / sdX -> SCSI device path
+        self.scan()
+        if monitor is not None:
+            monitor.subscribe(self._on_event)
+            monitor.start()
+
+    def _resolve(self, kind, name):
+        """Add the sg or block device `name` to its mux entry; returns whether it belongs to a USB device with a serial."""
+        directory = os.path.join(self.sysfs, "class", "scsi_generic") if kind == "sg" else os.path.join(self.sysfs, "block")
+        path = os.path.realpath(os.path.join(directory, name))
+        scsi_device = os.path.dirname(os.path.dirname(path))  # .../host0/target0:0:0/0:0:0:0/{scsi_generic,block}/<name>
+        usb_path = usb_device_of(path, self.sysfs)
+        if usb_path is None:
+            return False
+        try:
+            with open(os.path.join(usb_path, "serial")) as file:
+                serial = file.read().strip()
+        except OSError:
+            return False
+        with self._lock:
+            entry = self._muxes.setdefault(scsi_device, {"serial": serial, "sg": None, "block": None})
+            entry[kind] = name
+            self._names[name] = scsi_device
+        return True
+
+    def scan(self):
+        """Rebuild the index from sysfs."""
+        with self._lock:
+            self._muxes.clear()
+            self._names.clear()
+        for kind, directory in (("sg", os.path.join(self.sysfs, "class", "scsi_generic")), ("block", os.path.join(self.sysfs, "block"))):
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    self._resolve(kind, name)
+
+    def _on_event(self, event):
+        name = event.get("DEVNAME", "").rpartition("/")[2]
+        if event.get("ACTION") == "add":
+            if event.get("SUBSYSTEM") == "scsi_generic":
+                self._resolve("sg", name)
+            elif event.get("SUBSYSTEM") == "block" and event.get("DEVTYPE") == "disk":
+                self._resolve("block", name)
+        elif event.get("ACTION") == "remove":
+            with self._lock:
+                scsi_device = self._names.pop(name, None)
+                entry = self._muxes.get(scsi_device)
+                if entry:
+                    for kind in ("sg", "block"):
+                        if entry[kind] == name:
+                            entry[kind] = None
+                    if not entry["sg"] and not entry["block"]:
+                        del self._muxes[scsi_device]
+
+    def serials(self):
+        with self._lock:
+            return sorted({entry["serial"] for entry in self._muxes.values()})
+
+    def lookup(self, serial=None):
+        """
+        Return (sg device, block device) paths of the mux with `serial`; either may be None.
+
+        Without a serial the only mux on the host is returned.
+        """
+        for attempt in range(2):
+            with self._lock:
+                entries = [entry for entry in self._muxes.values() if serial is None or entry["serial"] == serial]
+            if len(entries) == 1:
+                entry = entries[0]
+                return tuple(os.path.join(self.dev_dir, entry[kind]) if entry[kind] else None for kind in ("sg", "block"))
+            if serial is None and len(entries) > 1:
+                raise Exception(f"Several USB SD muxes are connected ({', '.join(self.serials())}), set the serial of the one to use")
+            if attempt == 0:
+                self.scan()  # e.g. an event that was missed
+        raise Exception(f"USB SD mux {serial} not found in sysfs" if serial else "No USB SD mux found in sysfs")
+
+class DeviceDiscovery:
+    """
+    Finds the block device of the SD card behind an SD mux without polling /dev.
+
+    The mux is located in the USB topology by its serial string: the card
+    reader is either the mux itself (usbsdmux) or a sibling on the mux's
+    internal hub (SDWire). The card is the disk below that point, taken from
+    sysfs if it is already connected to the test server, else from the uevent
+    announcing it after the mux is switched. Since only disks below the mux's
+    own USB port match, several muxes can switch at once. Mux serial -> USB
+    path and device are cached on disk. A cached path is only used while the
+    device there is still the mux (or the reader found for it), since another
+    device may have enumerated on the same port after the mux was unplugged.
+
+    Muxes that cannot be found in sysfs fall back to taking the first disk that
+    appears after switching to the test server, one such mux at a time.
+    """
+
+    def __init__(self, sysfs=SYSFS_ROOT, dev_dir="/dev", cache_path=DEFAULT_CACHE_PATH, monitor=None):
+        self.sysfs = sysfs
+        self.dev_dir = dev_dir
+        self.cache_path = cache_path
+        self.monitor = monitor or UeventMonitor(sysfs, dev_dir)
+        self.monitor.start()
+        self._lock = threading.Lock()
+        self._fallback_lock = threading.Lock()
+        try:
+            with open(cache_path) as file:
+                self._cache = json.load(file)
+        except (OSError, ValueError):
+            self._cache = {}
+
+    def _remember(self, serial, usb_path, name, fallback=False):
+        entry = {"usb_path": usb_path, "device": name}
+        if fallback:
+            # Not found by the mux serial: identify the reader itself on revalidation
+            entry["reader_id"] = [usb_attribute(usb_path, attribute) for attribute in ("serial", "idVendor", "idProduct")]
+        with self._lock:
+            self._cache[serial] = entry
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as file:
+                    json.dump(self._cache, file, indent=1)
+                os.replace(tmp_path, self.cache_path)
+            except OSError:
+                pass  # the in-memory cache still works
+        return os.path.join(self.dev_dir, name)
+
+    def _anchor(self, serial):
+        """Return the sysfs path below which the mux's card reader sits, or None."""
+        cached = self._cached_anchor(serial)
+        if cached:
+            return cached
+        usb_path = usb_device_by_serial(serial, self.sysfs)
+        if usb_path is None:
+            return None
+        return usb_path if is_mass_storage(usb_path) else os.path.dirname(usb_path)
+
+    def _cached_anchor(self, serial):
+        """Return the cached anchor of a mux if the same device is still there, dropping the entry otherwise."""
+        with self._lock:
+            entry = self._cache.get(serial)
+        if not entry or not entry.get("usb_path"):
+            return None
+        cached = entry["usb_path"]
+        if os.path.isdir(cached):
+            if "reader_id" in entry:
+                current = [usb_attribute(cached, attribute) for attribute in ("serial", "idVendor", "idProduct")]
+                if current == entry["reader_id"]:
+                    return cached
+            elif usb_attribute(cached, "serial") == serial or any(
+                    usb_attribute(os.path.join(cached, child), "serial") == serial for child in os.listdir(cached)):
+                return cached  # the mux itself, or the hub it sits on
+        with self._lock:
+            if self._cache.get(serial) is entry:
+                del self._cache[serial]
+        return None
+
+    def _disk_under(self, anchor):
+        for name, path in sorted(block_disks(self.sysfs).items()):
+            if path.startswith(anchor + os.sep):
+                return name
+        return None
+
+    def _wait_for_node(self, name, timeout=2.0):
+        """The kernel announces a disk before udev has created its node."""
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(os.path.join(self.dev_dir, name)) and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    def device_for_mux(self, serial, sd_mux, timeout=10.0, topology_only=False):
+        """
+        Return the /dev path of the SD card behind mux `serial`, switching it to the test server if needed.
+
+        Args:
+            serial (str): Serial of the SD mux.
+            sd_mux (SDMuxController): Used to switch the card.
+            timeout (float): Seconds to wait for the card after switching.
+            topology_only (bool): Fail instead of falling back when the mux is not found in sysfs.
+        """
+        sysfs_root = os.path.realpath(self.sysfs)
+
+        def is_disk_add(event):
+            return event.get("ACTION") == "add" and event.get("SUBSYSTEM") == "block" and event.get("DEVTYPE") == "disk"
+
+        anchor = self._anchor(serial)
+        if anchor:
+            name = self._disk_under(anchor)
+            if name is None:
+                with self.monitor.watch(lambda event: is_disk_add(event) and
+                                        (sysfs_root + event.get("DEVPATH", "")).startswith(anchor + os.sep)) as waiter:
+                    switched = sd_mux.connect_to_ts(serial)
+                    event = waiter.wait(timeout) if switched['success'] else None
+                if not switched['success']:
+                    raise Exception(f"SD mux {serial} could not be switched to the test server: {switched['error']}")
+                if event is None:
+                    raise Exception(f"No SD card appeared behind SD mux {serial} within {timeout}s")
+                name = event["DEVNAME"]
+            self._wait_for_node(name)
+            return self._remember(serial, anchor, name)
+
+        if topology_only:
+            raise Exception(f"SD mux {serial} was not found in the USB topology, set serial.sd_mux_device")
+        with self._fallback_lock:
+            with self.monitor.watch(lambda event: event.get("ACTION") == "remove" and event.get("SUBSYSTEM") == "block") as waiter:
+                sd_mux.connect_to_dut(serial)
+                waiter.wait(2.0)  # only if the card was on the test server
+            with self.monitor.watch(is_disk_add) as waiter:
+                switched = sd_mux.connect_to_ts(serial)
+                event = waiter.wait(timeout) if switched['success'] else None
+        if not switched['success']:
+            raise Exception(f"SD mux {serial} could not be switched to the test server: {switched['error']}")
+        if event is None:
+            raise Exception(f"No new SD card device detected within {timeout}s")
+        name = event["DEVNAME"]
+        self._wait_for_node(name)
+        usb_path = usb_device_of(sysfs_root + event.get("DEVPATH", ""), self.sysfs)
+        return self._remember(serial, usb_path, name, fallback=True) if usb_path else os.path.join(self.dev_dir, name)
+
+_defaults = {}
+_default_lock = threading.Lock()
+
+def _default(kind, factory):
+    with _default_lock:
+        if kind not in _defaults:
+            _defaults[kind] = factory()
+        return _defaults[kind]
+
+def default_monitor():
+    """The process-wide UeventMonitor, so every board shares one uevent listener."""
+    return _default("monitor", UeventMonitor)
+
+def default_discovery():
+    return _default("discovery", lambda: DeviceDiscovery(monitor=default_monitor()))
+
+def default_sysfs_index():
+    return _default("index", lambda: SysfsIndex(monitor=default_monitor()))
@@ -0,0 +1,148 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from texttable import Texttable
+from rich.console import Console
+from main_controller import MainController
+from serial_hub import SerialHub
+from image_prefetcher import ImagePrefetcher
+
+class ResourceLocks:
+    """Named locks for shared farm hardware, always taken in sorted order so jobs cannot deadlock."""
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def _lock(self, name):
+        with self._guard:
+            return self._locks.setdefault(name, threading.Lock())
+
+    @contextmanager
+    def hold(self, names):
+        """Hold every named lock for the duration of the `with` block."""
+        locks = [self._lock(name) for name in sorted(set(names))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+class FarmJob:
+    """One (board, OS) flash-boot-test cycle."""
+
+    def __init__(self, board_config_path, controller, os_name, resources):
+        self.board_config_path = board_config_path
+        self.controller = controller
+        self.os_name = os_name
+        self.resources = resources
+        self.status = "pending"
+        self.results = None
+        self.error = None
+        self.report_path = None
+        self.wait_time = 0.0
+        self.duration = 0.0
+
+    @property
+    def board_name(self):
+        return self.controller.board_name
+
+def board_resources(board_config):
+    """Return the hardware resource names a board occupies while it is flashed, booted and tested."""
+    serial_config = board_config['serial']
+    resources = [
+        f"sdmux:{serial_config['serial_name']}",
+        f"serial:{serial_config['serial_file']}",
+    ]
+    if serial_config.get('sd_mux_device'):
+        resources.append(f"block:{serial_config['sd_mux_device']}")
+    if 'mi_sdk' in board_config:
+        resources.append(f"power:{board_config['mi_sdk']['ip_address']}")
+    return resources
+
+class FarmScheduler:
+    """
+    Runs the OS lists of many boards concurrently.
+
+    The job graph is one chain of (board, OS) jobs per board, run in os_list
+    order; chains run in parallel on a thread pool. Before a job starts it takes
+    the locks of its SD mux, serial port, SD block device and power switch, so
+    boards that share any of them are serialized and the rest proceed in
+    parallel. All serial ports are served by one SerialHub.
+    """
+
+    def __init__(self, board_config_paths, max_workers=None):
+        self.hub = SerialHub()
+        self.locks = ResourceLocks()
+        self.console = Console()
+        self.chains = []
+        for path in board_config_paths:
+            controller = MainController(path, self.hub)
+            # Unattended and with many muxes switching: only trust cards found below their own mux
+            controller.os_manager.topology_only_detection = True
+            resources = board_resources(controller.board_config)
+            self.chains.append([FarmJob(path, controller, os_name, resources)
+                                for os_name in controller.board_config['os_list']])
+        self.max_workers = max_workers or max(len(self.chains), 1)
+
+    @property
+    def jobs(self):
+        return [job for chain in self.chains for job in chain]
+
+    def run(self, flash=False, test=True, stdout_log=False, mi_sdk_enabled=False):
+        """Run every job and return the list of FarmJobs; the farm is unattended, so all prompts are answered yes."""
+        self.hub.start()
+        try:
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                for future in [pool.submit(self._run_chain, chain, flash, test, stdout_log, mi_sdk_enabled)
+                               for chain in self.chains]:
+                    future.result()
+        finally:
+            self.hub.stop()
+        return self.jobs
+
+    def _run_chain(self, chain, flash, test, stdout_log, mi_sdk_enabled):
+        prefetcher = ImagePrefetcher(chain[0].controller.os_manager) if flash and chain else None
+        try:
+            for job in chain:
+                self._run_job(job, flash, test, stdout_log, mi_sdk_enabled, prefetcher)
+        finally:
+            if prefetcher:
+                prefetcher.shutdown()
+
+    def _run_job(self, job, flash, test, stdout_log, mi_sdk_enabled, prefetcher=None):
+        controller = job.controller
+        queued = time.monotonic()
+        with self.locks.hold(job.resources):
+            started = time.monotonic()
+            job.wait_time = started - queued
+            job.status = "running"
+            self.console.print(f"[bold cyan]{job.board_name}: running test suite for OS {job.os_name}...[/bold cyan]")
+            try:
+                job.results = controller.run_test_suite(
+                    job.os_name, controller.board_config['serial']['serial_name'],
+                    flash, test, stdout_log, True, mi_sdk_enabled, prefetcher)
+                if job.results is not None:
+                    job.report_path = f"report_{job.board_name}_{job.os_name}.txt"
+                    controller.generate_report(job.results, job.report_path)
+                job.status = "completed"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                self.console.print(f"[bold red]{job.board_name}: OS {job.os_name} failed: {e}[/bold red]")
+            finally:
+                job.duration = time.monotonic() - started
+
+    def summary(self):
+        """Return a text table with the outcome of every job."""
+        table = Texttable()
+        table.set_deco(Texttable.HEADER)
+        table.add_rows([["Board", "OS", "Status", "Passed", "Waited (s)", "Duration (s)", "Report"]])
+        for job in self.jobs:
+            passed = "-" if not job.results else f"{sum(r['success'] for r in job.results)}/{len(job.results)}"
+            table.add_row([job.board_name, job.os_name, job.error or job.status, passed,
+                           f"{job.wait_time:.1f}", f"{job.duration:.1f}", job.report_path or "-"])
+        return table.draw()
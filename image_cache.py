@@ -0,0 +1,392 @@
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import requests
+import urllib3
+
+DEFAULT_CACHE_DIR = os.environ.get("BOARDTEST_IMAGE_CACHE", "./images/cache")
+
+class ImageCache:
+    """
+    Content-addressed cache of downloaded OS images, shared by every board on the host.
+
+    Layout of the cache directory:
+        objects/<sha256>     complete images, named by their SHA-256 digest
+        partial/<key>.part   interrupted downloads, resumed with HTTP Range requests
+        index.json           URL -> (ETag, Last-Modified, digest) and digest -> (size, last use)
+        pins/<sha256>.lock   held with a shared flock() while an object is in use
+
+    Downloads are streamed in chunks and hashed on the fly, so an image is never
+    held in memory. A cached URL is revalidated with a conditional GET, so a new
+    upstream release (different ETag) is fetched while an unchanged one costs a
+    single 304. Objects beyond `max_size` are evicted least recently used first.
+    The index and each in-flight download are protected by flock(), so several
+    boards, threads or processes can share one cache directory. Objects pinned
+    by fetch(pin=True), e.g. prefetched images waiting to be flashed, are not
+    evicted until they are released.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_size=None, chunk_size=1 << 20, retries=5, timeout=30):
+        """
+        Initialize the cache.
+
+        Args:
+            root (str): Cache directory.
+            max_size (int): Size cap in bytes for all cached objects, or None for no cap.
+            chunk_size (int): Bytes read from the network per iteration.
+            retries (int): How many times an interrupted download is resumed before giving up.
+            timeout (float): Connect/read timeout of each HTTP request in seconds.
+        """
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+        os.makedirs(os.path.join(root, "pins"), exist_ok=True)
+        self._pins = {}  # digest -> [pin file holding the shared flock, users in this process]
+        self._pins_lock = threading.Lock()
+
+    @staticmethod
+    def url_key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest)
+
+    @contextmanager
+    def _flock(self, name):
+        with open(os.path.join(self.root, name), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, "index.json")) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"urls": {}, "objects": {}}
+
+    def _save_index(self, index):
+        path = os.path.join(self.root, "index.json")
+        with open(path + ".tmp", 'w') as file:
+            json.dump(index, file, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def pin_path(self, digest):
+        return os.path.join(self.root, "pins", digest + ".lock")
+
+    def _pin(self, digest):
+        """Pin an object; call with index.lock held, so it cannot be evicted in between."""
+        with self._pins_lock:
+            pin = self._pins.get(digest)
+            if pin is None:
+                lock_file = open(self.pin_path(digest), 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                pin = self._pins[digest] = [lock_file, 0]
+            pin[1] += 1
+
+    def release(self, path):
+        """Release a pin taken by fetch(pin=True) or lookup(pin=True) on the object at `path`."""
+        digest = os.path.basename(path)
+        with self._pins_lock:
+            pin = self._pins.get(digest)
+            if pin is None:
+                return
+            pin[1] -= 1
+            if pin[1] == 0:
+                del self._pins[digest]
+                pin[0].close()  # drops the flock
+
+    def _pinned(self, digest):
+        """Return an exclusive lock file of an unpinned object (close it after removing the object), or None if it is pinned."""
+        lock_file = open(self.pin_path(digest), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def lookup(self, url=None, sha256=None, pin=False):
+        """Return the cached object path for a digest or a previously fetched URL, or None; pin it if asked to."""
+        with self._flock("index.lock"):
+            index = self._load_index()
+            digest = sha256.lower() if sha256 else index["urls"].get(self.url_key(url), {}).get("digest") if url else None
+            if not digest or not os.path.exists(self.object_path(digest)):
+                return None
+            self._touch(index, digest)
+            self._save_index(index)
+            if pin:
+                self._pin(digest)
+            return self.object_path(digest)
+
+    def _touch(self, index, digest):
+        entry = index["objects"].setdefault(digest, {"size": os.path.getsize(self.object_path(digest))})
+        entry["last_used"] = time.time()
+
+    def fetch(self, url, sha256=None, tee=None, pin=False, cancel=None):
+        """
+        Return the path of the cached image for `url`, downloading it if needed.
+
+        Args:
+            url (str): Image URL.
+            sha256 (str): Expected digest; when given and already cached no request is made at all.
+            tee (DownloadPipe): Receives the downloaded bytes as they arrive; the caller feeds
+                it the rest from the returned path with tee.finish(path).
+            pin (bool): Keep the object from being evicted until release(path) is called.
+            cancel (threading.Event): Stops the download when set; the partial file is kept for resuming.
+
+        Returns:
+            str: Path of the image inside the cache.
+        """
+        if sha256:
+            path = self.lookup(sha256=sha256, pin=pin)
+            if path:
+                return path
+
+        key = self.url_key(url)
+        # One download per URL at a time; later callers find the finished object.
+        with self._flock(os.path.join("partial", key + ".lock")):
+            with self._flock("index.lock"):
+                entry = dict(self._load_index()["urls"].get(key, {}))
+            cached = entry.get("digest")
+            if cached and not os.path.exists(self.object_path(cached)):
+                cached = None
+            if cached and sha256 and cached != sha256.lower():
+                cached = None
+
+            digest, validators = self._download(url, key, entry if cached else {}, tee, cancel)
+            if digest is None:  # 304 Not Modified
+                digest = cached
+            elif sha256 and digest != sha256.lower():
+                os.remove(self.object_path(digest))
+                raise Exception(f"Downloaded image {url} has sha256 {digest}, expected {sha256}")
+
+            with self._flock("index.lock"):
+                index = self._load_index()
+                index["urls"][key] = dict(url=url, digest=digest, **validators)
+                self._touch(index, digest)
+                self._evict(index, keep=digest)
+                self._save_index(index)
+                if pin:
+                    self._pin(digest)
+            return self.object_path(digest)
+
+    def _download(self, url, key, cached_entry, tee=None, cancel=None):
+        """
+        Stream `url` into partial/<key>.part, resuming it across dropped connections.
+
+        Returns:
+            tuple: (digest, validators), digest being None if the cached object is still current.
+        """
+        part = os.path.join(self.root, "partial", key + ".part")
+        meta_path = part + ".json"
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (FileNotFoundError, ValueError):
+            meta = {}
+        hasher, hashed = hashlib.sha256(), 0
+        attempts = 0
+        while True:
+            validator = meta.get("etag") or meta.get("last_modified")
+            offset = os.path.getsize(part) if validator and os.path.exists(part) else 0
+            if offset and meta.get("size") is not None and offset >= meta["size"]:
+                break  # complete, but the process died before it was moved into objects/
+            headers = {"Accept-Encoding": "identity"}  # store the exact bytes the server has
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = validator
+            elif cached_entry.get("etag"):
+                headers["If-None-Match"] = cached_entry["etag"]
+            elif cached_entry.get("last_modified"):
+                headers["If-Modified-Since"] = cached_entry["last_modified"]
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 304:
+                        return None, {k: cached_entry[k] for k in ("etag", "last_modified") if k in cached_entry}
+                    if response.status_code == 416 and offset:
+                        break  # nothing left after offset: the partial file is complete
+                    response.raise_for_status()
+                    if response.status_code == 206:
+                        print(f"Resuming download of {url} at {offset} bytes...")
+                    else:
+                        offset = 0
+                        print(f"Downloading {url}...")
+                        meta = {
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "size": int(response.headers["Content-Length"]) if response.headers.get("Content-Length") else None,
+                        }
+                        with open(meta_path, 'w') as file:
+                            json.dump(meta, file)
+                    if tee is not None:
+                        if tee.position > offset:
+                            raise Exception(f"Download of {url} restarted from scratch, cannot keep streaming it")
+                        if offset > tee.position:
+                            tee.feed_file(part, offset)
+                    if hashed != offset:
+                        # Resumed from a previous run: hash what is already on disk first
+                        hasher, hashed = hashlib.sha256(), 0
+                        with open(part, 'rb') as file:
+                            while hashed < offset:
+                                chunk = file.read(min(4 << 20, offset - hashed))
+                                hasher.update(chunk)
+                                hashed += len(chunk)
+                    with open(part, 'r+b' if offset else 'wb') as file:
+                        file.seek(offset)
+                        file.truncate()
+                        for chunk in response.raw.stream(self.chunk_size, decode_content=False):
+                            file.write(chunk)
+                            if tee is not None:
+                                tee.feed(chunk)
+                            if cancel is not None and cancel.is_set():
+                                raise Exception(f"Download of {url} was cancelled")
+                            hasher.update(chunk)
+                            hashed += len(chunk)
+            except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                attempts += 1
+                response = getattr(e, 'response', None)
+                if attempts > self.retries or (response is not None and response.status_code < 500):
+                    raise
+                print(f"Download of {url} interrupted ({e}), retrying...")
+                delay = min(2 ** (attempts - 1), 30)
+                if cancel is None:
+                    time.sleep(delay)
+                elif cancel.wait(delay):
+                    raise Exception(f"Download of {url} was cancelled")
+                continue
+
+            if meta.get("size") is not None and hashed < meta["size"]:
+                attempts += 1
+                if attempts > self.retries:
+                    raise Exception(f"Download of {url} stopped at {hashed} of {meta['size']} bytes")
+                continue
+            break
+
+        size = os.path.getsize(part)
+        if hashed != size:
+            # Completed by an earlier run: hash the file from where this run left off
+            with open(part, 'rb') as file:
+                if hashed > size:
+                    hasher, hashed = hashlib.sha256(), 0
+                file.seek(hashed)
+                for chunk in iter(lambda: file.read(4 << 20), b''):
+                    hasher.update(chunk)
+        digest = hasher.hexdigest()
+        os.replace(part, self.object_path(digest))
+        os.remove(meta_path)
+        return digest, {k: v for k, v in meta.items() if k in ("etag", "last_modified") and v}
+
+    def _evict(self, index, keep=None):
+        """Remove least recently used objects that are not pinned until the cache fits into max_size."""
+        objects = index["objects"]
+        for digest in list(objects):
+            if not os.path.exists(self.object_path(digest)):
+                del objects[digest]
+        if self.max_size is None:
+            return
+        total = sum(entry["size"] for entry in objects.values())
+        for digest in sorted(objects, key=lambda d: objects[d].get("last_used", 0)):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            lock_file = self._pinned(digest)
+            if lock_file is None:
+                continue  # in use, e.g. prefetched for a board that has not flashed it yet
+            with lock_file:
+                for path in [self.object_path(digest)] + glob.glob(self.object_path(digest) + ".*"):
+                    os.remove(path)  # the object and sidecars such as its block map
+                os.remove(self.pin_path(digest))
+            total -= objects.pop(digest)["size"]
+            index["urls"] = {k: v for k, v in index["urls"].items() if v.get("digest") != digest}
+
+class DownloadPipe(io.RawIOBase):
+    """
+    Bounded in-memory pipe handing the bytes of a download to a consumer while they
+    are also written to the cache, e.g. to decompress and flash an image before it
+    has finished downloading.
+
+    The producer calls feed()/feed_file() and then finish(path) or fail(error); the
+    consumer reads it like a file (wrap it in io.BufferedReader for peek()).
+    """
+
+    def __init__(self, max_chunks=32):
+        self.position = 0  # bytes fed so far
+        self._queue = queue.Queue(max_chunks)
+        self._pending = b""
+        self._eof = False
+        self._cancelled = False
+
+    def _put(self, item):
+        while not self._cancelled:
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise Exception("Download stream was cancelled by its consumer")
+
+    def feed(self, chunk):
+        self._put(bytes(chunk))
+        self.position += len(chunk)
+
+    def feed_file(self, path, end=None):
+        """Feed the bytes of `path` from the current position up to `end` (default: end of file)."""
+        if end is not None and end <= self.position:
+            return
+        with open(path, 'rb') as file:
+            file.seek(self.position)
+            while end is None or self.position < end:
+                chunk = file.read(1 << 20 if end is None else min(1 << 20, end - self.position))
+                if not chunk:
+                    break
+                self.feed(chunk)
+
+    def finish(self, path):
+        """Feed whatever the consumer has not seen yet from the complete file and signal end of stream."""
+        self.feed_file(path)
+        self._put(None)
+
+    def fail(self, error):
+        try:
+            self._put(error)
+        except Exception:
+            pass  # the consumer is already gone
+
+    def cancel(self):
+        """Called by the consumer when it stops reading, so the producer does not block forever."""
+        self._cancelled = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, BaseException):
+                raise item
+            self._pending = memoryview(item)
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
@@ -0,0 +1,56 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class ImagePrefetcher:
+    """
+    Downloads and verifies upcoming OS images on a background thread.
+
+    While one OS is being flashed, booted and tested, the next entry of the
+    board's os_list is already being fetched, so the network and the DUT are
+    busy at the same time instead of taking turns.
+    """
+
+    def __init__(self, os_manager):
+        self.os_manager = os_manager
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-prefetch")
+        self._futures = {}
+        self._cancel = threading.Event()  # stops the download in flight on shutdown
+
+    def prefetch(self, os_name, url, sha256=None):
+        """Start fetching an image in the background (no-op if already scheduled)."""
+        if os_name not in self._futures:
+            self._futures[os_name] = self.executor.submit(self._fetch, os_name, url, sha256)
+
+    def scheduled(self, os_name):
+        """True if the image is being (or has been) fetched in the background."""
+        return os_name in self._futures
+
+    def _fetch(self, os_name, url, sha256):
+        started = time.monotonic()
+        image_path = self.os_manager.download_image(os_name, url, sha256, pin=True, cancel=self._cancel)
+        return image_path, time.monotonic() - started
+
+    def get(self, os_name, url, sha256=None):
+        """
+        Return the image path, waiting for a running prefetch if needed.
+
+        The image stays pinned in the image cache until the caller is done
+        with it and calls os_manager.release_image(image_path).
+
+        Returns:
+            tuple: (image_path, timings) where timings holds the background
+            `prefetch` time and the foreground `download` (waiting) time.
+        """
+        self.prefetch(os_name, url, sha256)
+        started = time.monotonic()
+        image_path, fetch_time = self._futures.pop(os_name).result()
+        return image_path, {"prefetch": fetch_time, "download": time.monotonic() - started}
+
+    def shutdown(self):
+        """Drop the downloads not yet started and stop the one in flight; its partial file is kept for resuming."""
+        self._cancel.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for future in self._futures.values():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.os_manager.release_image(future.result()[0])  # prefetched but never used
@@ -0,0 +1,196 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_DB_PATH = os.environ.get("BOARDTEST_JOB_DB", "./jobs.db")
+
+LEASE_TIME = 60  # seconds a resource lease lasts unless renewed
+
+# created -> queued -> running -> completed | failed | stopped; created/queued -> cancelled
+FINAL_STATES = ("completed", "failed", "stopped", "cancelled")
+
+class JobQueue:
+    """
+    Durable job queue in SQLite with per-resource leases.
+
+    A job names the hardware it needs (board, SD mux, serial port, SD block
+    device, power switch; see farm_scheduler.board_resources). dispatch()
+    starts queued jobs by priority, then age, whenever all their resources are
+    free, so a job waiting for a busy board does not hold up jobs for other
+    boards. Leases live in a table keyed by resource name, so no resource can
+    be granted to two jobs. They expire unless renewed: dispatch() fails a job
+    whose leases expired, recover() requeues running jobs without a live lease
+    and requeue() hands back the jobs of a server that shuts down. Several
+    servers may share one database.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, lease_time=LEASE_TIME):
+        self.path = path
+        self.lease_time = lease_time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                spec TEXT NOT NULL,
+                resources TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                result TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority, id);
+            CREATE TABLE IF NOT EXISTS leases (
+                resource TEXT PRIMARY KEY,
+                job_id INTEGER NOT NULL,
+                expires REAL NOT NULL
+            );
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        """Serialize writers in this process and take SQLite's write lock up front for other processes."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["spec"] = json.loads(job["spec"])
+        job["resources"] = json.loads(job["resources"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(self, spec, resources, priority=0, state="queued"):
+        """
+        Add a job and return its id.
+
+        Args:
+            spec (dict): What to run, stored as JSON.
+            resources (list): Names of the resources the job needs exclusively.
+            priority (int): Higher runs first.
+            state (str): "queued", or "created" to enqueue later with enqueue().
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (spec, resources, priority, state, created) VALUES (?, ?, ?, ?, ?)",
+                (json.dumps(spec), json.dumps(sorted(set(resources))), priority, state, time.time()))
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        with self._lock:
+            return self._job(self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list(self, states=None):
+        """Return jobs in dispatch order, optionally only those in `states`."""
+        query = "SELECT * FROM jobs"
+        params = ()
+        if states:
+            query += f" WHERE state IN ({', '.join('?' * len(states))})"
+            params = tuple(states)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY priority DESC, id", params).fetchall()
+        return [self._job(row) for row in rows]
+
+    def enqueue(self, job_id):
+        """Move a created job into the queue; returns False if it is not in the created state."""
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'queued' WHERE id = ? AND state = 'created'", (job_id,)).rowcount == 1
+
+    def reprioritize(self, job_id, priority):
+        """Change the priority of a job that has not started; returns False otherwise."""
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET priority = ? WHERE id = ? AND state IN ('created', 'queued')",
+                              (priority, job_id)).rowcount == 1
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started; returns False otherwise (running jobs are stopped by their runner)."""
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'cancelled', finished = ? WHERE id = ? AND state IN ('created', 'queued')",
+                              (time.time(), job_id)).rowcount == 1
+
+    def dispatch(self, limit=None):
+        """
+        Lease the resources of every queued job that can start now and mark it running.
+
+        Returns:
+            list: The jobs started, in priority order.
+        """
+        now = time.time()
+        started = []
+        with self._transaction() as db:
+            # An expired lease means the runner stopped renewing it; its job is lost
+            db.execute("UPDATE jobs SET state = 'failed', finished = ?, error = 'lease expired' WHERE state = 'running' "
+                       "AND id IN (SELECT job_id FROM leases WHERE expires < ?)", (now, now))
+            db.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            busy = {row["resource"] for row in db.execute("SELECT resource FROM leases")}
+            for row in db.execute("SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id").fetchall():
+                if limit is not None and len(started) >= limit:
+                    break
+                job = self._job(row)
+                if busy.intersection(job["resources"]):
+                    continue
+                db.executemany("INSERT INTO leases (resource, job_id, expires) VALUES (?, ?, ?)",
+                               [(resource, job["id"], now + self.lease_time) for resource in job["resources"]])
+                db.execute("UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (now, job["id"]))
+                busy.update(job["resources"])
+                job.update(state="running", started=now)
+                started.append(job)
+        return started
+
+    def renew(self, job_ids):
+        """Extend the leases of running jobs."""
+        with self._transaction() as db:
+            db.executemany("UPDATE leases SET expires = ? WHERE job_id = ?",
+                           [(time.time() + self.lease_time, job_id) for job_id in job_ids])
+
+    def finish(self, job_id, state, result=None, error=None):
+        """Record the outcome (state and the job's structured result) of a running job and release its resources."""
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET state = ?, finished = ?, result = ?, error = ? WHERE id = ?",
+                       (state, time.time(), None if result is None else json.dumps(result, default=str), error, job_id))
+            db.execute("DELETE FROM leases WHERE job_id = ?", (job_id,))
+
+    def requeue(self, job_ids):
+        """Put running jobs back in the queue and release their resources, e.g. when their server shuts down."""
+        with self._transaction() as db:
+            for job_id in job_ids:
+                db.execute("UPDATE jobs SET state = 'queued', started = NULL, error = 'requeued after server shutdown' "
+                           "WHERE id = ? AND state = 'running'", (job_id,))
+                db.execute("DELETE FROM leases WHERE job_id = ?", (job_id,))
+
+    def recover(self):
+        """
+        Requeue running jobs that hold no live lease, e.g. those of a server
+        that died before dispatch() noticed; returns their ids.
+
+        Jobs whose leases are still being renewed belong to another server on
+        the same database and are left alone.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            ids = [row["id"] for row in db.execute(
+                "SELECT id FROM jobs WHERE state = 'running' AND id NOT IN (SELECT job_id FROM leases WHERE expires >= ?)", (now,))]
+            db.executemany("UPDATE jobs SET state = 'queued', started = NULL, error = 'requeued after server restart' WHERE id = ?",
+                           [(job_id,) for job_id in ids])
+            db.executemany("DELETE FROM leases WHERE job_id = ?", [(job_id,) for job_id in ids])
+        return ids
+
+    def close(self):
+        self._db.close()
@@ -1,7 +1,9 @@
 import argparse
 from main_controller import MainController
+from image_prefetcher import ImagePrefetcher
 
-def parse_args():
+def parse_args(argv=None):
+    """Parse a main.py command line, sys.argv unless `argv` (a list) is given."""
     parser = argparse.ArgumentParser(
         description="Main entry point for running test suites on different OS images for a specific board."
     )
@@ -31,8 +33,8 @@ def parse_args():
         help="Disable logging output to stdout."
     )
     parser.add_argument(
-        "-b", "--board-config", type=str, default="./boards/banana_pi_f3_config.toml",
-        help="Path to the board configuration file."
+        "-b", "--board-config", type=str, nargs="+", default=["./boards/banana_pi_f3_config.toml"],
+        help="Path to the board configuration file. Several files run as a farm, one board per file concurrently."
     )
     parser.add_argument(
         "-S", "--serial", type=str, default="sdwirec_alpha",
@@ -46,12 +48,32 @@ def parse_args():
         "-M", "--mi-sdk-enabled", action="store_true", default=False,
         help="Enable Mi SDK controller for power control. (default: disabled)"
     )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Maximum number of boards tested at the same time in farm mode. (default: all boards)"
+    )
     
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
-if __name__ == "__main__":
-    args = parse_args()
+def run_farm(args):
+    """Run the OS lists of several boards concurrently; each board uses the SD mux serial from its own config."""
+    from farm_scheduler import FarmScheduler
     
+    scheduler = FarmScheduler(args.board_config, args.jobs)
+    print(f"""
+          Boards: {', '.join(args.board_config)}
+          Jobs: {len(scheduler.jobs)} (max {scheduler.max_workers} boards at a time)
+          Flashing: {args.flash}
+          Testing: {args.test}
+          Stdout log: {args.stdout_log}
+          Mi SDK enabled: {args.mi_sdk_enabled}
+          """)
+    jobs = scheduler.run(args.flash, args.test, args.stdout_log, args.mi_sdk_enabled)
+    print(scheduler.summary())
+    return jobs
+
+def run_board(args):
+    """Run the OS list of one board; returns the test results of every OS (None where nothing was tested)."""
     controller = MainController(args.board_config)
     
     print(f"""
@@ -63,14 +85,75 @@ if __name__ == "__main__":
           Mi SDK enabled: {args.mi_sdk_enabled}
           """)
 
+    outcome = {}
+    prefetcher = ImagePrefetcher(controller.os_manager) if args.flash else None
     for os_name in controller.board_config['os_list']:
         print("="*50)
         print(f"Running test suite for OS: {os_name}...")
         print("="*50)
-        results = controller.run_test_suite(os_name, args.serial, args.flash, args.test, args.stdout_log, args.yes, args.mi_sdk_enabled)
+        results = controller.run_test_suite(os_name, args.serial, args.flash, args.test, args.stdout_log, args.yes, args.mi_sdk_enabled, prefetcher)
         print("\n")
         if results is not None:
             controller.generate_report(results)
         else:
             print("No test results need to generate report.")
         print("\n")
+        outcome[os_name] = results
+    if prefetcher:
+        prefetcher.shutdown()
+    return outcome
+
+def job_params(params):
+    """
+    Return the main.py options of a job given as structured parameters.
+
+    `params` maps long option names to values, e.g. {"board_config":
+    ["./boards/visionfive_config.toml"], "flash": True}; options not given keep
+    their defaults, except that a job answers yes to all prompts since nobody
+    can answer them.
+
+    Raises:
+        Exception: If a parameter is not an option of main.py.
+    """
+    args = parse_args([])
+    args.yes = True
+    unknown = set(params) - set(vars(args))
+    if unknown:
+        raise Exception(f"Unknown job parameters: {', '.join(sorted(unknown))}")
+    vars(args).update(params)
+    if isinstance(args.board_config, str):
+        args.board_config = [args.board_config]
+    return args
+
+def run_job(params):
+    """
+    Run a job from structured parameters (see job_params) in a server worker.
+
+    Returns:
+        dict: success, plus the results of every OS of a single board
+            (results) or the outcome of every farm job (jobs).
+    """
+    args = job_params(params)
+    if len(args.board_config) > 1:
+        jobs = run_farm(args)
+        return {
+            "success": all(job.status == "completed" for job in jobs),
+            "jobs": [{"board": job.board_name, "os": job.os_name, "status": job.status, "error": job.error,
+                      "results": job.results, "report": job.report_path} for job in jobs]
+        }
+    args.board_config = args.board_config[0]
+    outcome = run_board(args)
+    return {
+        "success": all(result['success'] for results in outcome.values() if results for result in results),
+        "results": outcome
+    }
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    if len(args.board_config) > 1:
+        run_farm(args)
+        raise SystemExit(0)
+    
+    args.board_config = args.board_config[0]
+    run_board(args)
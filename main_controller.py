@@ -4,49 +4,105 @@ import toml
 from sd_mux_controller import SDMuxController
 from test_framework import TestFramework
 from os_image_manager import OSImageManager
+from image_cache import ImageCache, DEFAULT_CACHE_DIR
+from chunk_store import ChunkStore, DEFAULT_STORE_DIR
 from test_manager import TestManager
+from boot_timeline import BootTimelineStore, format_timeline
 from texttable import Texttable
 from rich.console import Console
 from rich.prompt import Confirm
 
+try:
+    from mi_sdk_controller import MiSdkController
+except ImportError:  # python-miio is optional
+    MiSdkController = None
+
 class MainController:
-    def __init__(self, board_config):
-        """Initialize the main controller with the given board configuration."""
+    def __init__(self, board_config, hub=None):
+        """Initialize the main controller with the given board configuration and optional shared SerialHub."""
         self.board_config = toml.load(board_config)
+        self.hub = hub
         self.sd_mux = SDMuxController()
         self.sd_mux_device = self.board_config['serial']['sd_mux_device']
         self.board_name = self.board_config['board']['board_name']
-        self.os_manager = OSImageManager(self.board_name, self.board_config['os_list'], self.board_config['serial']['serial_name'])
-        self.mi_sdk_controller = None if 'mi_sdk' not in self.board_config 
+        cache_config = self.board_config.get('image_cache', {})
+        max_size_gb = cache_config.get('max_size_gb')
+        image_cache = ImageCache(cache_config.get('path', DEFAULT_CACHE_DIR), int(max_size_gb * 2**30) if max_size_gb else None)
+        chunk_store = ChunkStore(self.board_config.get('chunk_store', {}).get('path', DEFAULT_STORE_DIR))
+        self.os_manager = OSImageManager(self.board_name, self.board_config['os_list'], self.board_config['serial']['serial_name'], image_cache, chunk_store)
+        self.mi_sdk_controller = None if 'mi_sdk' not in self.board_config or MiSdkController is None \
             else MiSdkController(self.board_config['mi_sdk']['token'], self.board_config['mi_sdk']['ip_address'], self.board_config['mi_sdk']['device_id'])
         self.console = Console()
     
-    def run_test_suite(self, os_name, serial, flash=True, test=True, stdout_log=True, prompt_always_yes=False, mi_sdk_enabled=False):
-        """Run the test suite for the specified OS name and serial number."""
+    def run_test_suite(self, os_name, serial, flash=True, test=True, stdout_log=True, prompt_always_yes=False, mi_sdk_enabled=False, prefetcher=None):
+        """
+        Run the test suite for the specified OS name and serial number.
+
+        With an ImagePrefetcher the image is taken from the background download and
+        the next OS in os_list starts downloading while this one is flashed and tested.
+        """
         os_info = self.board_config['os_list'][os_name]
         url = os_info['url']
         dd_params = os_info.get('dd_params', [])
+        self.stage_times = {}
+        self.boot_record = self.previous_boot = None
+        power_on = None
         
         if flash:
             self.console.print(f"\n[bold cyan]Preparing to flash OS {os_name}...[/bold cyan]")
-            if not Confirm.ask("Do you want to continue with flashing the OS image? [y/N]", default=False):
+            if not prompt_always_yes and not Confirm.ask("Do you want to continue with flashing the OS image? [y/N]", default=False):
                 self.console.print("[bold red]Flashing aborted by user.[/bold red]")
                 return
             
             if mi_sdk_enabled and self.mi_sdk_controller != None:
-                self.console.print(f"[bold yellow]Detected Mi SDK config for {board_name}, powering device off...[/bold yellow]")
-                self.mi_sdk_controller.turn_off()
-            
-            image_path = self.os_manager.download_image(os_name, url)
-            device = self.sd_mux_device if self.sd_mux_device else self.os_manager.detect_device()
+                self.console.print(f"[bold yellow]Detected Mi SDK config for {self.board_name}, powering device off...[/bold yellow]")
+                self._report_power(self.mi_sdk_controller.turn_off())
             
-            self.console.print(f"[bold yellow]Connecting SD card to test server for OS {os_name} flashing...[/bold yellow]")
-            self.sd_mux.connect_to_ts(serial)
-            self.os_manager.flash_image(os_name, device, dd_params, image_path)
+            flash_method = os_info.get('flash_method', 'bmap')
+            chunk_index = os_info.get('chunk_index')
+            # An image that is not local and not already being prefetched is
+            # downloaded, decompressed and flashed in one pass
+            stream = flash_method == 'bmap' and not os.path.exists(url) and not (prefetcher and prefetcher.scheduled(os_name))
+            image_path = None
+            if chunk_index:
+                # Nightlies published as a chunk index: only the chunks new since earlier builds are downloaded
+                started = time.monotonic()
+                chunked_name = self.os_manager.fetch_chunked_image(os_name, chunk_index)
+                self.stage_times['download'] = time.monotonic() - started
+            elif stream:
+                if prefetcher:
+                    self._prefetch_next(os_name, prefetcher)
+            elif prefetcher:
+                image_path, timings = prefetcher.get(os_name, url, os_info.get('sha256'))
+                self.stage_times.update(timings)
+                self._prefetch_next(os_name, prefetcher)
+            else:
+                started = time.monotonic()
+                image_path = self.os_manager.download_image(os_name, url, os_info.get('sha256'), pin=True)
+                self.stage_times['download'] = time.monotonic() - started
+            try:
+                device = self.sd_mux_device if self.sd_mux_device else self.os_manager.detect_device()
+                
+                started = time.monotonic()
+                self.console.print(f"[bold yellow]Connecting SD card to test server for OS {os_name} flashing...[/bold yellow]")
+                self._check_mux(self.sd_mux.connect_to_ts(serial))
+                delta = os_info.get('delta_verify', 'full') if os_info.get('delta_flash', True) else None
+                verify = os_info.get('verify', True)
+                if chunk_index:
+                    self.os_manager.flash_chunked_image(os_name, device, chunked_name, confirm=not prompt_always_yes, delta=delta, verify=verify)
+                elif stream:
+                    self.os_manager.stream_flash_image(os_name, device, url, os_info.get('sha256'), confirm=not prompt_always_yes, delta=delta, verify=verify)
+                else:
+                    self.os_manager.flash_image(os_name, device, dd_params, image_path, confirm=not prompt_always_yes, method=flash_method, delta=delta, verify=verify)
+            finally:
+                if image_path:
+                    self.os_manager.release_image(image_path)  # the image cache may evict it again
             
             self.console.print(f"[bold yellow]Connecting SD card to device under test for OS {os_name}...[/bold yellow]")
-            self.sd_mux.connect_to_dut(serial)
-            self.sd_mux.power_cycle_dut(serial)
+            self._check_mux(self.sd_mux.connect_to_dut(serial))
+            if self.sd_mux.power_cycle_dut(serial)['success']:  # not every mux can, a failure is only reported
+                power_on = time.monotonic()
+            self.stage_times['flash'] = time.monotonic() - started
         
         if test:
             self.console.print(f"\n[bold cyan]Preparing to start test framework for OS {os_name}...[/bold cyan]")
@@ -56,8 +112,10 @@ class MainController:
             
             self.console.print("Starting test framework...")
             if mi_sdk_enabled and self.mi_sdk_controller != None:
-                self.console.print(f"[bold yellow]Detected Mi SDK config for {board_name}, powering device on...[/bold yellow]")
-                self.mi_sdk_controller.turn_on()
+                self.console.print(f"[bold yellow]Detected Mi SDK config for {self.board_name}, powering device on...[/bold yellow]")
+                result = self.mi_sdk_controller.turn_on()
+                self._report_power(result)
+                power_on = result['switched_at']  # the boot timeline starts when the switch took the command
             
             # 获取OS相关的自动登录、默认用户名密码、login password shell prompt
             auto_login = os_info.get('auto_login', True)
@@ -66,6 +124,9 @@ class MainController:
             login_prompts = os_info.get('login_prompts', ["login:", "用户名：", "Username:", "用户名:"])
             password_prompts = os_info.get('password_prompts', ["Password:", "密码：", "秘密："])
             shell_prompt = os_info.get('shell_prompt', 'root@k1:~#')
+            framing = os_info.get('framing', False)
+            boot_timeouts = self._inline_table(os_info.get('boot_timeouts', {}))
+            watchdog = self._inline_table(os_info.get('watchdog', {}))
             
             self.framework = TestFramework(
                 f"""
@@ -81,21 +142,142 @@ class MainController:
                 login_prompts = {login_prompts}
                 password_prompts = {password_prompts}
                 shell_prompt = "{shell_prompt}"
-                """
+                framing = {str(framing).lower()}
+                boot_timeouts = {boot_timeouts}
+                watchdog = {watchdog}
+                """,
+                self.hub
             )
             
-            self.framework.start()
-            
             test_config = os_info.get('test_config', './tests/default.toml')
-            test_manager = TestManager(test_config)
-            results = test_manager.execute_tests(self.framework)
-            
-            self.console.print("Stopping test framework...")
-            self.framework.stop()
+            run = int(time.time())
+            output_dir = os.path.join(self.board_config['test_framework']['log_dir'], 'outputs',
+                                      f"{self.board_name}_{os_name}_{run}")
+            try:
+                started = time.monotonic()
+                boot_failure = self._boot(os_name, serial, run, power_on, os_info.get('boot_retries', 2), mi_sdk_enabled)
+                self.stage_times['boot'] = time.monotonic() - started
+                if boot_failure:
+                    return [boot_failure]
+                
+                test_manager = TestManager(test_config, output_dir)
+                started = time.monotonic()
+                results = test_manager.execute_tests(self.framework)
+                self.stage_times['test'] = time.monotonic() - started
+            finally:
+                # Release the serial port even if boot or the tests failed, the next job needs it
+                self.console.print("Stopping test framework...")
+                self.framework.stop()
             
             return results
     
-    def generate_report(self, results):
+    def _boot(self, os_name, serial, run, power_on, retries, mi_sdk_enabled):
+        """
+        Start the test framework and wait for the DUT's shell, power cycling it
+        after a failed boot (panic, boot loop, hang, ...) up to `retries` times.
+        
+        Returns:
+            dict: None once the DUT is up, else a failed result with the
+            watchdog's verdict and the last console output.
+        """
+        failure = None
+        for attempt in range(retries + 1):
+            try:
+                if attempt == 0:
+                    self.framework.start(power_on)
+                else:
+                    self.console.print(f"[bold yellow]{self.board_name}: power cycling the DUT, boot attempt {attempt + 1}/{retries + 1}...[/bold yellow]")
+                    self.framework.reboot(lambda: self._power_cycle(serial, mi_sdk_enabled))
+                return None
+            except Exception as e:
+                if self.framework.boot_result is None:
+                    if failure is None:
+                        raise  # not a boot failure, e.g. the serial port is gone
+                    self.console.print(f"[bold red]{self.board_name}: {e}, giving up[/bold red]")
+                    break
+                failure = self.framework.boot_result
+                self.console.print(f"[bold red]{self.board_name}: {e}[/bold red]")
+            finally:
+                self._record_boot(os_name, run)
+        
+        context = "\n".join(failure['context'].splitlines()[-20:])
+        return {
+            "command": "boot",
+            "output": context,
+            "expected_output": self.framework.driver.shell_prompt,
+            "method": "boot",
+            "success": False,
+            "reason": f"{failure['error']} (stage {failure['stage']}, {failure['failure']}) after {attempt + 1} boot attempts",
+            "return_code": None,
+            "exit_code": None,
+            "output_file": None,
+            "boot": failure,
+        }
+    
+    def _power_cycle(self, serial, mi_sdk_enabled):
+        """
+        Power cycle the DUT with the Mi smart switch when enabled, else through the SD mux.
+        
+        Returns:
+            float: Monotonic time power came back, None if the DUT could not be power cycled.
+        """
+        if mi_sdk_enabled and self.mi_sdk_controller is not None:
+            result = self.mi_sdk_controller.power_cycle()
+            self._report_power(result)
+            return result['switched_at'] if result['success'] else None
+        if self.sd_mux.power_cycle_dut(serial)['success']:
+            return time.monotonic()
+        return None
+    
+    def _report_power(self, result):
+        """Report a smart switch that did not confirm the requested state; the boot watchdog notices a DUT left unpowered."""
+        if not result['success']:
+            self.console.print(f"[bold red]{self.board_name}: turning power {result['state']} failed: {result['error']}[/bold red]")
+    
+    @staticmethod
+    def _inline_table(values):
+        """Render a flat dict as a TOML inline table for the framework config."""
+        return "{ " + ", ".join(f"{key} = {value}" for key, value in values.items()) + " }"
+    
+    def _record_boot(self, os_name, run):
+        """Store the boot timeline of this run, stalled boots included, next to the earlier ones."""
+        if self.framework.boot_result is None:
+            return
+        store = BootTimelineStore(os.path.join(self.board_config['test_framework']['log_dir'], 'boot_timelines.jsonl'))
+        self.previous_boot = store.previous(self.board_name, os_name, run)
+        self.boot_record = store.record(self.board_name, os_name, run, self.framework.boot_result)
+    
+    def _check_mux(self, result):
+        """Stop the run if the SD card could not be switched, rather than flashing or booting the wrong card."""
+        if not result['success']:
+            raise Exception(f"SD mux {result['serial']}: switching to {result['operation']} failed: {result['error']}")
+    
+    def _prefetch_next(self, os_name, prefetcher):
+        """Start downloading the OS that follows `os_name` in os_list."""
+        os_names = list(self.board_config['os_list'])
+        index = os_names.index(os_name)
+        if index + 1 < len(os_names):
+            next_info = self.board_config['os_list'][os_names[index + 1]]
+            prefetcher.prefetch(os_names[index + 1], next_info['url'], next_info.get('sha256'))
+    
+    def format_stage_times(self):
+        """Return the per-stage timings of the last run as report text."""
+        stage_times = getattr(self, 'stage_times', {})
+        if not stage_times:
+            return ""
+        table = Texttable()
+        table.set_deco(Texttable.HEADER)
+        table.add_rows([["Stage", "Time (s)"]])
+        for stage in ("prefetch", "download", "flash", "boot", "test"):
+            if stage in stage_times:
+                table.add_row([stage, f"{stage_times[stage]:.1f}"])
+        text = table.draw()
+        if 'prefetch' in stage_times:
+            saved = stage_times['prefetch'] - stage_times['download']
+            text += f"\nSaved by prefetching the image in the background: {saved:.1f}s"
+        return text
+    
+    def generate_report(self, results, report_path="report.txt"):
         """Generate a report based on the test results."""
         table = Texttable()
         table.set_deco(Texttable.HEADER)
@@ -116,9 +298,14 @@ class MainController:
             ])
         
         report_content = table.draw()
+        stage_times = self.format_stage_times()
+        if stage_times:
+            report_content += f"\n\n{stage_times}"
+        if getattr(self, 'boot_record', None):
+            report_content += f"\n\n{format_timeline(self.boot_record, self.previous_boot)}"
         report_content += f"\n\nGenerated on: {time.strftime('%Y-%m-%d %H:%M:%S')}"
         
-        with open("report.txt", "w") as f:
+        with open(report_path, "w") as f:
             f.write(report_content)
         
-        self.console.print("[bold green]Test report generated: report.txt[/bold green]")
+        self.console.print(f"[bold green]Test report generated: {report_path}[/bold green]")
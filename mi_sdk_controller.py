@@ -1,8 +1,148 @@
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from miio import Device, DeviceException
 
+CONFIRM_TIMEOUT = 3.0  # seconds to wait for get_prop power to report the new state
+POLL_INTERVAL = 0.1
+SEND_TIMEOUT = 2  # seconds per miio request
+POWER_OFF_TIME = 3  # seconds the DUT stays unpowered in power_cycle()
+
+def power_result(device_id, state, started, switched_at=None, error=None):
+    """
+    Outcome of one power operation: success, device_id, state (requested),
+    error (None on success), switched_at (monotonic time the switch
+    acknowledged the command) and duration in seconds.
+    """
+    return {
+        "success": error is None,
+        "device_id": device_id,
+        "state": state,
+        "error": error,
+        "switched_at": switched_at,
+        "duration": time.monotonic() - started,
+    }
+
+class FakeMiDevice:
+    """Stand-in for a miio.Device: a relay that follows set_power after `delay` seconds, or never if `stuck`."""
+
+    def __init__(self, delay=0.05, stuck=False, power="off"):
+        self.delay = delay
+        self.stuck = stuck
+        self.power = power
+        self.commands = []
+        self._switch_at = None
+        self._target = power
+
+    def send(self, command, parameters=None):
+        self.commands.append((command, parameters))
+        now = time.monotonic()
+        if self._switch_at is not None and now >= self._switch_at:
+            self.power, self._switch_at = self._target, None
+        if command == "set_power":
+            if not self.stuck:
+                self._target, self._switch_at = parameters[0], now + self.delay
+            return ["ok"]
+        if command == "get_prop":
+            return [self.power]
+        raise DeviceException(f"Unsupported command {command}")
+
+class AsyncMiSdkController:
+    """
+    asyncio power control of one Xiaomi smart switch.
+
+    The miio device object, and with it the handshake and session of the
+    switch, is kept for the life of the controller. Requests to one switch are
+    serialized, while different switches are driven concurrently (see
+    set_power_many). A power change is only reported successful once get_prop
+    power confirms it.
+    """
+
+    def __init__(self, token, ip_address, device_id, device=None, confirm_timeout=CONFIRM_TIMEOUT, poll_interval=POLL_INTERVAL):
+        self.device_id = device_id
+        self.device = device or Device(ip_address, token, timeout=SEND_TIMEOUT)
+        self.confirm_timeout = confirm_timeout
+        self.poll_interval = poll_interval
+        self._lock = asyncio.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    async def _send(self, command, parameters):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.device.send, command, parameters)
+
+    async def power_state(self):
+        """Return "on" or "off" as reported by the switch."""
+        return (await self._send("get_prop", ["power"]))[0]
+
+    async def set_power(self, state):
+        """Switch to `state` ("on" or "off") and poll until the switch confirms it; returns a power_result()."""
+        started = time.monotonic()
+        async with self._lock:
+            try:
+                await self._send("set_power", [state])
+                switched_at = time.monotonic()
+                deadline = switched_at + self.confirm_timeout
+                while True:
+                    current = await self.power_state()
+                    if current == state:
+                        self.logger.info(f"Device {self.device_id} is {state}")
+                        return power_result(self.device_id, state, started, switched_at)
+                    if time.monotonic() >= deadline:
+                        error = f"still {current} {self.confirm_timeout}s after set_power {state}"
+                        break
+                    await asyncio.sleep(self.poll_interval)
+            except DeviceException as e:
+                error = str(e)
+        self.logger.error(f"Failed to turn {state} device {self.device_id}: {error}")
+        return power_result(self.device_id, state, started, error=error)
+
+    async def turn_on(self):
+        return await self.set_power("on")
+
+    async def turn_off(self):
+        return await self.set_power("off")
+
+    async def power_cycle(self, off_time=POWER_OFF_TIME):
+        """Turn off, wait `off_time` seconds and turn on; returns the power_result() of the failing or the final step."""
+        result = await self.turn_off()
+        if not result['success']:
+            return result
+        await asyncio.sleep(off_time)
+        return await self.turn_on()
+
+async def set_power_many(controllers, state):
+    """Switch several AsyncMiSdkControllers at once; returns device_id -> power_result()."""
+    results = await asyncio.gather(*(controller.set_power(state) for controller in controllers))
+    return {result['device_id']: result for result in results}
+
+_loop = None
+_loop_lock = threading.Lock()
+_controllers = {}
+
+def power_loop():
+    """Return the process-wide event loop all switches are driven from, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(64, thread_name_prefix="mi-sdk"))  # one blocking miio request per switch of a rack
+            threading.Thread(target=_loop.run_forever, name="mi-sdk", daemon=True).start()
+        return _loop
+
+def shared_controller(token, ip_address, device_id, device=None):
+    """Return the AsyncMiSdkController of a switch, shared by every board it powers."""
+    with _loop_lock:
+        key = (ip_address, device_id)
+        if key not in _controllers:
+            _controllers[key] = AsyncMiSdkController(token, ip_address, device_id, device)
+        return _controllers[key]
+
 class MiSdkController:
-    def __init__(self, token, ip_address, device_id):
+    """Blocking front end of AsyncMiSdkController for the (threaded) main controller and farm."""
+
+    def __init__(self, token, ip_address, device_id, device=None):
         """
         Initialize MiSdkController class.
 
@@ -10,63 +150,62 @@ class MiSdkController:
             token (str): Xiaomi account token.
             ip_address (str): Device IP address.
             device_id (str): Device ID.
+            device: A miio.Device or FakeMiDevice to use instead of connecting to `ip_address`.
         """
         self.token = token
         self.ip_address = ip_address
         self.device_id = device_id
-        self.device = Device(ip_address, token)
+        self.controller = shared_controller(token, ip_address, device_id, device)
         self.logger = logging.getLogger(__name__)
         self.logger.info(f"Initialized MiSdkController for device {device_id} at {ip_address}")
 
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, power_loop()).result()
+
     def turn_on(self):
         """
         Turn on the smart switch.
 
         Returns:
-            bool: Whether the operation was successful.
+            dict: power_result(); switched_at is when the DUT got power.
         """
-        try:
-            self.device.send("set_power", ["on"])
-            self.logger.info(f"Turned on device {self.device_id}")
-            return True
-        except DeviceException as e:
-            self.logger.error(f"Failed to turn on device {self.device_id}: {e}")
-            return False
+        return self._run(self.controller.turn_on())
 
     def turn_off(self):
         """
         Turn off the smart switch.
 
         Returns:
-            bool: Whether the operation was successful.
+            dict: power_result().
         """
-        try:
-            self.device.send("set_power", ["off"])
-            self.logger.info(f"Turned off device {self.device_id}")
-            return True
-        except DeviceException as e:
-            self.logger.error(f"Failed to turn off device {self.device_id}: {e}")
-            return False
+        return self._run(self.controller.turn_off())
+
+    def power_cycle(self, off_time=POWER_OFF_TIME):
+        """Turn the smart switch off and on again; returns a power_result()."""
+        return self._run(self.controller.power_cycle(off_time))
 
     def get_status(self):
         """
-        Get the status of the smart switch.
+        Get the power state of the smart switch.
 
         Returns:
-            dict: Device status information.
+            str: "on" or "off", None if the switch did not answer.
         """
         try:
-            status = self.device.send("get_prop", ["power"])
-            self.logger.info(f"Retrieved status for device {self.device_id}: {status}")
-            return status
+            return self._run(self.controller.power_state())
         except DeviceException as e:
             self.logger.error(f"Failed to get status for device {self.device_id}: {e}")
             return None
 
+def power_many(controllers, state):
+    """Switch several MiSdkControllers, e.g. a whole rack, concurrently; returns device_id -> power_result()."""
+    coroutine = set_power_many([controller.controller for controller in controllers], state)
+    return asyncio.run_coroutine_threadsafe(coroutine, power_loop()).result()
+
 # if __name__ == "__main__":
 #     logging.basicConfig(level=logging.INFO)
 #     controller = MiSdkController(token="your_token", ip_address="192.168.1.100", device_id="your_device_id")
 #     controller.turn_on()
 #     status = controller.get_status()
 #     print(f"Device status: {status}")
-#     controller.turn_off()
\ No newline at end of file
+#     controller.turn_off()
@@ -1,86 +1,243 @@
-import requests
 import subprocess
+import hashlib
+import io
 import os
-import re
-import time
+import shutil
+import threading
 from sd_mux_controller import SDMuxController
+from image_cache import ImageCache, DownloadPipe
+from block_flasher import BlockFlasher, FanOutFlasher, is_compressed, open_decompressed
+from card_manifest import CardManifest, DeltaFilter
+from chunk_store import ChunkStore
+from device_discovery import default_discovery
 
 class OSImageManager:
-    def __init__(self, board_name, os_list, serial):
-        """Initialize the OS image manager with the given OS list and serial number."""
+    def __init__(self, board_name, os_list, serial, image_cache=None, chunk_store=None):
+        """Initialize the OS image manager with the given OS list, serial number and optional shared ImageCache and ChunkStore."""
         self.board_name = board_name
         self.os_list = os_list
         self.sd_mux = SDMuxController()
         self.serial = serial
+        self.image_cache = image_cache or ImageCache()
+        self.chunk_store = chunk_store
+        self.topology_only_detection = False
     
-    def download_image(self, os_name, url):
-        """Download the OS image from the specified URL if not already downloaded."""
-        image_path = f"./images/{self.board_name}_{os_name}.img"
+    def download_image(self, os_name, url, sha256=None, tee=None, pin=False, cancel=None):
+        """
+        Return a local path of the OS image, downloading it into the image cache if needed.
 
+        Local paths are used as they are. URLs are streamed into the shared
+        content-addressed cache, resumed after network drops and revalidated
+        against the server, so a new upstream release is picked up. Compressed
+        images (.xz, .gz, .zst, .bz2) are cached compressed. With `pin` a cached
+        image is not evicted before release_image() is called; setting the
+        `cancel` event stops a running download.
+        """
         if os.path.exists(url):
-            image_path = url
+            return self.verify_image(url, sha256)
+        return self.image_cache.fetch(url, sha256, tee, pin, cancel)
+
+    def release_image(self, image_path):
+        """Let the image cache evict an image pinned by download_image() again."""
+        if os.path.dirname(os.path.abspath(image_path)) == os.path.abspath(os.path.join(self.image_cache.root, "objects")):
+            self.image_cache.release(image_path)
+
+    def fetch_chunked_image(self, os_name, index_url):
+        """
+        Bring a chunk-indexed image into the chunk store, downloading only the chunks it does not hold yet.
 
-        if not os.path.exists(image_path):
-            response = requests.get(url)
-            with open(image_path, 'wb') as file:
-                file.write(response.content)
+        Returns:
+            str: Name of the image in the store.
+        """
+        if self.chunk_store is None:
+            self.chunk_store = ChunkStore()
+        name, stats = self.chunk_store.fetch(index_url)
+        print(f"{os_name}: fetched {stats['fetched_chunks']} of {stats['chunks']} chunks "
+              f"({stats['fetched_bytes'] >> 20} MiB), the rest was already in the store")
+        return name
+
+    def verify_image(self, image_path, sha256=None):
+        """Check that the image exists, is not empty and, if given, matches its SHA-256 digest."""
+        if not os.path.isfile(image_path) or os.path.getsize(image_path) == 0:
+            raise Exception(f"Image {image_path} is missing or empty")
+        if sha256:
+            digest = hashlib.sha256()
+            with open(image_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(4 << 20), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != sha256.lower():
+                raise Exception(f"Image {image_path} does not match sha256 {sha256}")
         return image_path
 
-    def detect_device(self):
+    def detect_device(self, timeout=10.0):
         """
-        Detect the SD card device by connecting it to the test server and checking for new partitions.
-        (Will not be maintained. Recommend for name your device in config)
+        Return the block device of the SD card behind this board's SD mux (see device_discovery).
+
+        The card is located through the mux's USB topology and kernel uevents,
+        without prompts. With `topology_only_detection` set (farm mode) a mux
+        that cannot be found in sysfs is an error instead of falling back to
+        taking the first disk that appears.
         """
-        self.sd_mux.connect_to_ts(self.serial)
-        time.sleep(5)
-
-        devices_origin = set(os.listdir('/dev'))
-        self.sd_mux.connect_to_dut(self.serial)
-        
-        devices_before = devices_origin
-        while devices_before == devices_origin:
-            print("Waiting...")
-            time.sleep(0.5)
-            devices_before = set(os.listdir('/dev'))
-        
-        devices_before = {device for device in devices_before if "sd" in device}
-        
-        input("Please confirm the SD card is connected and press Enter to continue...")
-
-        devices_origin = set(os.listdir('/dev'))
-        self.sd_mux.connect_to_ts(self.serial)
-
-        devices_after = devices_origin
-        while devices_after == devices_origin:
-            print("Waiting...")
-            time.sleep(0.5)
-            devices_after = set(os.listdir('/dev'))
-
-        devices_after = {device for device in devices_after if "sd" in device}
-        
-        # Find all base sd devices before and after
-        base_devices_before = {device for device in devices_before if re.match(r'sd[a-z]$', device)}
-        base_devices_after = {device for device in devices_after if re.match(r'sd[a-z]$', device)}
-        
-        # Find new partitions that appeared after the SD card was connected
-        new_partitions = {device for device in devices_after if re.match(r'sd[a-z]\d+$', device)}
-        old_partitions = {device for device in devices_before if re.match(r'sd[a-z]\d+$', device)}
-        actual_new_partitions = {partition for partition in new_partitions if partition not in old_partitions}
-        
-        # If there are new partitions, find the base device(s) they belong to
-        if actual_new_partitions:
-            for base_device in base_devices_after:
-                if any(part.startswith(base_device) for part in actual_new_partitions):
-                    return f'/dev/{base_device}'
-        
-        raise Exception("No new SD card device detected")
-    
-    def flash_image(self, os_name, device, dd_params, image_path):
-        """Flash the OS image to the SD card with the specified dd parameters."""
-        dd_command = ['sudo', 'dd', f'if={image_path}', f'of={device}'] + dd_params
-        print(f"Executing command: {' '.join(dd_command)}")
-        input("Press Enter to confirm and continue...")
-        subprocess.run(dd_command)
+        return default_discovery().device_for_mux(self.serial, self.sd_mux, timeout, self.topology_only_detection)
+
+    def _delta_filter(self, flasher, delta, device=None, serial=None):
+        """
+        Return a DeltaFilter over the manifest of the card behind an SD mux (default: this board's).
+
+        The manifest is updated on every block-map flash, `delta` ("full", "sample"
+        or None) only decides whether chunks the card already holds are skipped.
+        """
+        manifest = CardManifest.for_card(os.path.join(self.image_cache.root, "cards"), serial or self.serial, flasher.buffer_size)
+        if not delta:
+            manifest.hashes = {}
+        return DeltaFilter(device or flasher.device, manifest, delta or "full")
+
+    def _print_stats(self, stats):
+        skipped = f", {stats['skipped'] >> 20} MiB already on the card" if stats.get('skipped') else ""
+        print(f"Wrote {stats['written'] >> 20} of {stats['image_size'] >> 20} MiB in {stats['duration']:.1f}s{skipped}")
+        if 'verified' in stats:
+            print(f"Read back and verified {stats['verified'] >> 20} MiB")
+
+    def _check_verified(self, device, stats):
+        """Raise if the read-back found ranges where the card does not hold the image."""
+        mismatches = stats.get('mismatches')
+        if mismatches:
+            ranges = ", ".join(f"{start}-{end - 1}" for start, end in mismatches[:10])
+            more = f" and {len(mismatches) - 10} more" if len(mismatches) > 10 else ""
+            raise Exception(f"{device} does not hold the image at bytes {ranges}{more}")
+
+    def flash_image(self, os_name, device, dd_params, image_path, confirm=True, method="bmap", delta="full", verify=True):
+        """
+        Flash the OS image to the SD card.
+
+        The default "bmap" method writes only the blocks of the image that hold
+        data (see block_flasher) and, unless `delta` is None, skips the chunks
+        the card's manifest and a read-back show to be unchanged (see
+        card_manifest). With `verify` every written range is read back while
+        the next ones are written, and mismatching ranges raise an exception.
+        "dd" runs `sudo dd` with the given dd parameters.
+        """
+        if method == "dd":
+            CardManifest.for_card(os.path.join(self.image_cache.root, "cards"), self.serial, 0).invalidate()
+        if method == "dd" and is_compressed(image_path):
+            dd_command = ['sudo', 'dd', f'of={device}'] + dd_params
+            print(f"Executing command: {' '.join(dd_command)} < decompressed {image_path}")
+            if confirm:
+                input("Press Enter to confirm and continue...")
+            with open(image_path, 'rb') as stream, subprocess.Popen(dd_command, stdin=subprocess.PIPE) as dd:
+                shutil.copyfileobj(open_decompressed(stream), dd.stdin, 4 << 20)
+                dd.stdin.close()
+        elif method == "dd":
+            dd_command = ['sudo', 'dd', f'if={image_path}', f'of={device}'] + dd_params
+            print(f"Executing command: {' '.join(dd_command)}")
+            if confirm:
+                input("Press Enter to confirm and continue...")
+            subprocess.run(dd_command)
+        elif method == "bmap":
+            print(f"Flashing {image_path} to {device} (block map)")
+            if confirm:
+                input("Press Enter to confirm and continue...")
+            flasher = BlockFlasher(device, verify=verify)
+            stats = flasher.flash(image_path, delta=self._delta_filter(flasher, delta))
+            self._print_stats(stats)
+            self._check_verified(device, stats)
+        else:
+            raise Exception(f"Unknown flash method {method}")
+        self._finish_flash(device)
+
+    def flash_image_to_many(self, os_name, targets, image_path, confirm=True, delta="full", verify=True):
+        """
+        Flash one OS image to several SD cards at once.
+
+        The cards are switched to the test server with their SD muxes in one
+        batch, then the image is read once and written to all of them
+        concurrently (see block_flasher.FanOutFlasher). A card that fails does
+        not stop the others.
+
+        Args:
+            targets (dict): SD mux serial -> block device of the card behind it.
+
+        Returns:
+            dict: SD mux serial -> flash statistics, or the exception that card failed with.
+        """
+        print(f"Flashing {image_path} to {', '.join(targets.values())} (block map)")
+        if confirm:
+            input("Press Enter to confirm and continue...")
+        results = {}
+        for serial, switched in self.sd_mux.switch_many({serial: "ts" for serial in targets}).items():
+            if not switched['success']:
+                results[serial] = Exception(f"SD mux {serial} could not be switched to the test server: {switched['error']}")
+        targets = {serial: device for serial, device in targets.items() if serial not in results}
+        flasher = FanOutFlasher(list(targets.values()), verify=verify)
+        deltas = {device: self._delta_filter(flasher, delta, device, serial) for serial, device in targets.items()}
+        by_device = flasher.flash(image_path, deltas=deltas) if targets else {}
+        for serial, device in targets.items():
+            stats = by_device[device]
+            if not isinstance(stats, BaseException):
+                try:
+                    print(f"{device}:", end=" ")
+                    self._print_stats(stats)
+                    self._check_verified(device, stats)
+                    self._finish_flash(device)
+                except Exception as e:
+                    stats = e
+            if isinstance(stats, BaseException):
+                print(f"Flashing {device} (SD mux {serial}) failed: {stats}")
+            results[serial] = stats
+        return results
+
+    def stream_flash_image(self, os_name, device, url, sha256=None, confirm=True, delta="full", verify=True):
+        """
+        Download, decompress and flash an image in one pass.
+
+        The download runs on its own thread and is written to the image cache
+        while its bytes are handed to the block flasher, which decompresses them
+        on its reader thread and writes the data blocks to the device.
+
+        Returns:
+            str: Path of the cached image.
+        """
+        print(f"Streaming {url} to {device} (block map)")
+        if confirm:
+            input("Press Enter to confirm and continue...")
+        pipe = DownloadPipe()
+        result = {}
+
+        def download():
+            try:
+                result['path'] = self.download_image(os_name, url, sha256, tee=pipe, pin=True)
+                pipe.finish(result['path'])
+            except BaseException as e:
+                pipe.fail(e)
+
+        downloader = threading.Thread(target=download, name="image-download", daemon=True)
+        downloader.start()
+        try:
+            flasher = BlockFlasher(device, verify=verify)
+            stats = flasher.flash_stream(io.BufferedReader(pipe, 1 << 20), delta=self._delta_filter(flasher, delta))
+        finally:
+            pipe.cancel()
+            downloader.join()
+            if 'path' in result:
+                self.release_image(result['path'])
+        self._print_stats(stats)
+        self._check_verified(device, stats)
+        self._finish_flash(device)
+        return result['path']
+
+    def flash_chunked_image(self, os_name, device, name, confirm=True, delta="full", verify=True):
+        """Flash an image of the chunk store, rebuilding it from its chunks on the fly."""
+        print(f"Flashing {name} from the chunk store to {device} (block map)")
+        if confirm:
+            input("Press Enter to confirm and continue...")
+        flasher = BlockFlasher(device, verify=verify)
+        with self.chunk_store.open(name) as reader:
+            stats = flasher.flash_stream(io.BufferedReader(reader, 1 << 20), delta=self._delta_filter(flasher, delta))
+        self._print_stats(stats)
+        self._check_verified(device, stats)
+        self._finish_flash(device)
+
+    def _finish_flash(self, device):
         sync_command = ['sync']
         subprocess.run(sync_command)
         eject_command = ['sudo', 'eject', device]
@@ -0,0 +1,178 @@
+import os
+import re
+import tempfile
+from collections import deque
+
+class OutputCapture:
+    """
+    Streaming capture of one command's output.
+
+    Only a bounded head and tail are kept in memory; when a path is given the
+    full output is streamed to that file as it arrives. Without a path, output
+    that outgrows head and tail spills to a temporary file, removed by close().
+    Observers (e.g. the incremental evaluators below) see every piece of output
+    exactly once.
+    """
+
+    def __init__(self, path=None, head_size=4096, tail_size=4096):
+        """
+        Initialize the capture.
+
+        Args:
+            path (str): File receiving the full output, or None for a temporary spill file when needed.
+            head_size (int): Number of leading characters kept in memory.
+            tail_size (int): Number of trailing characters kept in memory.
+        """
+        self.path = path
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.size = 0
+        self.observers = []
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+        self._file = None
+        self.spill_path = path
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._file = open(path, 'w', encoding='utf-8', newline='')
+
+    def write(self, text):
+        """Append a piece of output."""
+        if not text:
+            return
+        if self._file is None and self.size + len(text) > self.head_size + self.tail_size:
+            # Nothing was dropped yet, so head and tail are all the output so far
+            fd, self.spill_path = tempfile.mkstemp(prefix="boardtest_output_", suffix=".log")
+            self._file = open(fd, 'w', encoding='utf-8', newline='')
+            self._file.write("".join(self._head) + "".join(self._tail))
+        self.size += len(text)
+        if self._file:
+            self._file.write(text)
+        for observer in self.observers:
+            observer(text)
+
+        room = self.head_size - self._head_len
+        if room > 0:
+            piece = text[:room]
+            self._head.append(piece)
+            self._head_len += len(piece)
+            text = text[room:]
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            while self._tail_len - len(self._tail[0]) >= self.tail_size:
+                self._tail_len -= len(self._tail.popleft())
+            if self._tail_len > self.tail_size:
+                cut = self._tail_len - self.tail_size
+                self._tail[0] = self._tail[0][cut:]
+                self._tail_len -= cut
+
+    @property
+    def truncated(self):
+        """True if some output is only available in the spill file."""
+        return self.size > self._head_len + self._tail_len
+
+    @property
+    def text(self):
+        """The output, with the middle elided when it exceeds head_size + tail_size."""
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.truncated:
+            return head + tail
+        omitted = self.size - self._head_len - self._tail_len
+        where = f", full output in {self.path}" if self.path else ""
+        return f"{head}\n... [{omitted} characters omitted{where}] ...\n{tail}"
+
+    def read_full(self):
+        """Return the complete output, reading it back from the spill file if needed."""
+        if not self.truncated:
+            return self.text
+        self.flush()
+        with open(self.spill_path, 'r', encoding='utf-8', newline='') as file:
+            return file.read()
+
+    def flush(self):
+        """Make the spill file (spill_path) complete, e.g. before another process reads it."""
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.spill_path and self.spill_path != self.path:
+            os.remove(self.spill_path)
+            self.spill_path = None
+
+class ContainsEvaluator:
+    """
+    Incremental `contains` check; stops scanning once the expected text was seen.
+
+    Only the last len(expected) - 1 characters are carried over between pieces,
+    which is enough to catch a match split across them.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.verdict = None
+        self._carry = ""
+
+    def feed(self, text):
+        if self.verdict is not None:
+            return
+        window = self._carry + text
+        if self.expected in window:
+            self.verdict = True
+        else:
+            self._carry = window[len(window) - len(self.expected) + 1:] if len(self.expected) > 1 else ""
+
+    def finish(self):
+        """Return the final verdict once the command has completed."""
+        return bool(self.verdict)
+
+class RegexEvaluator:
+    """
+    Incremental regular expression check; stops scanning once a match was found.
+
+    New output is searched in slices of at least `batch` characters, each together
+    with the last `overlap` characters before it, so matches spanning pieces are
+    found as long as they are not longer than `overlap`. Serial line endings
+    (CRLF) are normalized to LF so `$` works as expected in MULTILINE mode.
+    """
+
+    def __init__(self, pattern, overlap=4096, batch=65536, flags=re.MULTILINE):
+        self.pattern = re.compile(pattern, flags)
+        self.overlap = overlap
+        self.batch = batch
+        self.verdict = None
+        self.match = None
+        self._carry = ""
+        self._pending = []
+        self._pending_len = 0
+
+    def feed(self, text):
+        if self.verdict is not None:
+            return
+        self._pending.append(text)
+        self._pending_len += len(text)
+        if self._pending_len >= self.batch:
+            self._search()
+
+    def _search(self):
+        window = (self._carry + "".join(self._pending)).replace('\r\n', '\n')
+        self._pending = []
+        self._pending_len = 0
+        match = self.pattern.search(window)
+        if match:
+            self.verdict = True
+            self.match = match.group(0)
+        else:
+            self._carry = window[-self.overlap:]
+
+    def finish(self):
+        """Return the final verdict once the command has completed."""
+        if self.verdict is None and self._pending:
+            self._search()
+        return bool(self.verdict)
@@ -0,0 +1,94 @@
+import asyncio
+from bisect import bisect_right
+
+def utf8_boundary(data):
+    """Return the length of `data` without a trailing, incomplete UTF-8 sequence."""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte < 0x80:
+            return len(data)  # ASCII, nothing pending
+        if byte >= 0xC0:  # lead byte: complete if enough continuation bytes follow
+            needed = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return len(data) if back >= needed else len(data) - back
+    return len(data)
+
+class OutputLog:
+    """
+    Append-only byte log of a job's output, addressed by byte offsets.
+
+    Output is kept in blocks of up to `block_size` bytes, so reading from an
+    offset costs a binary search plus the bytes returned, however long the log
+    gets. Readers on the event loop await wait() instead of polling; every
+    append wakes all of them at once.
+    """
+
+    def __init__(self, block_size=64 << 10):
+        self.block_size = block_size
+        self._blocks = []
+        self._starts = []  # offset of the first byte of every block
+        self.size = 0
+        self.closed = False
+        self._changed = asyncio.Event()
+
+    def append(self, data):
+        """Append a chunk of output (bytes); call from the event loop."""
+        data = memoryview(data)
+        if not data:
+            return
+        while data:
+            if not self._blocks or len(self._blocks[-1]) >= self.block_size:
+                self._starts.append(self.size)
+                self._blocks.append(bytearray())
+            block = self._blocks[-1]
+            piece = data[:self.block_size - len(block)]
+            block += piece
+            self.size += len(piece)
+            data = data[len(piece):]
+        self._notify()
+
+    def close(self):
+        """Mark the end of the output; waiting readers return."""
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def read(self, offset, max_bytes=1 << 20):
+        """
+        Return (bytes, next offset) from `offset` on.
+
+        Unless the log is closed, a UTF-8 sequence cut by the end of the data is
+        left for the next read, so every piece decodes on its own.
+        """
+        offset = max(0, min(offset, self.size))
+        end = min(self.size, offset + max_bytes)
+        pieces = []
+        index = bisect_right(self._starts, offset) - 1
+        position = offset
+        while position < end:
+            block = self._blocks[index]
+            start = position - self._starts[index]
+            piece = block[start:start + end - position]
+            pieces.append(bytes(piece))
+            position += len(piece)
+            index += 1
+        data = b"".join(pieces)
+        if not (self.closed and end == self.size):
+            data = data[:utf8_boundary(data)]
+        return data, offset + len(data)
+
+    async def wait(self, offset, timeout=None):
+        """Wait until there is output past `offset` or the log is closed; returns False on timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while offset >= self.size and not self.closed:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
@@ -0,0 +1,131 @@
+from collections import deque
+from functools import lru_cache
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton compiled once from a set of byte patterns.
+
+    The automaton is turned into a full transition table, so scanning costs one
+    table lookup per byte no matter how many patterns were added. Scanning state
+    lives in PatternScanner objects, so one compiled matcher can serve several
+    independent streams.
+    """
+
+    def __init__(self):
+        self._patterns = []  # (pattern bytes, key, callback)
+        self._delta = None
+        self._outputs = None
+
+    def add(self, pattern, key=None, callback=None):
+        """
+        Add a pattern to the matcher (before compile()).
+
+        Args:
+            pattern (str | bytes): Text to look for; str patterns are UTF-8 encoded.
+            key: Value reported for matches of this pattern (defaults to the pattern itself).
+            callback (callable): Called with (key, end_offset) the moment the pattern completes.
+        """
+        if self._delta is not None:
+            raise RuntimeError("Cannot add patterns to a compiled matcher")
+        data = pattern.encode('utf-8') if isinstance(pattern, str) else bytes(pattern)
+        if not data:
+            raise ValueError("Empty patterns are not supported")
+        self._patterns.append((data, pattern if key is None else key, callback))
+        return self
+
+    def compile(self):
+        """Build the transition table; returns self for chaining."""
+        goto = [{}]
+        outputs = [[]]
+        for index, (data, _, _) in enumerate(self._patterns):
+            state = 0
+            for byte in data:
+                nxt = goto[state].get(byte)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][byte] = nxt
+                    goto.append({})
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(index)
+
+        # Breadth-first pass: fill every missing transition with the one of the
+        # failure state, which yields a DFA over all 256 byte values.
+        delta = [None] * len(goto)
+        delta[0] = [goto[0].get(byte, 0) for byte in range(256)]
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            row = list(delta[fail[state]])
+            for byte, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]][byte] if state else 0
+                row[byte] = nxt
+                queue.append(nxt)
+            delta[state] = row
+            outputs[state] = outputs[state] + outputs[fail[state]]
+
+        self._delta = delta
+        self._outputs = [tuple(out) for out in outputs]
+        return self
+
+    @property
+    def compiled(self):
+        return self._delta is not None
+
+    def scanner(self):
+        """Create a new scanning state over this matcher."""
+        if not self.compiled:
+            self.compile()
+        return PatternScanner(self)
+
+class PatternScanner:
+    """Incremental scanning state of a PatternMatcher; matches survive chunk boundaries."""
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.state = 0
+        self.offset = 0  # bytes consumed so far
+
+    def reset(self):
+        """Forget any partial match and restart offsets from zero."""
+        self.state = 0
+        self.offset = 0
+
+    def feed(self, data):
+        """
+        Scan the next chunk of the stream.
+
+        Args:
+            data (bytes | str): Next chunk; str chunks are UTF-8 encoded.
+
+        Returns:
+            list: (key, end_offset) for every match completed inside this chunk.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        delta = self.matcher._delta
+        outputs = self.matcher._outputs
+        patterns = self.matcher._patterns
+        state = self.state
+        matches = []
+        for i, byte in enumerate(data):
+            state = delta[state][byte]
+            if outputs[state]:
+                for index in outputs[state]:
+                    _, key, callback = patterns[index]
+                    end = self.offset + i + 1
+                    matches.append((key, end))
+                    if callback:
+                        callback(key, end)
+        self.state = state
+        self.offset += len(data)
+        return matches
+
+@lru_cache(maxsize=64)
+def compile_patterns(patterns):
+    """Compile (and cache) a matcher for a tuple of patterns keyed by the patterns themselves."""
+    matcher = PatternMatcher()
+    for pattern in patterns:
+        matcher.add(pattern)
+    return matcher.compile()
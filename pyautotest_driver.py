@@ -3,11 +3,25 @@ import time
 import threading
 import toml
 import os
+import codecs
 import logging
+import sys
+from serial_reader import RingBuffer, SerialReader
+from command_framing import CommandFrame, FrameParser, BatchParser, batch_lines
+from pattern_matcher import PatternMatcher, compile_patterns
+from output_capture import OutputCapture
+from boot_monitor import BootMonitor
 
 class pyautotest_driver:
-    def __init__(self, config):
+    def __init__(self, config, hub=None):
+        """
+        Initialize the driver from a TOML config string.
+
+        With a serial_hub.SerialHub the port is served by the hub's event loop
+        instead of a dedicated reader thread.
+        """
         self.config = toml.loads(config)
+        self.hub = hub
         self.serial_file = self.config['serial']['serial_file']
         self.bund_rate = self.config['serial']['bund_rate']
         self.timeout = self.config['serial'].get('timeout', 1)  # 新增timeout配置，默认1秒
@@ -17,36 +31,115 @@ class pyautotest_driver:
         self.login_prompts = self.config['serial']['login_prompts']
         self.password_prompts = self.config['serial']['password_prompts']
         self.shell_prompt = self.config['serial']['shell_prompt']  # 新增shell提示符
+        self.framing = self.config['serial'].get('framing', False)  # 用标记包裹命令，直接取得退出码
         self.log_dir = self.config['log_dir']
         self.stdout_log = self.config['serial']['stdout_log']
         self.serial_conn = None
         self.running = False
         self.reopening = False  # 新增标志位
         self.lock = threading.Lock()  # 用于避免同时读写的锁
-        self.login_event = threading.Event()  # 登录成功事件
         self.last_output_time = time.time()  # 记录最后一次输出的时间
+        self.rx_buffer = RingBuffer(self.config['serial'].get('rx_buffer_size', 1 << 20))  # 读线程写入，命令执行时消费
+        self.reader = None
+        self._rx_decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._rx_line = ""  # 尚未收到换行的半行数据
+
+        # 启动阶段状态机：所有里程碑和提示符只编译一次，每个字节查一次表，出现提示符立即回调
+        self.boot_timeouts = self.config['serial'].get('boot_timeouts', {})
+        self.watchdog = self.config['serial'].get('watchdog', {})  # panic、重启循环、无输出等检测参数
+        self.boot_monitor = BootMonitor(self.login_prompts, self.password_prompts, self.shell_prompt,
+                                        self.boot_timeouts, self._on_prompt, self.watchdog)
+        self.boot_result = None
+        self.shell_matcher = PatternMatcher().add(self.shell_prompt).compile()
+
+        # 每个串口一个日志记录器，多块板子同时运行时互不混杂；日志文件在 start() 时创建
+        self.logger = logging.getLogger(f"pyautotest_driver.{os.path.basename(self.serial_file)}")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.log_file_path = None
 
-        # 设置日志
-        log_file_path = os.path.join(self.log_dir, f"serial_log_{int(time.time())}.log")
-        logging.basicConfig(filename=log_file_path, level=logging.DEBUG, 
-                            format='%(asctime)s - %(levelname)s - %(message)s')
-        self.logger = logging.getLogger()
+    def _open_log(self):
+        """每次运行写入新的带时间戳的日志文件，关闭同一串口上一次运行留下的文件处理器。"""
+        for handler in list(self.logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                self.logger.removeHandler(handler)
+                handler.close()
+        port_name = os.path.basename(self.serial_file)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.log_file_path = os.path.join(self.log_dir, f"serial_log_{port_name}_{int(time.time())}.log")
+        handler = logging.FileHandler(self.log_file_path)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        self.logger.addHandler(handler)
 
-    def start(self):
+    def start(self, power_on=None):
+        """
+        Open the port and, with auto_login, wait until the DUT reaches its shell.
+
+        `power_on` is the monotonic time the DUT was powered, the start of the
+        boot timeline; it defaults to now.
+
+        Raises if the boot monitor's watchdog fails the boot (a stage stalled,
+        panic, boot loop, ...); the details are kept in `boot_result`.
+        """
+        self._open_log()
+        self.boot_monitor.reset(power_on)
         self._open_serial_port()
         self.running = True
-        read_thread = threading.Thread(target=self._read_serial)
-        read_thread.start()
+        reader_factory = self.hub.reader if self.hub else SerialReader
+        self.reader = reader_factory(
+            lambda: self.serial_conn,
+            self.rx_buffer,
+            on_data=self._on_serial_data,
+            on_error=self._on_serial_error,
+        )
+        self.reader.start()
         
         if self.auto_login:
-            self.login_event.wait()  # 等待登录成功事件被设置
-            self.logger.info("Auto login successful")
+            # 端口打开前控制台可能已停在提示符处，完全没有输出时发送一次回车
+            self._wait_for_shell(wake=self._wake_console)
+
+    def reboot(self, power_cycle):
+        """
+        Power cycle the DUT and, with auto_login, wait for its shell again.
+
+        `power_cycle` is called with the port open, so the whole boot is seen,
+        and returns the monotonic time power came back, or None if the DUT
+        could not be power cycled. Raises like start().
+        """
+        self.boot_result = None
+        self.boot_monitor.reset()
+        power_on = power_cycle()
+        if power_on is None:
+            raise Exception("Power cycling the DUT failed")
+        self.boot_monitor.powered(power_on)
+        if self.auto_login:
+            self._wait_for_shell()
+
+    def _wait_for_shell(self, wake=None):
+        self.boot_result = self.boot_monitor.wait(wake=wake)
+        timeline = ", ".join(f"{stage} {elapsed:.1f}s" for stage, elapsed in self.boot_result['stage_times'])
+        if not self.boot_result['success']:
+            error = f"Boot failed in stage {self.boot_result['stage']} ({self.boot_result['failure']}): {self.boot_result['error']}"
+            self.logger.error(f"{error} ({timeline})")
+            raise Exception(error)
+        self.logger.info(f"Auto login successful ({timeline})")
+
+    def _wake_console(self):
+        if self.serial_conn:
+            self._write(b'\n')
 
     def stop(self):
         self.running = False
+        if self.reader:
+            self.reader.stop()
+        self.rx_buffer.close()
         if self.serial_conn:
             self.serial_conn.close()
 
+    def _write(self, data):
+        with self.lock:  # 写操作加锁，读操作由读线程独占
+            self.serial_conn.write(data)
+
     def _open_serial_port(self):
         try:
             self.serial_conn = serial.Serial(
@@ -67,34 +160,24 @@ class pyautotest_driver:
             self.logger.error(f"Error opening serial port {self.serial_file}: {e}")
             self.serial_conn = None
 
-    def _read_serial(self):
-        while self.running:
-            try:
-                if self.serial_conn and self.serial_conn.in_waiting > 0:
-                    with self.lock:  # 获取锁，确保读写操作不会同时进行
-                        line = self.serial_conn.readline().decode('utf-8', errors='ignore')
-                    if self.stdout_log:
-                        print(line, end='')
-                    self.logger.debug(line)
-                    self.last_output_time = time.time()  # 更新最后一次输出的时间
-                    if self.auto_login:
-                        self._handle_auto_login(line)
-                elif self.serial_conn and self.serial_conn.in_waiting == 0:
-                    # 处理设备未返回数据的情况
-                    current_time = time.time()
-                    if self.auto_login and not self.login_event.is_set() and (current_time - self.last_output_time > 5):
-                        # 如果超过5秒没有接收到任何输出，并且登录事件未设置，则尝试输入用户名
-                        with self.lock:  # 获取锁，确保读写操作不会同时进行
-                            self.serial_conn.write((self.username + '\n').encode('utf-8'))
-                        self.logger.info("No output detected for 5 seconds, sending username to provoke response.")
-                        self.last_output_time = current_time  # 更新最后一次输出的时间
-                    time.sleep(0.1)
-            except (serial.SerialException, OSError, TypeError) as e:
-                if not self.running:
-                    self.logger.info("Serial read loop exiting due to stop signal.")
-                    break
-                self.logger.error(f"Error reading from serial port: {e}")
-                self._attempt_reopen_serial_port()
+    def _on_serial_data(self, chunk):
+        """Handle a chunk pushed by the reader thread: log it and drive auto login."""
+        received_at = time.monotonic()  # 单调时钟，不受系统时间调整影响，用于启动各阶段耗时
+        text = self._rx_decoder.decode(chunk)
+        if self.stdout_log:
+            print(text, end='', flush=True)
+        self.last_output_time = time.time()  # 更新最后一次输出的时间
+
+        lines = (self._rx_line + text).split('\n')
+        self._rx_line = lines.pop()[-4096:]
+        for line in lines:
+            self.logger.debug(line)
+        # 直接在字节流上匹配，跨块的提示符也能识别，匹配完成时立即回调
+        self.boot_monitor.feed(chunk, received_at)
+
+    def _on_serial_error(self, e):
+        self.logger.error(f"Error reading from serial port: {e}")
+        self._attempt_reopen_serial_port()
 
     def _attempt_reopen_serial_port(self):
         if not self.reopening:  # 避免多次尝试重新打开
@@ -109,78 +192,193 @@ class pyautotest_driver:
             self._open_serial_port()
             self.reopening = False  # 重置标志位
 
-    def _handle_auto_login(self, line):
-        if self.shell_prompt in line:
-            self.login_event.set()  # 设置登录成功事件
-            self.logger.info(f"Detected shell prompt: {line.strip()}")
+    def _on_prompt(self, kind, prompt):
+        """BootMonitor callback: answer login/password prompts."""
+        if not self.auto_login:
             return
-        
-        for prompt in self.login_prompts:
-            if prompt in line:
-                with self.lock:  # 获取锁，确保读写操作不会同时进行
-                    self.serial_conn.write((self.username + '\n').encode('utf-8'))
-                self.logger.info(f"Detected login prompt: {line.strip()}")
-                return
-        for prompt in self.password_prompts:
-            if prompt in line:
-                with self.lock:  # 获取锁，确保读写操作不会同时进行
-                    self.serial_conn.write((self.password + '\n').encode('utf-8'))
-                self.logger.info(f"Detected password prompt: {line.strip()}")
-                return
-
-    def run_command(self, cmd, timeout):
-        """Run a command and return the output without checking the result."""
+        if kind == 'login':
+            self._write((self.username + '\n').encode('utf-8'))
+            self.logger.info(f"Detected login prompt: {prompt}")
+        elif kind == 'password':
+            self._write((self.password + '\n').encode('utf-8'))
+            self.logger.info(f"Detected password prompt: {prompt}")
+
+    def _ensure_serial_port(self):
         if not self.serial_conn or not self.serial_conn.is_open:
             self._open_serial_port()
         if not self.serial_conn:
             self.logger.error("Failed to open serial port.")
+            return False
+        return True
+
+    def _exchange(self, line, timeout, consume):
+        """
+        Send one line and feed the decoded reply to `consume` until it returns True.
+
+        Returns:
+            bool: False if `timeout` expired or the driver stopped first.
+        """
+        cursor = self.rx_buffer.total  # 只消费命令发出之后收到的数据
+        try:
+            self._write((line + '\n').encode('utf-8'))
+        except (serial.SerialException, OSError, TypeError) as e:
+            self.logger.error(f"Error writing to serial port: {e}")
+            self._attempt_reopen_serial_port()
+            return False
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        deadline = time.monotonic() + timeout
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.rx_buffer.wait(cursor, remaining):
+                if self.rx_buffer.closed:
+                    break
+                continue
+            data, cursor = self.rx_buffer.read(cursor)
+            if consume(decoder.decode(data)):
+                return True
+        return False
+
+    def _new_capture(self, capture, observer):
+        if capture is None:
+            capture = OutputCapture(head_size=sys.maxsize)  # 未指定时完整保留在内存中
+        if observer:
+            capture.observers.append(observer)
+        return capture
+
+    def run_command(self, cmd, timeout, observer=None, capture=None):
+        """
+        Run a command and return the output without checking the result.
+
+        `observer`, when given, is called with each piece of output as soon as it arrives.
+        With an OutputCapture the output is streamed into it and only its bounded
+        text is returned.
+        """
+        if self.framing:
+            return self.run_command_framed(cmd, timeout, observer, capture)[0]
+        if not self._ensure_serial_port():
             return ""
 
         self.logger.info(f"Running command: {cmd}")
-        with self.lock:  # 获取锁，确保读写操作不会同时进行
-            self.serial_conn.reset_input_buffer()  # 清空缓冲区
-            self.serial_conn.write((cmd + '\n').encode('utf-8'))
-            start_time = time.time()
-            output = ""
-            while time.time() - start_time < timeout:
-                try:
-                    if not self.running:  # 检查运行状态
-                        break
-
-                    if self.serial_conn.in_waiting > 0:
-                        line = self.serial_conn.readline().decode('utf-8', errors='ignore')
-                        
-                        # 检测并去掉命令本身
-                        if line.startswith(cmd):
-                            line = line[len(cmd):].lstrip()
-                        
-                        # 检测到 shell 提示符，命令执行完成
-                        if self.shell_prompt in line:
-                            line = line.split(self.shell_prompt)[0].rstrip()
-                            output += line
-                            self.logger.debug(f"Detected shell prompt in output: {line.strip()}")
-                            break
-
-                        output += line
-                        if self.stdout_log:
-                            print(line, end='')
-                        self.logger.debug(line)
-                    elif self.serial_conn and self.serial_conn.in_waiting == 0:
-                        # 处理设备未返回数据的情况
-                        time.sleep(0.1)
-                except (serial.SerialException, OSError, TypeError) as e:
-                    self.logger.error(f"Error reading from serial port: {e}")
-                    self._attempt_reopen_serial_port()
-                    break
+        capture = self._new_capture(capture, observer)
+        pending = ""
+        scanner = self.shell_matcher.scanner()
+
+        def consume(text):
+            nonlocal pending
+            prompt_seen = bool(scanner.feed(text))
+            lines = (pending + text).split('\n')
+            pending = lines.pop()
+            # 提示符不以换行结尾，自动机命中后把最后的半行也作为一行处理
+            if prompt_seen:
+                lines.append(pending)
+            for i, line in enumerate(lines):
+                is_partial = prompt_seen and i == len(lines) - 1
+                if not is_partial:
+                    line += '\n'
+                
+                # 检测并去掉命令本身
+                if line.startswith(cmd):
+                    line = line[len(cmd):].lstrip()
+                
+                # 检测到 shell 提示符，命令执行完成
+                if self.shell_prompt in line:
+                    line = line.split(self.shell_prompt)[0].rstrip()
+                    capture.write(line)
+                    self.logger.debug(f"Detected shell prompt in output: {line.strip()}")
+                    return True
 
-            self.logger.info(f"Command output: {output}")
+                capture.write(line)
+            return False
+
+        self._exchange(cmd, timeout, consume)
+        output = capture.text
+        self.logger.info(f"Command output: {output}")
 
         return output
 
+    def run_command_framed(self, cmd, timeout, observer=None, capture=None):
+        """
+        Run a command wrapped in begin/end markers and return as soon as the end marker arrives.
+
+        `observer` and `capture` work as in run_command.
+
+        Returns:
+            tuple: (stdout, exit_code, duration); exit_code is None if the end marker
+            did not arrive within `timeout`.
+        """
+        if not self._ensure_serial_port():
+            return "", None, 0.0
+
+        frame = CommandFrame(cmd)
+        capture = self._new_capture(capture, observer)
+        parser = FrameParser(frame, capture.write)
+        self.logger.info(f"Running framed command: {cmd}")
+        start_time = time.monotonic()
+        if not self._exchange(frame.wrap(), timeout, parser.feed):
+            self.logger.error(f"Timed out waiting for end marker of command: {cmd}")
+        duration = time.monotonic() - start_time
+
+        output = capture.text
+        self.logger.info(f"Command output: {output}")
+        self.logger.info(f"Exit code: {parser.exit_code}, duration: {duration:.3f}s")
+        return output, parser.exit_code, duration
+
+    def run_commands_framed(self, cmds, timeout, captures=None):
+        """
+        Ship several independent commands to the DUT as framed script lines and
+        split the combined output back per command.
+
+        `captures`, when given, holds one OutputCapture per command.
+
+        Returns:
+            list: One (stdout, exit_code, duration) tuple per command; exit_code is
+            None for commands whose end marker did not arrive within `timeout`.
+        """
+        if not self._ensure_serial_port():
+            return [("", None, 0.0) for _ in cmds]
+
+        frames = [CommandFrame(cmd) for cmd in cmds]
+        captures = captures or [self._new_capture(None, None) for _ in cmds]
+        results = []
+        deadline = time.monotonic() + timeout
+        self.logger.info(f"Running {len(cmds)} commands as a batch")
+        position = 0
+        for line, members in batch_lines(frames):
+            batch_captures = captures[position:position + len(members)]
+            position += len(members)
+            parser = BatchParser(members, [capture.write for capture in batch_captures])
+            start_time = time.monotonic()
+            remaining = deadline - start_time
+            if remaining <= 0:
+                # Whatever timed out may still own the console, do not type more commands into it
+                self.logger.error(f"Batch deadline passed, not sending {len(members)} more commands")
+            elif not self._exchange(line, remaining, parser.feed):
+                self.logger.error(f"Timed out waiting for batch, {parser.index}/{len(members)} commands completed")
+                deadline = start_time  # skip the remaining lines
+            for frame_parser, finish_time, capture in zip(parser.parsers, parser.finish_times, batch_captures):
+                duration = finish_time - start_time if finish_time is not None else None
+                if finish_time is not None:
+                    start_time = finish_time
+                output = capture.text
+                results.append((output, frame_parser.exit_code, duration))
+                self.logger.info(f"Command: {frame_parser.frame.cmd}, exit code: {frame_parser.exit_code}")
+                self.logger.debug(f"Command output: {output}")
+        return results
+
     def run_command_and_check_output(self, cmd, patterns, timeout):
         """Run a command and check if the output matches any of the given patterns."""
-        output = self.run_command(cmd, timeout)
-        matched = any(pattern in output for pattern in patterns)
+        scanner = compile_patterns(tuple(patterns)).scanner()
+        matched = False
+
+        def observer(text):
+            nonlocal matched
+            if not matched and scanner.feed(text):
+                matched = True
+
+        output = self.run_command(cmd, timeout, observer)
         self.logger.info(f"Command output: {output}")
         self.logger.info(f"Matched: {matched}")
-        return output, matched
\ No newline at end of file
+        return output, matched
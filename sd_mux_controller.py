@@ -1,7 +1,37 @@
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from device_discovery import default_sysfs_index
+
+try:
+    from pyftdi.ftdi import Ftdi
+except ImportError:  # pyftdi is optional, sd-mux-ctrl is used without it
+    Ftdi = None
+
+try:
+    from usbsdmux import usbsdmux
+except ImportError:  # the usbsdmux package is optional, its CLI is used without it
+    usbsdmux = None
+
+COMMAND_TIMEOUT = 60  # seconds; a hung mux tool must not keep a farm slot locked
+
+def mux_result(serial, operation, started, error=None):
+    """Outcome of one mux operation: success, serial, operation, error (None on success) and duration in seconds."""
+    return {
+        "success": error is None,
+        "serial": serial,
+        "operation": operation,
+        "error": error,
+        "duration": time.monotonic() - started,
+    }
 
 class SDMuxBaseController:
-    """Base class for SD-Mux controllers."""
+    """
+    Base class for SD-Mux controllers.
+    
+    connect_to_dut(), connect_to_ts() and power_cycle_dut() return a mux_result() dict.
+    """
     
     def list_devices(self):
         """List all devices connected to the SD-Mux controller."""
@@ -22,6 +52,21 @@ class SDMuxBaseController:
     def power_cycle_dut(self, serial):
         """Power cycle the Device Under Test (DUT)."""
         raise NotImplementedError("Method 'power_cycle_dut' not implemented in subclass.")
+    
+    def close(self):
+        """Release the handles kept open across operations."""
+    
+    def _run(self, command, serial, operation):
+        """Run a mux command line and turn its exit status into a mux_result()."""
+        started = time.monotonic()
+        print(f"Executing command: {' '.join(command)}")
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=COMMAND_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return mux_result(serial, operation, started, str(e))
+        if result.returncode != 0:
+            return mux_result(serial, operation, started, (result.stderr or result.stdout).strip() or f"exit status {result.returncode}")
+        return mux_result(serial, operation, started)
 
 class SDMuxCtrlController(SDMuxBaseController):
     """Controller for managing SD-Mux via sd-mux-ctrl."""
@@ -44,80 +89,244 @@ class SDMuxCtrlController(SDMuxBaseController):
     
     def connect_to_dut(self, serial):
         """Connect the SD card to the Device Under Test (DUT)."""
-        command = ['sudo', 'sd-mux-ctrl', '--dut', f'--device-serial={serial}']
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True)
-        print(f"Connecting SD card to DUT with serial {serial}:")
-        print(result.stdout if result.stdout else "Connected to DUT successfully.")
+        return self._run(['sudo', 'sd-mux-ctrl', '--dut', f'--device-serial={serial}'], serial, "dut")
     
     def connect_to_ts(self, serial):
         """Connect the SD card to the Test Server (TS)."""
-        command = ['sudo', 'sd-mux-ctrl', '--ts', f'--device-serial={serial}']
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True)
-        print(f"Connecting SD card to TS with serial {serial}:")
-        print(result.stdout if result.stdout else "Connected to TS successfully.")
+        return self._run(['sudo', 'sd-mux-ctrl', '--ts', f'--device-serial={serial}'], serial, "ts")
     
     def power_cycle_dut(self, serial):
         """Power cycle the Device Under Test (DUT)."""
-        command = ['sudo', 'sd-mux-ctrl', '--tick', '--tick-time=2000', f'--device-serial={serial}']
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True)
-        print(f"Power cycling DUT with serial {serial}:")
-        print(result.stdout if result.stdout else "Power cycle completed successfully.")
+        return self._run(['sudo', 'sd-mux-ctrl', '--tick', '--tick-time=2000', f'--device-serial={serial}'], serial, "power_cycle")
+
+class FtdiSDWireController(SDMuxCtrlController):
+    """
+    Switches SDWire muxes in-process with pyftdi, as sd-mux-ctrl does with libftdi.
+    
+    The FTDI handle of each mux is opened once and kept, so a switch is a single
+    USB control transfer. Listing, serial programming and power cycling (which
+    SDWire does not have) still go through sd-mux-ctrl.
+    """
+    
+    VENDOR = 0x04e8
+    PRODUCT = 0x6001
+    # CBUS bit-bang: upper nibble makes CBUS0 an output, bit 0 selects the card's side
+    PINS = {"dut": 0xF0, "ts": 0xF1}
+    
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+    
+    def _handle(self, serial):
+        with self._lock:
+            if serial not in self._handles:
+                ftdi = Ftdi()
+                ftdi.open(self.VENDOR, self.PRODUCT, serial=serial)
+                self._handles[serial] = ftdi
+            return self._handles[serial]
+    
+    def _switch(self, serial, target):
+        started = time.monotonic()
+        try:
+            self._handle(serial).set_bitmode(self.PINS[target], Ftdi.BitMode.CBUS)
+        except Exception as e:
+            with self._lock:
+                stale = self._handles.pop(serial, None)  # reopened on the next attempt, e.g. after a replug
+            if stale is not None:
+                try:
+                    stale.close()
+                except Exception:
+                    pass
+            return mux_result(serial, target, started, f"{type(e).__name__}: {e}")
+        return mux_result(serial, target, started)
+    
+    def connect_to_dut(self, serial):
+        return self._switch(serial, "dut")
+    
+    def connect_to_ts(self, serial):
+        return self._switch(serial, "ts")
+    
+    def close(self):
+        with self._lock:
+            for ftdi in self._handles.values():
+                ftdi.close()
+            self._handles.clear()
 
 class UsbSDMuxController(SDMuxBaseController):
     """Controller for managing SD-Mux via usbsdmux."""
     
-    def __init__(self):
-        self.sda_device = self._detect_sda_device()
-        self.sg_device = self._detect_sg_device()
+    def __init__(self, index=None):
+        """Initialize with a device_discovery.SysfsIndex; the process-wide one by default."""
+        self.index = index or default_sysfs_index()
     
-    def _detect_sda_device(self):
-        """Detect /dev/sda device, or read from configuration."""
-        # TODO: Implement detection logic here
-        # Maybe read from dd config?
-        return '/dev/sda'
+    def sg_device(self, serial=None):
+        """Return the SCSI generic device (/dev/sgN) of the mux with the given serial, or of the only mux."""
+        sg_device, _ = self.index.lookup(serial)
+        if sg_device is None:
+            raise Exception(f"USB SD mux {serial} has no SCSI generic device")
+        return sg_device
     
-    def _detect_sg_device(self):
-        """Detect /dev/sg0 device, or read from configuration."""
-        # TODO: Implement detection logic here
-        # With lsscsi or scan the /sys/class/scsi_generic/sgX/device/block?
-        return '/dev/sg0'
+    def block_device(self, serial=None):
+        """Return the block device (/dev/sdX) of the card reader of the mux with the given serial."""
+        return self.index.lookup(serial)[1]
     
     def list_devices(self):
         """List all devices connected to the SD-Mux controller."""
-        print("usbsdmux does not support listing devices.")
+        print("Listing all connected devices:")
+        for serial in self.index.serials():
+            sg_device, block_device = self.index.lookup(serial)
+            print(f"{serial}: {sg_device} {block_device or '(no card reader)'}")
     
     def set_serial(self, serial):
         """Set the serial number for the SD-Mux controller."""
         print("usbsdmux does not support setting serial number.")
     
+    def _usbsdmux(self, serial, mode, operation):
+        started = time.monotonic()
+        try:
+            sg_device = self.sg_device(serial)
+        except Exception as e:
+            return mux_result(serial, operation, started, str(e))
+        return self._run(['sudo', 'usbsdmux', sg_device, mode], serial, operation)
+    
     def connect_to_dut(self, serial=None):
         """Connect the SD card to the Device Under Test (DUT)."""
-        command = ['sudo', 'usbsdmux', self.sg_device, 'dut']
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True)
-        print("Connecting SD card to DUT:")
-        print(result.stdout if result.stdout else "Connected to DUT successfully.")
+        return self._usbsdmux(serial, 'dut', "dut")
     
     def connect_to_ts(self, serial=None):
         """Connect the SD card to the Test Server (TS)."""
-        command = ['sudo', 'usbsdmux', self.sg_device, 'host']
-        print(f"Executing command: {' '.join(command)}")
-        result = subprocess.run(command, capture_output=True, text=True)
-        print("Connecting SD card to TS:")
-        print(result.stdout if result.stdout else "Connected to TS successfully.")
+        return self._usbsdmux(serial, 'host', "ts")
     
     def power_cycle_dut(self, serial=None):
         """Power cycle the Device Under Test (DUT)."""
         print("usbsdmux does not support power cycling.")
+        return mux_result(serial, "power_cycle", time.monotonic(), "usbsdmux does not support power cycling")
+
+class UsbSDMuxLibController(UsbSDMuxController):
+    """
+    Switches USB-SD-Muxes in-process through the usbsdmux package.
+    
+    One driver object per SCSI generic device is created and kept, instead of
+    running `sudo usbsdmux` for every switch.
+    """
+    
+    def __init__(self, index=None):
+        super().__init__(index)
+        self._drivers = {}
+        self._lock = threading.Lock()
+    
+    def _driver(self, sg_device):
+        with self._lock:
+            if sg_device not in self._drivers:
+                if hasattr(usbsdmux, 'autoselect_driver'):
+                    self._drivers[sg_device] = usbsdmux.autoselect_driver(sg_device)
+                else:
+                    self._drivers[sg_device] = usbsdmux.UsbSdMux(sg_device)
+            return self._drivers[sg_device]
+    
+    def _usbsdmux(self, serial, mode, operation):
+        started = time.monotonic()
+        try:
+            sg_device = self.sg_device(serial)
+            driver = self._driver(sg_device)
+            driver.mode_DUT() if mode == 'dut' else driver.mode_host()
+        except Exception as e:
+            with self._lock:
+                self._drivers = {}  # the sg device may have been renumbered by a replug
+            return mux_result(serial, operation, started, f"{type(e).__name__}: {e}")
+        return mux_result(serial, operation, started)
+    
+    def close(self):
+        with self._lock:
+            self._drivers = {}
+
+class MockSDMuxController(SDMuxBaseController):
+    """
+    In-memory mux for tests: records every operation and the side each card is on.
+    
+    Args:
+        delay (float): Seconds each operation takes.
+        fail (set): Serials whose operations fail.
+    """
+    
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.state = {}
+        self.operations = []
+        self._lock = threading.Lock()
+    
+    def list_devices(self):
+        print("Listing all connected devices:")
+        print("\n".join(sorted(self.state)))
+    
+    def set_serial(self, serial):
+        pass
+    
+    def _operate(self, serial, operation):
+        started = time.monotonic()
+        time.sleep(self.delay)
+        with self._lock:
+            self.operations.append((serial, operation))
+            if serial in self.fail:
+                return mux_result(serial, operation, started, f"mock mux {serial} failed")
+            if operation != "power_cycle":
+                self.state[serial] = operation
+        return mux_result(serial, operation, started)
+    
+    def connect_to_dut(self, serial=None):
+        return self._operate(serial, "dut")
+    
+    def connect_to_ts(self, serial=None):
+        return self._operate(serial, "ts")
+    
+    def power_cycle_dut(self, serial=None):
+        return self._operate(serial, "power_cycle")
+
+_shared_controllers = {}
+_shared_lock = threading.Lock()
+
+def shared_controller(use_usbsdmux=False):
+    """
+    Return the process-wide controller of a mux type, created on first use.
+    
+    The in-process controllers are preferred when pyftdi / usbsdmux are
+    installed; otherwise the command line tools are run.
+    """
+    kind = "usbsdmux" if use_usbsdmux else "sd-mux-ctrl"
+    with _shared_lock:
+        if kind not in _shared_controllers:
+            if use_usbsdmux:
+                _shared_controllers[kind] = UsbSDMuxLibController() if usbsdmux is not None else UsbSDMuxController()
+            else:
+                _shared_controllers[kind] = FtdiSDWireController() if Ftdi is not None else SDMuxCtrlController()
+        return _shared_controllers[kind]
 
 class SDMuxController:
-    """High-level controller for managing SD-Mux devices using different implementations."""
+    """
+    High-level controller for managing SD-Mux devices using different implementations.
+    
+    Every instance of a mux type shares one long-lived controller (see
+    shared_controller()), so handles stay open across boards and operations,
+    and operations on the same mux are serialized. Operations return
+    mux_result() dicts instead of raising; switch_many() switches several muxes
+    concurrently.
+    """
+    
+    _mux_locks = {}
+    _mux_locks_guard = threading.Lock()
+    
+    def __init__(self, use_usbsdmux=False, controller=None):
+        self.controller = controller or shared_controller(use_usbsdmux)
     
-    def __init__(self, use_usbsdmux=False):
-        self.controller = UsbSDMuxController() if use_usbsdmux else SDMuxCtrlController()
+    def _locked(self, serial, operation):
+        with self._mux_locks_guard:
+            lock = self._mux_locks.setdefault(serial, threading.Lock())
+        with lock:
+            result = operation(serial)
+        if not result["success"]:
+            print(f"SD mux {serial}: {result['operation']} failed: {result['error']}")
+        return result
     
     def list_devices(self):
         """List all devices connected to the SD-Mux controller."""
@@ -129,12 +338,29 @@ class SDMuxController:
     
     def connect_to_dut(self, serial=None):
         """Connect the SD card to the Device Under Test (DUT)."""
-        self.controller.connect_to_dut(serial)
+        return self._locked(serial, self.controller.connect_to_dut)
     
     def connect_to_ts(self, serial=None):
         """Connect the SD card to the Test Server (TS)."""
-        self.controller.connect_to_ts(serial)
+        return self._locked(serial, self.controller.connect_to_ts)
     
     def power_cycle_dut(self, serial=None):
         """Power cycle the Device Under Test (DUT)."""
-        self.controller.power_cycle_dut(serial)
\ No newline at end of file
+        return self._locked(serial, self.controller.power_cycle_dut)
+    
+    def switch_many(self, targets):
+        """
+        Switch several muxes at once.
+    
+        Args:
+            targets (dict): serial -> "dut" or "ts".
+    
+        Returns:
+            dict: serial -> mux_result().
+        """
+        operations = {"dut": self.connect_to_dut, "ts": self.connect_to_ts}
+        if not targets:
+            return {}
+        with ThreadPoolExecutor(len(targets)) as executor:
+            futures = {serial: executor.submit(operations[target], serial) for serial, target in targets.items()}
+        return {serial: future.result() for serial, future in futures.items()}
@@ -0,0 +1,155 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import serial
+
+class SerialHub:
+    """
+    A single asyncio event loop that owns the serial ports of many boards.
+
+    Every port is registered with loop.add_reader(), so a host drives dozens of
+    boards from one thread instead of one reader thread (or one Python process)
+    per port. Drivers created with `hub=` use it transparently and keep their
+    usual start/run_command/stop surface.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._readers = set()
+
+    def start(self):
+        """Start the event loop thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="serial-hub", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Detach every port and stop the event loop."""
+        if self._thread is None:
+            return
+        for reader in list(self._readers):
+            reader.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+        self.loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, func, *args):
+        """Run `func` on the loop thread and return its result."""
+        if threading.current_thread() is self._thread:
+            return func(*args)
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def reader(self, port, buffer, on_data=None, on_idle=None, on_error=None, poll_interval=0.1):
+        """Create a HubReader; it takes the same arguments as serial_reader.SerialReader."""
+        self.start()
+        return HubReader(self, port, buffer, on_data, on_idle, on_error, poll_interval)
+
+class HubReader:
+    """Drop-in replacement for SerialReader that lives on a SerialHub's event loop."""
+
+    def __init__(self, hub, port, buffer, on_data=None, on_idle=None, on_error=None, poll_interval=0.1):
+        self.hub = hub
+        self.port = port
+        self.buffer = buffer
+        self.on_data = on_data
+        self.on_idle = on_idle
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self.stopped = False
+        self._fd = None
+        self._timer = None
+        self._last_rx = 0.0
+
+    def start(self):
+        self.hub.call(self._start)
+
+    def stop(self):
+        """Detach the port from the loop; safe to call from any thread."""
+        if not self.stopped:
+            self.hub.call(self._stop)
+
+    def is_alive(self):
+        return not self.stopped
+
+    def _start(self):
+        self.stopped = False
+        self.hub._readers.add(self)
+        self._register()
+        self._timer = self.hub.loop.call_later(self.poll_interval, self._tick)
+
+    def _stop(self):
+        self.stopped = True
+        self.hub._readers.discard(self)
+        self._unregister()
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _register(self):
+        if self._fd is not None:
+            return
+        conn = self.port()
+        if conn is None or not conn.is_open:
+            return  # _tick() retries once the driver has reopened the port
+        self._fd = conn.fileno()
+        self._last_rx = self.hub.loop.time()
+        self.hub.loop.add_reader(self._fd, self._on_readable)
+
+    def _unregister(self):
+        if self._fd is not None:
+            self.hub.loop.remove_reader(self._fd)
+            self._fd = None
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not data:
+            self._fail(serial.SerialException("device reports readiness to read but returned no data"))
+            return
+        self._last_rx = self.hub.loop.time()
+        self.buffer.write(data)
+        if self.on_data:
+            self.on_data(data)
+
+    def _fail(self, error):
+        self._unregister()
+        if self.stopped or not self.on_error:
+            return
+        # Recovery (closing and reopening the port) may sleep, keep it off the loop thread
+        self.hub.loop.run_in_executor(None, self.on_error, error)
+
+    def _tick(self):
+        if self.stopped:
+            return
+        self._register()
+        if self._fd is not None and self.hub.loop.time() - self._last_rx >= self.poll_interval and self.on_idle:
+            self.on_idle()
+        self._timer = self.hub.loop.call_later(self.poll_interval, self._tick)
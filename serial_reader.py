@@ -0,0 +1,167 @@
+import select
+import threading
+import time
+import serial
+
+class RingBuffer:
+    """Fixed-size byte ring shared between one serial reader and any number of consumers."""
+
+    def __init__(self, capacity=1 << 20):
+        """
+        Initialize the ring buffer.
+
+        Args:
+            capacity (int): Number of most recent bytes kept in memory.
+        """
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._total = 0  # absolute number of bytes ever written
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def total(self):
+        """Absolute offset one past the last byte written so far."""
+        return self._total
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def write(self, data):
+        """Append bytes and wake up every waiting consumer."""
+        if not data:
+            return
+        with self._cond:
+            end = self._total + len(data)
+            if len(data) > self.capacity:
+                data = data[-self.capacity:]
+            start = (end - len(data)) % self.capacity
+            first = min(len(data), self.capacity - start)
+            self._buf[start:start + first] = data[:first]
+            if first < len(data):
+                self._buf[:len(data) - first] = data[first:]
+            self._total = end
+            self._cond.notify_all()
+
+    def read(self, offset, max_bytes=None):
+        """
+        Read the bytes written since the given absolute offset.
+
+        A consumer that fell more than `capacity` bytes behind silently skips
+        the overwritten part.
+
+        Returns:
+            tuple: (data, next_offset)
+        """
+        with self._cond:
+            offset = max(offset, self._total - self.capacity, 0)
+            end = self._total
+            if max_bytes is not None:
+                end = min(end, offset + max_bytes)
+            if end <= offset:
+                return b"", offset
+            start = offset % self.capacity
+            size = end - offset
+            first = min(size, self.capacity - start)
+            data = bytes(self._buf[start:start + first])
+            if first < size:
+                data += bytes(self._buf[:size - first])
+            return data, end
+
+    def wait(self, offset, timeout=None):
+        """Block until data past `offset` is available; return False on timeout or close."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._total > offset or self._closed, timeout)
+            return self._total > offset
+
+    def close(self):
+        """Wake up all consumers for good."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class SerialReader(threading.Thread):
+    """
+    Background reader that blocks on the serial file descriptor and pushes every
+    received chunk into a RingBuffer.
+
+    Instead of polling `in_waiting` and sleeping, the thread sleeps in select()
+    until the kernel reports data, then drains everything that is available in
+    one read. Ports without a file descriptor fall back to a blocking read with
+    the port's own timeout.
+    """
+
+    def __init__(self, port, buffer, on_data=None, on_idle=None, on_error=None, poll_interval=0.1):
+        """
+        Initialize the serial reader.
+
+        Args:
+            port (callable): Returns the current serial.Serial object (it may be reopened).
+            buffer (RingBuffer): Destination for received bytes.
+            on_data (callable): Called with each received chunk after it is buffered.
+            on_idle (callable): Called when no data arrived within `poll_interval`.
+            on_error (callable): Called with the exception when reading fails.
+            poll_interval (float): Maximum time spent blocked before checking the stop flag.
+        """
+        super().__init__(daemon=True)
+        self.port = port
+        self.buffer = buffer
+        self.on_data = on_data
+        self.on_idle = on_idle
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Ask the reader to exit and wait for it."""
+        self._stop_event.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=self.poll_interval * 5 + 1)
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                chunk = self._read_chunk()
+            except (serial.SerialException, OSError, TypeError, ValueError) as e:
+                if self._stop_event.is_set():
+                    break
+                if self.on_error:
+                    self.on_error(e)
+                else:
+                    time.sleep(self.poll_interval)
+                continue
+
+            if chunk:
+                self.buffer.write(chunk)
+                if self.on_data:
+                    self.on_data(chunk)
+            elif self.on_idle:
+                self.on_idle()
+
+    def _read_chunk(self):
+        conn = self.port()
+        if conn is None or not conn.is_open:
+            self._stop_event.wait(self.poll_interval)
+            return b""
+
+        try:
+            fd = conn.fileno()
+        except (AttributeError, NotImplementedError, serial.SerialException):
+            fd = None
+
+        if fd is not None:
+            ready, _, _ = select.select([fd], [], [], self.poll_interval)
+            if not ready:
+                return b""
+            return conn.read(max(conn.in_waiting, 1))
+
+        # Ports without a file descriptor (e.g. loop://) fall back to a timed blocking read
+        first = conn.read(1)
+        if not first:
+            return b""
+        return first + conn.read(conn.in_waiting)
@@ -1,9 +1,59 @@
 import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+import toml
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi import Request
+from farm_scheduler import board_resources
+from job_queue import DEFAULT_DB_PATH, FINAL_STATES, LEASE_TIME, JobQueue
+from main import job_params, parse_args, run_job as run_params
+from output_log import OutputLog
+from worker_pool import DEFAULT_WORKERS, WorkerPool
 
-app = FastAPI()
+JOB_DB_PATH = DEFAULT_DB_PATH
+JOB_TARGET = run_params  # run by a pool worker with the parameters of every job
+JOB_WORKERS = DEFAULT_WORKERS
+
+async def schedule():
+    """
+    Start queued jobs as soon as their hardware is free and keep the leases of running jobs alive.
+
+    Runs for the life of the server; it wakes up whenever a job is queued or
+    finishes, and at least every third of the lease time to renew leases.
+    """
+    while True:
+        wake.clear()
+        for job in queue.dispatch(limit=pool.available()):
+            runners[job["id"]] = asyncio.create_task(run_job(job, pool.acquire()))
+        queue.renew(list(runners))
+        try:
+            await asyncio.wait_for(wake.wait(), LEASE_TIME / 3)
+        except asyncio.TimeoutError:
+            pass
+
+@asynccontextmanager
+async def lifespan(app):
+    global queue, pool, wake
+    queue = JobQueue(JOB_DB_PATH)
+    pool = WorkerPool(JOB_TARGET, JOB_WORKERS)
+    wake = asyncio.Event()
+    await pool.start()
+    requeued = queue.recover()
+    if requeued:
+        print(f"Requeued jobs left running: {requeued}")
+    scheduler = asyncio.create_task(schedule())
+    yield
+    # Running jobs go back to the queue for the next server
+    scheduler.cancel()
+    queue.requeue(list(runners))
+    for runner in list(runners.values()):
+        runner.cancel()
+    await pool.close()
+    queue.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Read token
 with open("secret.token", "r") as file:
@@ -22,8 +72,6 @@ html = """
         <button onclick="startTest()">Start Test</button>
         <script>
             let testId = null;
-            let polling = null;
-            let outputLength = 0;
 
             async function startTest() {
                 const args = prompt("Enter CLI arguments:");
@@ -45,20 +93,13 @@ html = """
                     body: JSON.stringify({token: "your_token_here"})
                 });
                 
-                // Start polling for status and output
-                polling = setInterval(async () => {
-                    const statusResponse = await fetch(`/test_status/${testId}`);
-                    const statusData = await statusResponse.json();
-
-                    const outputResponse = await fetch(`/test_output/${testId}?length=${outputLength}`);
-                    const outputData = await outputResponse.json();
-                    document.getElementById("output").value += outputData.output;
-                    outputLength += outputData.length;
-
-                    if (statusData.status === "completed" || statusData.status === "stopped") {
-                        clearInterval(polling);
-                    }
-                }, 1000);
+                // The server pushes new output as it arrives; on reconnect the
+                // browser resumes from the last event id (a byte offset)
+                const events = new EventSource(`/test_output/${testId}/stream`);
+                events.onmessage = (event) => {
+                    document.getElementById("output").value += JSON.parse(event.data);
+                };
+                events.addEventListener("end", () => events.close());
             }
         </script>
     </body>
@@ -69,8 +110,87 @@ html = """
 async def get():
     return HTMLResponse(html)
 
-# Store active tests and their status
-active_tests = {}
+# Jobs live in a durable queue; output and workers only while this server runs
+queue = None
+pool = None
+outputs = {}
+workers = {}
+runners = {}
+stopping = set()
+wake = None
+
+def check_token(data):
+    if data.get("token") != SECRET_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid token")
+
+def job_id(test_id):
+    try:
+        return int(test_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Test not found")
+
+def find_job(test_id):
+    job = queue.get(job_id(test_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Test not found")
+    return job
+
+def find_output(test_id):
+    if str(job_id(test_id)) in outputs:
+        return outputs[str(job_id(test_id))]
+    # Output is only kept in memory: a job from before a restart starts with an empty log
+    job = find_job(test_id)
+    log = outputs.setdefault(str(job["id"]), OutputLog())
+    if job["state"] in FINAL_STATES:
+        log.close()
+    return log
+
+def job_status(job):
+    return {key: job[key] for key in ("id", "state", "priority", "resources", "created", "started", "finished", "result", "error")} | {"params": job["spec"]["params"]}
+
+def request_params(data):
+    """
+    Return the job parameters of a create_test request.
+
+    Jobs are given as "params", the long options of main.py as JSON (e.g.
+    {"board_config": ["./boards/visionfive_config.toml"], "flash": true}), or
+    as "args", a main.py command line.
+
+    Raises:
+        HTTPException: If the parameters are invalid.
+    """
+    if "params" not in data:
+        try:
+            return vars(parse_args((data.get("args") or "").split())) | {"yes": True}  # nobody can answer a prompt
+        except SystemExit:
+            raise HTTPException(status_code=400, detail=f"Invalid arguments: {data.get('args')}")
+    try:
+        return vars(job_params(data["params"]))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def job_resources(params):
+    """
+    Return the hardware a job occupies while it runs.
+
+    That is every board it names and the SD mux, serial port, SD block device
+    and power switch of each (see farm_scheduler.board_resources), plus the SD
+    mux given with -S for a single board run.
+
+    Raises:
+        HTTPException: If the arguments or a board config cannot be read.
+    """
+    try:
+        resources = []
+        for path in params["board_config"]:
+            board_config = toml.load(path)
+            resources += board_resources(board_config)
+            resources.append(f"board:{board_config['board']['board_name']}")
+    except (OSError, KeyError, TypeError, toml.TomlDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid board config: {e}")
+    if len(params["board_config"]) == 1:
+        resources.append(f"sdmux:{params['serial']}")
+    return resources
 
 @app.post("/create_test")
 async def create_test(request: Request):
@@ -79,37 +199,33 @@ async def create_test(request: Request):
 
     Args:
         token (str): the secret token to authenticate the request.
-        args (str): the arguments to pass to the test.
+        params (dict): the options of the test (the long options of main.py), or
+        args (str): the arguments to pass to the test as a main.py command line.
+        priority (int): higher priority tests are started first (default 0).
 
     Returns:
         A JSON object with the test id and status of the newly created test.
 
     Raises:
-        HTTPException: If the token is invalid.
+        HTTPException: If the token or the arguments are invalid.
     """
     data = await request.json()
     token = data.get("token")
-    args = data.get("args")
 
     if token != SECRET_TOKEN:
         print(f"Invalid token: {token}")
         raise HTTPException(status_code=403, detail="Invalid token")
 
-    # Generate unique test ID
-    test_id = str(len(active_tests) + 1)
-    active_tests[test_id] = {
-        "status": "created",
-        "args": args,
-        "output": [],
-        "process": None
-    }
+    params = request_params(data)
+    test_id = queue.submit({"params": params}, job_resources(params), int(data.get("priority", 0)), state="created")
+    outputs[str(test_id)] = OutputLog()
 
-    return {"test_id": test_id, "status": "created"}
+    return {"test_id": str(test_id), "status": "created"}
 
 @app.post("/start_test/{test_id}")
 async def start_test(test_id: str, request: Request):
     """
-    Start the test process for the given test ID.
+    Queue the test with the given ID; it starts as soon as its board and SD mux are free.
 
     Args:
         test_id (str): The unique identifier of the test to start.
@@ -119,31 +235,17 @@ async def start_test(test_id: str, request: Request):
         A JSON object with the status of the test and the test ID.
 
     Raises:
-        HTTPException: If the token is invalid, test is not found, or test is already running.
+        HTTPException: If the token is invalid, test is not found, or test was already started.
     """
     data = await request.json()
-    if data.get("token") != SECRET_TOKEN:
-        raise HTTPException(status_code=403, detail="Invalid token")
-
-    if test_id not in active_tests:
-        raise HTTPException(status_code=404, detail="Test not found")
+    check_token(data)
 
-    test = active_tests[test_id]
-    if test["status"] == "running":
-        raise HTTPException(status_code=400, detail="Test already running")
-
-    process = await asyncio.create_subprocess_exec(
-        'python', 'main.py', *test["args"].split(),
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    test["process"] = process
-    test["status"] = "running"
+    job = find_job(test_id)
+    if not queue.enqueue(job["id"]):
+        raise HTTPException(status_code=400, detail=f"Test already {job['state']}")
+    wake.set()
     
-    # Start background task to collect output
-    asyncio.create_task(collect_output(test_id))
-    
-    return {"status": "started", "test_id": test_id}
+    return {"status": "queued", "test_id": test_id}
 
 @app.get("/test_status/{test_id}")
 async def get_test_status(test_id: str, request: Request):
@@ -155,48 +257,102 @@ async def get_test_status(test_id: str, request: Request):
         request (Request): The request object for authentication and other request data.
 
     Returns:
-        A JSON object with the current status of the test.
+        A JSON object with the current status (created, queued, running, completed,
+        failed, stopped or cancelled), priority, structured result and error of the test.
 
     Raises:
         HTTPException: If the test is not found.
     """
-    if test_id not in active_tests:
-        raise HTTPException(status_code=404, detail="Test not found")
-    
-    test = active_tests[test_id]
+    job = find_job(test_id)
     return {
-        "status": test["status"]
+        "status": job["state"],
+        "priority": job["priority"],
+        "result": job["result"],
+        "error": job["error"]
     }
 
+@app.get("/jobs")
+async def list_jobs(state: str = None):
+    """
+    List jobs in the order they will be started, optionally only those in the
+    given comma separated states (e.g. "queued,running").
+    """
+    return {"jobs": [job_status(job) for job in queue.list(state.split(",") if state else None)]}
+
+@app.post("/jobs/{test_id}/cancel")
+async def cancel_job(test_id: str, request: Request):
+    """Cancel a job that has not started yet; a running job is stopped with /stop_test."""
+    check_token(await request.json())
+    job = find_job(test_id)
+    if not queue.cancel(job["id"]):
+        raise HTTPException(status_code=400, detail=f"Test already {job['state']}")
+    find_output(test_id).close()
+    return {"status": "cancelled"}
+
+@app.post("/jobs/{test_id}/priority")
+async def set_job_priority(test_id: str, request: Request):
+    """Change the priority of a job that has not started yet."""
+    data = await request.json()
+    check_token(data)
+    job = find_job(test_id)
+    if not queue.reprioritize(job["id"], int(data.get("priority", 0))):
+        raise HTTPException(status_code=400, detail=f"Test already {job['state']}")
+    return {"status": job["state"], "priority": int(data.get("priority", 0))}
+
 @app.get("/test_output/{test_id}")
-async def get_test_output(test_id: str, length: int):
+async def get_test_output(test_id: str, length: int = 0, max_bytes: int = 1 << 20):
     """
     Retrieve a portion of the test output.
 
     Args:
         test_id (str): The unique identifier of the test.
-        length (int): The number of characters to skip from the beginning of the output.
+        length (int): Byte offset to read from, the sum of the lengths returned so far.
+        max_bytes (int): Most bytes of output to return.
 
     Returns:
-        A JSON object with the output of the test and the length of the output.
+        A JSON object with the output of the test and the length of the output in bytes.
 
     Raises:
         HTTPException: If the test is not found.
     """
-    if test_id not in active_tests:
-        raise HTTPException(status_code=404, detail="Test not found")
-    
-    test = active_tests[test_id]
-    output = "".join(test["output"][length:])
+    data, offset = find_output(test_id).read(length, max_bytes)
     return {
-        "output": output,
-        "length": len(output)
+        "output": data.decode('utf-8', errors='replace'),
+        "length": offset - length
     }
 
+@app.get("/test_output/{test_id}/stream")
+async def stream_test_output(test_id: str, request: Request, offset: int = 0):
+    """
+    Push the test output as Server-Sent Events while it is produced.
+
+    Every event carries a JSON string with the next piece of output and the byte
+    offset after it as its id, so a reconnecting EventSource resumes where it
+    stopped (Last-Event-ID). An "end" event follows the last output.
+
+    Raises:
+        HTTPException: If the test is not found.
+    """
+    log = find_output(test_id)
+    offset = int(request.headers.get("last-event-id", offset))
+    
+    async def events():
+        position = offset
+        while True:
+            await log.wait(position)
+            data, position = log.read(position)
+            if data:
+                yield f"id: {position}\ndata: {json.dumps(data.decode('utf-8', errors='replace'))}\n\n"
+            elif log.closed:
+                yield "event: end\ndata: \n\n"
+                return
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.post("/stop_test/{test_id}")
 async def stop_test(test_id: str, request: Request):
     """
-    Stop a running test.
+    Stop a test: a running test is terminated, a queued one is cancelled.
 
     Args:
         test_id (str): The unique identifier of the test to stop.
@@ -209,53 +365,52 @@ async def stop_test(test_id: str, request: Request):
         HTTPException: If the test is not found or the token is invalid.
     """
     data = await request.json()
-    if data.get("token") != SECRET_TOKEN:
-        raise HTTPException(status_code=403, detail="Invalid token")
-
-    if test_id not in active_tests:
-        raise HTTPException(status_code=404, detail="Test not found")
-
-    test = active_tests[test_id]
-    if test["process"]:
-        test["process"].terminate()
-        test["status"] = "stopped"
+    check_token(data)
+
+    job = find_job(test_id)
+    if queue.cancel(job["id"]):
+        find_output(test_id).close()
+        return {"status": "cancelled"}
+    if job["id"] in workers:
+        stopping.add(job["id"])
+        pool.stop(workers[job["id"]])
         return {"status": "stopped"}
-    return {"status": test["status"]}
+    return {"status": job["state"]}
 
-async def collect_output(test_id: str):
+async def run_job(job, worker):
     """
-    Collect output from a running test process.
+    Run a dispatched job on a pool worker and record its outcome in the queue.
 
-    This function is run in the background as a task to collect the output from a test process.
-    It will stop when the test is stopped or completed.
+    This function is run in the background as a task and appends the job's
+    output to its OutputLog in chunks as it arrives. When the job ends its
+    leases are released and the scheduler is woken up to start the jobs
+    waiting for the hardware or a worker.
 
     Args:
-        test_id (str): The unique identifier of the test.
+        job (dict): The job, as returned by JobQueue.dispatch().
+        worker (Worker): The worker acquired for it.
 
     Returns:
         None
     """
-    
-    test = active_tests[test_id]
-    process = test["process"]
-    
-    while True:
-        if test["status"] == "stopped":
-            break
-        
-        char = await process.stdout.read(1)
-        if not char:
-            test["status"] = "completed"
-            break
-            
-        test["output"].append(char.decode('utf-8'))
-    
-    await process.wait()
-    
-    # Ensure to read any remaining output after process completion
-    remaining_output = await process.stdout.read()
-    if remaining_output:
-        test["output"].append(remaining_output.decode('utf-8'))
+    log = outputs.setdefault(str(job["id"]), OutputLog())
+    workers[job["id"]] = worker
+    try:
+        result = await pool.run(worker, job["spec"]["params"], log.append)
+    except asyncio.CancelledError:
+        return  # server shutdown
+    finally:
+        workers.pop(job["id"], None)
+        runners.pop(job["id"], None)
+        log.close()
+    if job["id"] in stopping:
+        stopping.discard(job["id"])
+        queue.finish(job["id"], "stopped")
+    elif result is None:
+        queue.finish(job["id"], "failed", error="worker exited")
+    else:
+        queue.finish(job["id"], "completed" if result.get("success") else "failed", result, result.get("error"))
+    wake.set()
         
 @app.post("/write_test")
 async def write_test(request: Request):
@@ -0,0 +1,129 @@
+import gzip
+import lzma
+import os
+import tempfile
+import time
+import unittest
+from block_flasher import BlockMap, BlockFlasher, FanOutFlasher
+
+class TestBlockFlasher(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.tmp.name, "os.img")
+        with open(self.image, 'wb') as file:
+            file.truncate(8 << 20)
+            file.seek(0)
+            file.write(b"boot" * 1500)          # blocks 0-1
+            file.seek(5 << 20)
+            file.write(os.urandom(10000))       # blocks 1280-1282
+            file.seek((8 << 20) - 100)
+            file.write(b"end")                  # last block
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_scan_finds_data_blocks(self):
+        block_map = BlockMap.scan(self.image)
+        self.assertEqual(block_map.ranges, [(0, 8192), (5 << 20, (5 << 20) + 12288), ((8 << 20) - 4096, 8 << 20)])
+        self.assertEqual(block_map.mapped_size, 8192 + 12288 + 4096)
+
+    def test_bmap_roundtrip_and_sidecar_cache(self):
+        block_map = BlockMap.for_image(self.image)
+        self.assertTrue(os.path.exists(self.image + ".bmap"))
+        loaded = BlockMap.from_bmap(self.image + ".bmap")
+        self.assertEqual(loaded.ranges, block_map.ranges)
+        self.assertEqual(loaded.image_size, block_map.image_size)
+
+    def test_flash_writes_identical_image(self):
+        target = os.path.join(self.tmp.name, "sdcard.img")
+        progress = []
+        stats = BlockFlasher(target, buffer_size=4096, progress=lambda *args, **kwargs: progress.append(args)).flash(self.image)
+        self.assertEqual(self.read(target), self.read(self.image))
+        self.assertEqual(stats["written"], 8192 + 12288 + 4096)
+        self.assertEqual(progress[-1][0], stats["written"])
+
+    def test_verify_reports_mismatching_blocks(self):
+        target = os.path.join(self.tmp.name, "sdcard.img")
+        flasher = BlockFlasher(target, buffer_size=4096, progress=lambda *args, **kwargs: None, verify=True)
+        stats = flasher.flash(self.image)
+        self.assertEqual(stats["verified"], stats["written"])
+        self.assertEqual(stats["mismatches"], [])
+
+        class DroppingFlasher(BlockFlasher):  # a card that loses one write
+            @staticmethod
+            def _write_all(fd, view, offset):
+                if offset == (5 << 20) + 4096:
+                    view = bytes(len(view))
+                BlockFlasher._write_all(fd, view, offset)
+
+        stats = DroppingFlasher(target, buffer_size=4096, progress=lambda *args, **kwargs: None, verify=True).flash(self.image)
+        self.assertEqual(stats["mismatches"], [((5 << 20) + 4096, (5 << 20) + 8192)])
+
+    def test_image_rebuilt_in_place_is_rescanned(self):
+        target = os.path.join(self.tmp.name, "sdcard.img")
+        flasher = BlockFlasher(target, progress=lambda *args, **kwargs: None)
+        flasher.flash(self.image)
+        with open(self.image, 'r+b') as file:  # same size, data in another block
+            file.seek(3 << 20)
+            file.write(b"new data")
+        flasher.flash(self.image)
+        self.assertEqual(self.read(target), self.read(self.image))
+
+    def test_unaligned_image_size(self):
+        with open(self.image, 'ab') as file:
+            file.write(b"tail")
+        target = os.path.join(self.tmp.name, "sdcard.img")
+        BlockFlasher(target, progress=lambda *args, **kwargs: None).flash(self.image)
+        self.assertEqual(self.read(target), self.read(self.image))
+
+    def test_flash_compressed_images(self):
+        raw = self.read(self.image)
+        for suffix, compress in ((".xz", lzma.compress), (".gz", gzip.compress)):
+            compressed = self.image + suffix
+            with open(compressed, 'wb') as file:
+                file.write(compress(raw))
+            target = os.path.join(self.tmp.name, "sdcard" + suffix)
+            stats = BlockFlasher(target, buffer_size=1 << 20, progress=lambda *args, **kwargs: None).flash(compressed)
+            self.assertEqual(self.read(target), raw)
+            self.assertEqual(stats["image_size"], len(raw))
+            self.assertEqual(stats["written"], 8192 + 12288 + 4096)
+            # The block map found while streaming is kept for the next flash
+            self.assertEqual(BlockMap.from_bmap(compressed + ".bmap").ranges, BlockMap.scan(self.image).ranges)
+
+    def test_fan_out_isolates_slow_and_failing_targets(self):
+        targets = [os.path.join(self.tmp.name, name) for name in ("a.img", "slow.img", "missing/c.img")]
+
+        with open(self.image, 'r+b') as file:
+            file.seek(1 << 20)
+            file.write(os.urandom(64 * 4096))
+
+        def progress(device, *args, **kwargs):
+            if device == targets[1]:
+                time.sleep(0.02)
+
+        flasher = FanOutFlasher(targets, buffer_size=4096, progress=progress, depth=1, stall_timeout=0.2, verify=True)
+        results = flasher.flash(self.image)
+        raw = self.read(self.image)
+        for target in targets[:2]:
+            self.assertEqual(self.read(target), raw)
+            self.assertEqual(results[target]["written"], 8192 + 64 * 4096 + 12288 + 4096)
+            self.assertEqual(results[target]["mismatches"], [])
+        self.assertIsInstance(results[targets[2]], OSError)
+
+    def test_fan_out_compressed_image(self):
+        raw = self.read(self.image)
+        compressed = self.image + ".gz"
+        with open(compressed, 'wb') as file:
+            file.write(gzip.compress(raw))
+        targets = [os.path.join(self.tmp.name, name) for name in ("a.img", "b.img")]
+        results = FanOutFlasher(targets, buffer_size=1 << 20, progress=lambda *args, **kwargs: None).flash(compressed)
+        for target in targets:
+            self.assertEqual(self.read(target), raw)
+            self.assertEqual(results[target]["image_size"], len(raw))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import pty
+import tempfile
+import threading
+import time
+import tty
+import unittest
+from unittest import mock
+from boot_monitor import BootMonitor
+from pyautotest_driver import pyautotest_driver
+
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "typical_log")
+
+class TestBootMonitor(unittest.TestCase):
+    def monitor(self, prompts, timeouts=None, watchdog=None):
+        return BootMonitor(["login:"], ["Password:"], "root@k1:~#", timeouts,
+                           lambda kind, prompt: prompts.append(kind), watchdog)
+
+    def test_typical_log_reaches_login(self):
+        prompts = []
+        monitor = self.monitor(prompts)
+        with open(LOG_PATH, 'rb') as log:
+            data = log.read()
+        for pos in range(0, len(data), 61):  # milestones split across chunks
+            monitor.feed(data[pos:pos + 61])
+        self.assertEqual([stage for stage, _ in monitor.stage_times],
+                         ["power_on", "spl", "uboot", "kernel", "init", "login"])
+        self.assertEqual(prompts, ["login"])
+
+        monitor.feed(b"root\r\nPassword: ")
+        monitor.feed(b"\r\nroot@k1:~# ")
+        result = monitor.wait()
+        self.assertTrue(result['success'])
+        self.assertEqual(prompts, ["login", "password"])
+
+    def test_stalled_stage_is_reported(self):
+        monitor = self.monitor([], {"uboot": 0.1})
+        monitor.feed(b"U-Boot 2022.10spacemit\r\nERROR:   sd f! l:76\r\n")
+        result = monitor.wait()
+        self.assertFalse(result['success'])
+        self.assertEqual(result['stage'], "uboot")
+
+    def test_silent_console_is_woken_once(self):
+        prompts = []
+        monitor = self.monitor(prompts, {"power_on": 1})
+        woken = []
+        result = monitor.wait(wake=lambda: woken.append(monitor.feed(b"\r\nroot@k1:~# ")), wake_after=0.05)
+        self.assertTrue(result['success'])
+        self.assertEqual(len(woken), 1)
+        self.assertEqual(prompts, [])
+
+    def test_watchdog_fails_fast(self):
+        monitor = self.monitor([], watchdog={"grace": 0.1, "silence": 0.2})
+        monitor.feed(b"Starting kernel ...\r\n[    2.1] Kernel panic - not syncing: VFS: Unable to mount root fs\r\n")
+        result = monitor.wait()
+        self.assertEqual((result['stage'], result['failure']), ("kernel", "panic"))
+        self.assertIn("Unable to mount root fs", result['context'])
+
+        monitor.reset()
+        monitor.feed(b"U-Boot SPL 2022.10\r\nU-Boot 2022.10\r\nStarting kernel ...\r\n")
+        monitor.feed(b"U-Boot SPL 2022.10\r\nU-Boot 2022.10\r\nStarting kernel ...\r\n")  # one reset is tolerated
+        monitor.feed(b"U-Boot SPL 2022.10\r\n")
+        self.assertEqual(monitor.wait()['failure'], "boot loop")
+
+        monitor.reset()
+        monitor.feed(b"U-Boot 2022.10\r\nERROR:   sd f! l:76\r\n")
+        self.assertEqual(monitor.wait()['failure'], "boot media error")
+
+        monitor.reset()
+        monitor.feed(b"Starting kernel ...\r\n")
+        self.assertEqual(monitor.wait()['failure'], "silence")
+
+def answer_login(master, typed):
+    """Fake DUT from init on: answer the user name and password typed on the pty."""
+    os.write(master, b"[    5.528429] Run /init as init process\r\nk1 login: ")
+    for answer in (b"Password: ", b"\r\nroot@k1:~# "):
+        line = b""
+        while not line.endswith(b"\n"):
+            line += os.read(master, 64)
+        typed.append(line)
+        os.write(master, answer)
+
+class TestAutoLogin(unittest.TestCase):
+    def setUp(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.config = f"""
+        log_dir = "{self.log_dir.name}"
+        [serial]
+        serial_file = "{os.ttyname(self.slave)}"
+        bund_rate = 115200
+        auto_login = true
+        username = "root"
+        password = "bianbu"
+        stdout_log = false
+        login_prompts = ["login:"]
+        password_prompts = ["Password:"]
+        shell_prompt = "root@k1:~#"
+        boot_timeouts = {{ login = 5 }}
+        """
+        self.driver = pyautotest_driver(self.config)
+
+    def tearDown(self):
+        self.driver.stop()
+        os.close(self.master)
+        os.close(self.slave)
+        self.log_dir.cleanup()
+
+    def test_start_logs_in_at_the_first_prompt(self):
+        typed = []
+        threading.Timer(0.2, lambda: (os.write(self.master, b"Starting kernel ...\r\n"), answer_login(self.master, typed))).start()
+        self.driver.start()
+        self.assertEqual(typed, [b"root\n", b"bianbu\n"])
+        self.assertEqual([stage for stage, _ in self.driver.boot_result['stage_times']],
+                         ["power_on", "kernel", "init", "login", "shell"])
+
+    def test_every_run_on_a_port_gets_its_own_log_file(self):
+        with mock.patch("time.time", return_value=1000):
+            self.driver._open_log()
+        first = self.driver.logger.handlers[0]
+        second_run = pyautotest_driver(self.config)
+        with mock.patch("time.time", return_value=2000):
+            second_run._open_log()
+        second_run.logger.info("second run")
+        self.assertEqual(len(second_run.logger.handlers), 1)
+        self.assertIsNone(first.stream)  # closed
+        with open(second_run.log_file_path) as file:
+            self.assertIn("second run", file.read())
+        self.assertNotEqual(second_run.log_file_path, self.driver.log_file_path)
+
+    def test_reboot_after_panic(self):
+        threading.Timer(0.2, os.write, args=(self.master, b"Starting kernel ...\r\nKernel panic - not syncing: Attempted to kill init!\r\n")).start()
+        with self.assertRaises(Exception):
+            self.driver.start()
+        self.assertEqual(self.driver.boot_result['failure'], "panic")
+
+        typed = []
+
+        def power_cycle():
+            os.write(self.master, b"U-Boot SPL 2022.10\r\nStarting kernel ...\r\n")
+            threading.Timer(0.2, answer_login, args=(self.master, typed)).start()
+            return time.monotonic()
+
+        self.driver.reboot(power_cycle)
+        self.assertTrue(self.driver.boot_result['success'])
+        self.assertEqual(typed, [b"root\n", b"bianbu\n"])
+
+if __name__ == '__main__':
+    unittest.main()
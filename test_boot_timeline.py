@@ -0,0 +1,51 @@
+import io
+import os
+import tempfile
+import unittest
+from boot_timeline import BootTimelineStore, extract_timeline, format_timeline
+
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "typical_log")
+
+def replay(data, seconds_per_line=0.01):
+    """Chunks of a recorded log, one line every `seconds_per_line` after power on at t=100."""
+    received_at = 100.0
+    for line in io.BytesIO(data):
+        received_at += seconds_per_line
+        yield received_at, line
+
+class TestBootTimeline(unittest.TestCase):
+    def timeline(self, seconds_per_line=0.01):
+        with open(LOG_PATH, 'rb') as log:
+            data = log.read() + b"root\r\nPassword: \r\nroot@k1:~# "
+        return extract_timeline(replay(data, seconds_per_line), ["login:"], ["Password:"], "root@k1:~#", power_on=100.0)
+
+    def test_phases_from_typical_log(self):
+        phases = self.timeline()
+        self.assertEqual([phase["phase"] for phase in phases],
+                         ["power_on", "spl", "uboot", "kernel", "init", "login", "shell"])
+        self.assertEqual(phases[0]["start"], 0)
+        for phase, following in zip(phases, phases[1:]):
+            self.assertAlmostEqual(phase["start"] + phase["duration"], following["start"], places=3)
+        self.assertIsNone(phases[-1]["duration"])
+        # "Starting kernel" is line 132 of the log
+        self.assertAlmostEqual(phases[3]["start"], 1.32, places=2)
+
+    def test_slower_phase_is_flagged_against_the_previous_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = BootTimelineStore(os.path.join(tmp, "boot_timelines.jsonl"))
+            fast = {"success": True, "stage": "shell", "error": None,
+                    "stage_times": [("power_on", 0), ("kernel", 2.0), ("init", 5.0), ("login", 20.0), ("shell", 21.0)]}
+            slow = dict(fast, stage_times=[("power_on", 0), ("kernel", 2.0), ("init", 9.0), ("login", 24.0), ("shell", 25.0)])
+            store.record("k1", "Bianbu", 1, fast)
+            store.record("other", "Bianbu", 2, slow)
+            self.assertIsNone(store.previous("k1", "Bianbu", 1))
+            previous = store.previous("k1", "Bianbu", 3)
+            record = store.record("k1", "Bianbu", 3, slow)
+            self.assertEqual(len(store.history("k1", "Bianbu")), 2)
+
+        text = format_timeline(record, previous)
+        self.assertIn("Time to shell: 25.0s (previous run 1: 21.0s)", text)
+        self.assertIn("Boot latency regressions: kernel", text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from block_flasher import BlockFlasher
+from card_manifest import CardManifest, DeltaFilter
+
+CHUNK = 64 << 10
+
+class TestDeltaFlash(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.tmp.name, "os.img")
+        self.card = os.path.join(self.tmp.name, "sdcard.img")
+        with open(self.image, 'wb') as file:
+            file.write(os.urandom(1 << 20))
+            file.truncate(2 << 20)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def flash(self, verify="full", sample=0.05):
+        flasher = BlockFlasher(self.card, buffer_size=CHUNK, progress=lambda *args, **kwargs: None)
+        manifest = CardManifest.for_card(os.path.join(self.tmp.name, "cards"), "mux_a", CHUNK)
+        stats = flasher.flash(self.image, delta=DeltaFilter(self.card, manifest, verify, sample))
+        self.assertEqual(self.read(self.card), self.read(self.image))
+        return stats
+
+    def test_unchanged_image_writes_nothing(self):
+        self.assertEqual(self.flash()["written"], 1 << 20)
+        stats = self.flash()
+        self.assertEqual(stats["written"], 0)
+        self.assertEqual(stats["skipped"], 1 << 20)
+
+    def test_only_changed_chunks_are_written(self):
+        self.flash()
+        with open(self.image, 'r+b') as file:
+            file.seek(CHUNK * 3 + 10)
+            file.write(b"patched")
+        self.assertEqual(self.flash()["written"], CHUNK)
+
+    def test_card_modified_by_dut_is_rewritten(self):
+        self.flash()
+        with open(self.card, 'r+b') as file:  # e.g. the DUT's journal
+            file.seek(CHUNK * 5)
+            file.write(b"\0" * 100)
+        stats = self.flash()
+        self.assertEqual(stats["written"], CHUNK)
+
+    def test_interrupted_flash_leaves_no_trusted_hashes(self):
+        self.flash()
+        CardManifest.for_card(os.path.join(self.tmp.name, "cards"), "mux_a", CHUNK).begin()
+        self.assertEqual(self.flash()["written"], 1 << 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import functools
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from chunk_store import ChunkStore
+from block_flasher import BlockFlasher
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ChunkStore(os.path.join(self.tmp.name, "store"), mask_bits=4, min_size=16 << 10, max_size=256 << 10)
+        self.nightly = os.path.join(self.tmp.name, "nightly1.img")
+        with open(self.nightly, 'wb') as file:
+            file.write(os.urandom(2 << 20))
+            file.write(bytes(1 << 20))
+            file.write(os.urandom(1 << 20))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def next_nightly(self, name):
+        """Copy of the first nightly with one block changed and 8 blocks inserted."""
+        data = bytearray(self.read(self.nightly))
+        data[100 << 12:101 << 12] = os.urandom(4096)
+        data[300 << 12:300 << 12] = os.urandom(8 * 4096)
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def test_second_nightly_stores_only_its_changes(self):
+        first = self.store.add("nightly1", self.nightly)
+        self.assertEqual(first["size"], 4 << 20)
+        second = self.store.add("nightly2", self.next_nightly("nightly2.img"))
+        self.assertLess(second["new_bytes"], first["new_bytes"] // 4)
+
+        rebuilt = self.store.rebuild("nightly2", os.path.join(self.tmp.name, "rebuilt.img"))
+        self.assertEqual(self.read(rebuilt), self.read(os.path.join(self.tmp.name, "nightly2.img")))
+
+    def test_concurrent_adds_of_one_build(self):
+        errors = []
+        def add(name):
+            try:
+                self.store.add(name, self.nightly)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=add, args=(f"board{i}",)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.read(self.store.rebuild("board3", os.path.join(self.tmp.name, "rebuilt.img"))), self.read(self.nightly))
+        self.assertEqual(self.store.gc(), 0)
+
+    def test_flash_streams_from_store(self):
+        self.store.add("nightly1", self.nightly)
+        target = os.path.join(self.tmp.name, "sdcard.img")
+        with self.store.open("nightly1") as reader:
+            stats = BlockFlasher(target, progress=lambda *args, **kwargs: None).flash_stream(io.BufferedReader(reader))
+        self.assertEqual(self.read(target), self.read(self.nightly))
+        self.assertEqual(stats["written"], 3 << 20)
+
+    def test_fetch_downloads_only_missing_chunks(self):
+        server_store = ChunkStore(os.path.join(self.tmp.name, "server"), mask_bits=4, min_size=16 << 10, max_size=256 << 10)
+        server_store.add("nightly1", self.nightly)
+        server_store.add("nightly2", self.next_nightly("nightly2.img"))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=server_store.root))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            name, first = self.store.fetch(f"{base}/recipes/nightly1.json")
+            self.assertEqual(name, "nightly1")
+            self.assertEqual(first["fetched_chunks"], len(set(d for d, _ in self.store.recipe("nightly1")["chunks"])))
+            _, second = self.store.fetch(f"{base}/recipes/nightly2.json")
+            self.assertLess(second["fetched_bytes"], first["fetched_bytes"] // 4)
+            recipe_path = server_store.recipe_path("nightly2")
+            recipe = json.loads(self.read(recipe_path))
+            recipe["sha256"] = "0" * 64
+            with open(recipe_path, 'w') as file:
+                json.dump(recipe, file)
+            with self.assertRaises(Exception):
+                self.store.fetch(f"{base}/recipes/nightly2.json", "tampered")
+            self.assertNotIn("tampered", self.store.names())
+        finally:
+            server.shutdown()
+            server.server_close()
+        rebuilt = self.store.rebuild("nightly2", os.path.join(self.tmp.name, "rebuilt.img"))
+        self.assertEqual(self.read(rebuilt), self.read(os.path.join(self.tmp.name, "nightly2.img")))
+
+        self.store.remove("nightly1")
+        self.assertGreater(self.store.gc(), 0)
+        self.store.rebuild("nightly2", rebuilt)
+
+if __name__ == '__main__':
+    unittest.main()
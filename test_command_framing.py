@@ -0,0 +1,58 @@
+import subprocess
+import unittest
+from command_framing import CommandFrame, FrameParser, BatchParser, batch_lines
+
+class TestFrameParser(unittest.TestCase):
+    def setUp(self):
+        self.frame = CommandFrame("uname -a", token="cafe")
+
+    def test_echo_does_not_complete_frame(self):
+        self.assertNotIn(self.frame.begin_marker, self.frame.wrap())
+        self.assertNotIn(self.frame.end_marker, self.frame.wrap())
+
+    def test_output_and_exit_code_split_across_chunks(self):
+        parser = FrameParser(self.frame)
+        stream = (self.frame.wrap() + "\r\n" + self.frame.begin_marker + "\r\n"
+                  + "Linux k1 6.1.15\r\n" + self.frame.end_marker + ":0\r\nroot@k1:~# ")
+        done = [parser.feed(stream[i:i + 7]) for i in range(0, len(stream), 7)]
+        self.assertTrue(any(done))
+        self.assertEqual(parser.output, "Linux k1 6.1.15\r\n")
+        self.assertEqual(parser.exit_code, 0)
+
+    def test_output_without_trailing_newline(self):
+        parser = FrameParser(self.frame)
+        parser.feed(f"{self.frame.begin_marker}\r\nnonl{self.frame.end_marker}:127\r\n")
+        self.assertEqual(parser.output, "nonl")
+        self.assertEqual(parser.exit_code, 127)
+
+    def test_awkward_commands_keep_their_frame(self):
+        for cmd, output in (("sleep 0 &", ""), ("true;", ""), ("echo hi # comment", "hi\n"),
+                            ("echo 'it''s' \"$((1+1))\"", "its 2\n")):
+            frame = CommandFrame(cmd)
+            parser = FrameParser(frame)
+            result = subprocess.run(["sh", "-c", frame.wrap()], capture_output=True, text=True, timeout=10)
+            self.assertTrue(parser.feed(result.stdout), cmd)
+            self.assertEqual((parser.output, parser.exit_code), (output, 0), cmd)
+
+class TestBatchParser(unittest.TestCase):
+    def test_splits_combined_output(self):
+        frames = [CommandFrame(f"echo {i}", token=f"t{i}") for i in range(3)]
+        ((line, members),) = batch_lines(frames)
+        self.assertEqual(members, frames)
+        parser = BatchParser(frames)
+        stream = line + "\r\n"
+        for i, frame in enumerate(frames):
+            stream += f"{frame.begin_marker}\r\n{i}\r\n{frame.end_marker}:{i}\r\n"
+        self.assertTrue(parser.feed(stream))
+        self.assertEqual([p.output for p in parser.parsers], ["0\r\n", "1\r\n", "2\r\n"])
+        self.assertEqual([p.exit_code for p in parser.parsers], [0, 1, 2])
+
+    def test_long_batches_are_split(self):
+        frames = [CommandFrame("true") for _ in range(200)]
+        batches = batch_lines(frames, max_line=1000)
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(all(len(line) <= 1000 for line, _ in batches))
+        self.assertEqual(sum(len(members) for _, members in batches), 200)
+
+if __name__ == '__main__':
+    unittest.main()
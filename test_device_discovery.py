@@ -0,0 +1,186 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from device_discovery import DeviceDiscovery, SysfsIndex, UeventMonitor
+from sd_mux_controller import UsbSDMuxController
+
+class FakeMonitor(UeventMonitor):
+    def start(self):
+        pass
+
+class FakeSysfs:
+    """A /sys tree with SDWire-like muxes: a hub holding the mux's FTDI chip and a card reader."""
+
+    def __init__(self, root):
+        self.root = os.path.join(root, "sys")
+        self.dev_dir = os.path.join(root, "dev")
+        os.makedirs(os.path.join(self.root, "bus", "usb", "devices"))
+        os.makedirs(os.path.join(self.root, "class", "block"))
+        os.makedirs(self.dev_dir)
+
+    def usb_device(self, port, serial=None, interface_class="ff"):
+        path = os.path.join(self.root, "devices", "pci0000:00", "usb1", *[port[:i] for i in range(3, len(port) + 1, 2)])
+        os.makedirs(os.path.join(path, f"{port}:1.0"))
+        with open(os.path.join(path, "busnum"), "w") as file:
+            file.write("1\n")
+        with open(os.path.join(path, f"{port}:1.0", "bInterfaceClass"), "w") as file:
+            file.write(interface_class + "\n")
+        if serial:
+            with open(os.path.join(path, "serial"), "w") as file:
+                file.write(serial + "\n")
+        os.symlink(path, os.path.join(self.root, "bus", "usb", "devices", port))
+        return path
+
+    def mux(self, hub_port, serial):
+        self.usb_device(hub_port)
+        self.usb_device(hub_port + ".1", serial)
+        return self.usb_device(hub_port + ".2", interface_class="08")
+
+    def usbsdmux(self, port, serial, sg, block):
+        """An LXA USB-SD-Mux: one USB device with a serial whose SCSI device has an sg and a block node."""
+        usb_path = self.usb_device(port, serial, interface_class="08")
+        scsi_path = os.path.join(usb_path, f"{port}:1.0", "host0", "target0:0:0", "0:0:0:0")
+        os.makedirs(os.path.join(scsi_path, "scsi_generic", sg))
+        os.makedirs(os.path.join(self.root, "class", "scsi_generic"), exist_ok=True)
+        os.symlink(os.path.join(scsi_path, "scsi_generic", sg), os.path.join(self.root, "class", "scsi_generic", sg))
+        os.makedirs(os.path.join(scsi_path, "block", block))
+        os.makedirs(os.path.join(self.root, "block"), exist_ok=True)
+        os.symlink(os.path.join(scsi_path, "block", block), os.path.join(self.root, "block", block))
+        return scsi_path
+
+    def add_disk(self, reader, name):
+        path = os.path.join(reader, os.path.basename(reader) + ":1.0", "host0", "block", name)
+        os.makedirs(os.path.join(path, name + "1"))
+        with open(os.path.join(path, name + "1", "partition"), "w") as file:
+            file.write("1\n")
+        os.symlink(path, os.path.join(self.root, "class", "block", name))
+        os.symlink(os.path.join(path, name + "1"), os.path.join(self.root, "class", "block", name + "1"))
+        open(os.path.join(self.dev_dir, name), "w").close()
+        return {"ACTION": "add", "SUBSYSTEM": "block", "DEVTYPE": "disk", "DEVNAME": name,
+                "DEVPATH": os.path.realpath(path)[len(os.path.realpath(self.root)):]}
+
+class FakeMux:
+    """Switching to the test server makes the card (and another mux's card) appear shortly after."""
+
+    def __init__(self, sysfs, monitor, cards):
+        self.sysfs = sysfs
+        self.monitor = monitor
+        self.cards = cards
+        self.switched = []
+
+    def connect_to_ts(self, serial):
+        self.switched.append(("ts", serial))
+
+        def appear():
+            for reader, name in self.cards:
+                self.monitor.dispatch(self.sysfs.add_disk(reader, name))
+        threading.Timer(0.05, appear).start()
+        return {"success": True}
+
+    def connect_to_dut(self, serial):
+        self.switched.append(("dut", serial))
+        return {"success": True}
+
+class TestDeviceDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sysfs = FakeSysfs(self.tmp.name)
+        self.monitor = FakeMonitor(self.sysfs.root, self.sysfs.dev_dir)
+        self.cache = os.path.join(self.tmp.name, "devices.json")
+        self.discovery = DeviceDiscovery(self.sysfs.root, self.sysfs.dev_dir, self.cache, self.monitor)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_card_already_on_test_server_needs_no_switch(self):
+        reader = self.sysfs.mux("1-2", "sdwire_a")
+        self.sysfs.mux("1-3", "sdwire_b")
+        self.sysfs.add_disk(reader, "sdc")
+        mux = FakeMux(self.sysfs, self.monitor, [])
+        self.assertEqual(self.discovery.device_for_mux("sdwire_a", mux), os.path.join(self.sysfs.dev_dir, "sdc"))
+        self.assertEqual(mux.switched, [])
+        with open(self.cache) as file:
+            self.assertEqual(json.load(file)["sdwire_a"]["device"], "sdc")
+
+    def test_only_the_card_below_the_mux_matches(self):
+        reader_a = self.sysfs.mux("1-2", "sdwire_a")
+        reader_b = self.sysfs.mux("1-3", "sdwire_b")
+        # another mux switches at the same time and its card is announced first
+        mux = FakeMux(self.sysfs, self.monitor, [(reader_b, "sdb"), (reader_a, "sdc")])
+        device = self.discovery.device_for_mux("sdwire_a", mux, timeout=2)
+        self.assertEqual(device, os.path.join(self.sysfs.dev_dir, "sdc"))
+        self.assertEqual(mux.switched, [("ts", "sdwire_a")])
+
+    def test_unknown_mux(self):
+        reader = self.sysfs.usb_device("1-4", interface_class="08")
+        mux = FakeMux(self.sysfs, self.monitor, [(reader, "sdd")])
+        with self.assertRaises(Exception):
+            self.discovery.device_for_mux("sdwire_x", mux, topology_only=True)
+        self.assertEqual(mux.switched, [])
+
+        self.assertEqual(self.discovery.device_for_mux("sdwire_x", mux, timeout=2), os.path.join(self.sysfs.dev_dir, "sdd"))
+        self.assertEqual(mux.switched, [("dut", "sdwire_x"), ("ts", "sdwire_x")])
+        # the reader found this way is remembered as the mux's place in the topology
+        self.assertEqual(DeviceDiscovery(self.sysfs.root, self.sysfs.dev_dir, self.cache, self.monitor)._anchor("sdwire_x"), reader)
+
+    def test_cached_anchor_is_dropped_when_another_device_takes_the_port(self):
+        reader = self.sysfs.mux("1-2", "sdwire_a")
+        self.sysfs.add_disk(reader, "sdc")
+        self.discovery.device_for_mux("sdwire_a", FakeMux(self.sysfs, self.monitor, []))
+        with open(os.path.join(os.path.dirname(reader), "1-2.1", "serial"), "w") as file:
+            file.write("some_other_device\n")
+        self.assertIsNone(self.discovery._anchor("sdwire_a"))
+        self.assertNotIn("sdwire_a", self.discovery._cache)
+
+        unknown = self.sysfs.usb_device("1-4", interface_class="08")
+        self.discovery.device_for_mux("sdwire_x", FakeMux(self.sysfs, self.monitor, [(unknown, "sdd")]), timeout=2)
+        self.assertEqual(self.discovery._anchor("sdwire_x"), unknown)
+        with open(os.path.join(unknown, "serial"), "w") as file:
+            file.write("new_reader\n")
+        self.assertIsNone(self.discovery._anchor("sdwire_x"))
+
+    def test_failing_subscriber_does_not_stop_dispatch(self):
+        seen = []
+        self.monitor.subscribe(lambda event: 1 / 0)
+        self.monitor.subscribe(seen.append)
+        self.monitor.dispatch({"ACTION": "add", "DEVPATH": "/devices/x"})
+        self.assertEqual(seen, [{"ACTION": "add", "DEVPATH": "/devices/x"}])
+
+class TestSysfsIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sysfs = FakeSysfs(self.tmp.name)
+        self.sysfs.usbsdmux("1-2", "000000000101", "sg1", "sdb")
+        self.sysfs.usbsdmux("1-3", "000000000102", "sg2", "sdc")
+        self.monitor = FakeMonitor(self.sysfs.root, self.sysfs.dev_dir)
+        self.index = SysfsIndex(self.sysfs.root, "/dev", self.monitor)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_muxes_by_serial(self):
+        self.assertEqual(self.index.serials(), ["000000000101", "000000000102"])
+        self.assertEqual(self.index.lookup("000000000102"), ("/dev/sg2", "/dev/sdc"))
+        controller = UsbSDMuxController(self.index)
+        self.assertEqual(controller.sg_device("000000000101"), "/dev/sg1")
+        with self.assertRaises(Exception):
+            controller.sg_device()  # ambiguous with two muxes
+        with self.assertRaises(Exception):
+            controller.sg_device("000000000199")
+
+    def test_hotplug_updates_only_the_named_device(self):
+        self.monitor.dispatch({"ACTION": "remove", "SUBSYSTEM": "block", "DEVTYPE": "disk", "DEVNAME": "sdc"})
+        self.assertEqual(self.index.lookup("000000000102"), ("/dev/sg2", None))
+        self.monitor.dispatch({"ACTION": "remove", "SUBSYSTEM": "scsi_generic", "DEVNAME": "sg2"})
+        self.assertEqual(self.index.serials(), ["000000000101"])
+
+        self.sysfs.usbsdmux("1-4", "000000000103", "sg3", "sdd")
+        self.monitor.dispatch({"ACTION": "add", "SUBSYSTEM": "scsi_generic", "DEVNAME": "sg3"})
+        self.assertEqual(self.index.lookup("000000000103"), ("/dev/sg3", None))
+        self.monitor.dispatch({"ACTION": "add", "SUBSYSTEM": "block", "DEVTYPE": "disk", "DEVNAME": "sdd"})
+        self.assertEqual(self.index.lookup("000000000103"), ("/dev/sg3", "/dev/sdd"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from farm_scheduler import FarmScheduler, ResourceLocks
+
+BOARD = """
+[test_framework]
+log_dir = "{tmp}"
+[board]
+board_name = "{name}"
+[serial]
+serial_file = "{tty}"
+bund_rate = 115200
+serial_name = "{mux}"
+sd_mux_device = ""
+[os_list.Debian]
+url = "debian.img"
+[os_list.Bianbu]
+url = "bianbu.img"
+"""
+
+class TestFarmScheduler(unittest.TestCase):
+    def test_boards_run_concurrently_unless_they_share_hardware(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, tty, mux in [("a", "/dev/ttyUSB0", "mux_a"), ("b", "/dev/ttyUSB1", "mux_b"), ("c", "/dev/ttyUSB1", "mux_c")]:
+                path = os.path.join(tmp, f"{name}.toml")
+                with open(path, "w") as file:
+                    file.write(BOARD.format(tmp=tmp, name=name, tty=tty, mux=mux))
+                paths.append(path)
+
+            scheduler = FarmScheduler(paths)
+            active = set()
+            overlaps = []
+            guard = threading.Lock()
+
+            def fake_run(controller, os_name, *args):
+                with guard:
+                    if {"b", "c"} <= active | {controller.board_name}:
+                        overlaps.append(os_name)
+                    active.add(controller.board_name)
+                time.sleep(0.1)
+                with guard:
+                    active.discard(controller.board_name)
+                return None
+
+            for chain in scheduler.chains:
+                controller = chain[0].controller
+                controller.run_test_suite = lambda *args, c=controller: fake_run(c, *args)
+
+            started = time.monotonic()
+            jobs = scheduler.run()
+            elapsed = time.monotonic() - started
+
+        self.assertEqual([job.status for job in jobs], ["completed"] * 6)
+        self.assertEqual([job.os_name for job in jobs[:2]], ["Debian", "Bianbu"])
+        self.assertEqual(overlaps, [])
+        # a runs alongside b/c, which share /dev/ttyUSB1: 4 slots instead of 6
+        self.assertLess(elapsed, 0.55)
+
+    def test_device_detection_is_topology_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.toml")
+            with open(path, "w") as file:
+                file.write(BOARD.format(tmp=tmp, name="a", tty="/dev/ttyUSB0", mux="mux_a"))
+            scheduler = FarmScheduler([path])
+        self.assertTrue(scheduler.chains[0][0].controller.os_manager.topology_only_detection)
+
+class TestResourceLocks(unittest.TestCase):
+    def test_hold_is_exclusive(self):
+        locks = ResourceLocks()
+        with locks.hold(["serial:/dev/ttyUSB0", "sdmux:alpha"]):
+            acquired = locks._lock("sdmux:alpha").acquire(blocking=False)
+        self.assertFalse(acquired)
+        self.assertTrue(locks._lock("sdmux:alpha").acquire(blocking=False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,13 +4,22 @@ from pyautotest_driver import pyautotest_driver
 import time
 
 class TestFramework:
-    def __init__(self, config):
-        """Initialize the test framework with the given configuration."""
-        self.driver = pyautotest_driver(config)
+    def __init__(self, config, hub=None):
+        """Initialize the test framework with the given configuration, optionally on a shared SerialHub."""
+        self.driver = pyautotest_driver(config, hub)
     
-    def start(self):
-        """Start the test framework."""
-        self.driver.start()
+    def start(self, power_on=None):
+        """Start the test framework; `power_on` is the monotonic time the DUT was powered, for the boot timeline."""
+        self.driver.start(power_on)
+    
+    def reboot(self, power_cycle):
+        """Power cycle the DUT with `power_cycle` and wait for it to boot again."""
+        self.driver.reboot(power_cycle)
+    
+    @property
+    def boot_result(self):
+        """Stages the DUT went through while booting, None without auto login."""
+        return self.driver.boot_result
     
     def stop(self):
         """Stop the test framework."""
@@ -20,6 +29,14 @@ class TestFramework:
         """Run a command on the Device Under Test (DUT) and check the output for specific patterns within a timeout."""
         return self.driver.run_command(cmd, timeout)
     
+    def run_command_framed(self, cmd, timeout, capture=None):
+        """Run a command on the Device Under Test (DUT) and return its output, exit code and duration."""
+        return self.driver.run_command_framed(cmd, timeout, capture=capture)
+    
+    def run_commands_framed(self, cmds, timeout, captures=None):
+        """Run several independent commands on the Device Under Test (DUT) in one framed batch."""
+        return self.driver.run_commands_framed(cmds, timeout, captures)
+    
     def run_command_and_check_output(self, cmd, patterns, timeout):
         """Run a command on the Device Under Test (DUT) and check the output for specific patterns within a timeout."""
         return self.driver.run_command_and_check_output(cmd, patterns, timeout)
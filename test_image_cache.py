@@ -0,0 +1,165 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from image_cache import ImageCache, DownloadPipe
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves `server.image` with ETag and Range support; can cut the first response short."""
+
+    def do_GET(self):
+        image = self.server.image
+        etag = '"%s"' % hashlib.sha256(image).hexdigest()[:16]
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+            if start >= len(image):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(image) - 1}/{len(image)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        if self.server.content_encoding:
+            self.send_header("Content-Encoding", self.server.content_encoding)
+        self.send_header("Content-Length", str(len(image) - start))
+        self.end_headers()
+        body = image[start:]
+        if self.server.drop_after:
+            body = body[:self.server.drop_after]
+            self.server.drop_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        self.server.image = os.urandom(300000)
+        self.server.requests = []
+        self.server.drop_after = None
+        self.server.content_encoding = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/image.img"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ImageCache(self.tmp.name, chunk_size=4096, retries=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def test_download_is_content_addressed_and_revalidated(self):
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.read(path), self.server.image)
+        self.assertEqual(os.path.basename(path), hashlib.sha256(self.server.image).hexdigest())
+
+        self.assertEqual(self.cache.fetch(self.url), path)  # 304
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.server.image = os.urandom(1000)  # new upstream release
+        new_path = self.cache.fetch(self.url)
+        self.assertNotEqual(new_path, path)
+        self.assertEqual(self.read(new_path), self.server.image)
+
+    def test_resumes_after_connection_drop(self):
+        self.server.drop_after = 100000
+        path = self.cache.fetch(self.url, hashlib.sha256(self.server.image).hexdigest())
+        self.assertEqual(self.read(path), self.server.image)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotEqual(self.server.requests[-1]["Range"], "bytes=0-")
+
+    def test_tee_streams_download(self):
+        self.server.drop_after = 100000
+        pipe = DownloadPipe()
+        received = []
+        reader = threading.Thread(target=lambda: received.append(pipe.read()))
+        reader.start()
+        try:
+            pipe.finish(self.cache.fetch(self.url, tee=pipe))
+        except Exception as e:
+            pipe.fail(e)
+            raise
+        finally:
+            reader.join(10)
+        self.assertEqual(received, [self.server.image])
+
+    def test_content_encoding_is_not_decoded(self):
+        # e.g. Apache serving a .gz file with "Content-Encoding: gzip"
+        self.server.image = gzip.compress(os.urandom(1000))
+        self.server.content_encoding = "gzip"
+        path = self.cache.fetch(self.url, hashlib.sha256(self.server.image).hexdigest())
+        self.assertEqual(self.read(path), self.server.image)
+
+    def test_complete_partial_download_is_finished(self):
+        part = os.path.join(self.tmp.name, "partial", ImageCache.url_key(self.url) + ".part")
+        with open(part, 'wb') as file:
+            file.write(self.server.image)
+        with open(part + ".json", 'w') as file:
+            json.dump({"etag": '"%s"' % hashlib.sha256(self.server.image).hexdigest()[:16]}, file)
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.read(path), self.server.image)
+        self.assertEqual(self.server.requests[-1]["Range"], f"bytes={len(self.server.image)}-")
+
+    def test_known_digest_needs_no_request(self):
+        digest = hashlib.sha256(self.server.image).hexdigest()
+        self.cache.fetch(self.url)
+        requests_before = len(self.server.requests)
+        self.assertTrue(self.cache.fetch(self.url, digest).endswith(digest))
+        self.assertEqual(len(self.server.requests), requests_before)
+
+    def test_checksum_mismatch_is_rejected(self):
+        with self.assertRaises(Exception):
+            self.cache.fetch(self.url, "0" * 64)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "objects")), [])
+
+    def test_lru_eviction(self):
+        cache = ImageCache(self.tmp.name, max_size=500000)
+        first = cache.fetch(self.url)
+        self.server.image = os.urandom(300000)
+        second = cache.fetch(self.url + "?v2")
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_pinned_object_is_not_evicted(self):
+        cache = ImageCache(self.tmp.name, max_size=500000)
+        other_board = ImageCache(self.tmp.name, max_size=500000)  # shares the directory, like another process
+        prefetched = cache.fetch(self.url, pin=True)
+        self.server.image = os.urandom(300000)
+        second = other_board.fetch(self.url + "?v2")
+        self.assertTrue(os.path.exists(prefetched))
+        cache.release(prefetched)
+        self.server.image = os.urandom(300000)
+        other_board.fetch(self.url + "?v3")
+        self.assertFalse(os.path.exists(prefetched))
+        self.assertFalse(os.path.exists(second))
+
+    def test_cancelled_download_keeps_partial_file(self):
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(Exception):
+            self.cache.fetch(self.url, cancel=cancel)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "objects")), [])
+        path = self.cache.fetch(self.url)
+        self.assertEqual(self.read(path), self.server.image)
+        self.assertIn("Range", self.server.requests[-1])  # resumed
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from job_queue import JobQueue
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "jobs.db")
+        self.queue = JobQueue(self.path)
+
+    def tearDown(self):
+        self.queue.close()
+        self.directory.cleanup()
+
+    def test_burst_keeps_boards_busy_without_double_booking(self):
+        boards = [["sdmux:alpha", "serial:/dev/ttyUSB0"], ["sdmux:beta", "serial:/dev/ttyUSB1"], ["sdmux:gamma", "serial:/dev/ttyUSB2"]]
+        submitters = [threading.Thread(target=lambda i=i: [self.queue.submit({"args": f"job {i} {j}"}, boards[j % 3]) for j in range(10)])
+                      for i in range(4)]
+        for thread in submitters:
+            thread.start()
+        for thread in submitters:
+            thread.join()
+        
+        # Two schedulers on the same database must not start the same job or share a board
+        other = JobQueue(self.path)
+        finished = 0
+        while finished < 40:
+            waiting = {tuple(job["resources"]) for job in self.queue.list(["queued"])}
+            running = self.queue.dispatch() + other.dispatch()
+            self.assertEqual(len(running), len(waiting))  # every board with work is busy
+            self.assertEqual(len({resource for job in running for resource in job["resources"]}), 2 * len(running))
+            for job in running:
+                self.queue.finish(job["id"], "completed", {"success": True})
+                finished += 1
+        other.close()
+        self.assertEqual({job["state"] for job in self.queue.list()}, {"completed"})
+
+    def test_priority_cancel_and_reprioritize(self):
+        low = self.queue.submit({"args": "low"}, ["sdmux:alpha"])
+        high = self.queue.submit({"args": "high"}, ["sdmux:alpha"], priority=5)
+        later = self.queue.submit({"args": "later"}, ["sdmux:alpha"], state="created")
+        self.assertEqual([job["id"] for job in self.queue.dispatch()], [high])
+        self.assertEqual(self.queue.dispatch(), [])  # board still leased
+        
+        self.assertTrue(self.queue.enqueue(later))
+        self.assertTrue(self.queue.reprioritize(later, 10))
+        self.assertFalse(self.queue.reprioritize(high, 10))
+        self.assertTrue(self.queue.cancel(low))
+        self.assertFalse(self.queue.cancel(high))
+        self.queue.finish(high, "completed", {"success": True})
+        self.assertEqual([job["id"] for job in self.queue.dispatch()], [later])
+        self.assertEqual(self.queue.get(low)["state"], "cancelled")
+
+    def test_restart_requeues_running_jobs_and_expires_leases(self):
+        first = self.queue.submit({"args": "first"}, ["sdmux:alpha"])
+        self.queue.dispatch()
+        self.assertEqual(JobQueue(self.path).recover(), [])  # a second server keeps off live leases
+        self.queue.requeue([first])
+        self.queue.close()
+        
+        self.queue = JobQueue(self.path, lease_time=0.1)
+        self.assertEqual(self.queue.dispatch()[0]["spec"], {"args": "first"})
+        second = self.queue.submit({"args": "second"}, ["sdmux:alpha"])
+        time.sleep(0.2)  # runner stopped renewing
+        self.assertEqual(self.queue.recover(), [first])
+        self.assertEqual([job["id"] for job in self.queue.dispatch()], [first])
+        time.sleep(0.2)
+        self.assertEqual([job["id"] for job in self.queue.dispatch()], [second])
+        self.assertEqual(self.queue.get(first)["error"], "lease expired")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,105 @@
 import os
+import re
 import subprocess
 import time
 import toml
+from output_capture import OutputCapture, ContainsEvaluator, RegexEvaluator
 
 class TestManager:
-    def __init__(self, test_config):
-        """Initialize the test manager with the given test configuration."""
+    def __init__(self, test_config, output_dir=None):
+        """
+        Initialize the test manager with the given test configuration.
+
+        When `output_dir` is set, the full output of every test is streamed to a
+        file in it and only a bounded head and tail are kept in the results.
+        """
         self.test_config = toml.load(test_config)
+        self.output_dir = output_dir
+        self.output_head_size = self.test_config.get('output_head_size', 4096)
+        self.output_tail_size = self.test_config.get('output_tail_size', 4096)
     
-    def execute_tests(self, framework):
-        """Execute the tests defined in the test configuration."""
+    def execute_tests(self, framework, batch=None):
+        """
+        Execute the tests defined in the test configuration.
+
+        In batch mode (the `batch` argument, or `batch = true` at the top of the
+        test file) consecutive tests that do not set `batch = false` are shipped
+        to the DUT as one framed script instead of one round trip per test.
+        """
+        if batch is None:
+            batch = self.test_config.get('batch', False)
+
         results = []
-        for test in self.test_config['tests']:
-            cmd = test['command']
-            expected_output = test.get('expected_output')
-            timeout = test.get('timeout', 10)
-            method = test.get('method', 'exact')
-            
-            output = framework.run_command(cmd, timeout)
-            
-            result = self.evaluate_result(output, expected_output, method, test)
-            results.append(result)
+        group = []
+        for index, test in enumerate(self.test_config['tests'], start=1):
+            if batch and test.get('batch', True):
+                group.append((index, test))
+                continue
+            results += self._execute_batch(framework, group)
+            group = []
+            results.append(self._execute_test(framework, index, test))
+        results += self._execute_batch(framework, group)
         
         return results
+
+    def _new_capture(self, index, test):
+        """Create the output capture of a test and attach its incremental evaluator."""
+        path = None
+        if self.output_dir:
+            name = re.sub(r'[^A-Za-z0-9_-]+', '_', str(test.get('name', 'test'))).strip('_') or 'test'
+            path = os.path.join(self.output_dir, f"{index:03d}_{name}.log")
+        capture = OutputCapture(path, self.output_head_size, self.output_tail_size)
+
+        method = test.get('method', 'exact')
+        expected_output = test.get('expected_output')
+        evaluator = None
+        if method == 'contains' and expected_output is not None:
+            evaluator = ContainsEvaluator(str(expected_output))
+        elif method == 'regex' and expected_output is not None:
+            evaluator = RegexEvaluator(expected_output)
+        if evaluator:
+            capture.observers.append(evaluator.feed)
+        return capture, evaluator
+
+    def _execute_test(self, framework, index, test):
+        """Run a single test in its own round trip."""
+        cmd = test['command']
+        expected_output = test.get('expected_output')
+        timeout = test.get('timeout', 10)
+        method = test.get('method', 'exact')
+        capture, evaluator = self._new_capture(index, test)
+        
+        output, exit_code, duration = framework.run_command_framed(cmd, timeout, capture=capture)
+        
+        result = self.evaluate_result(output, expected_output, method, test, exit_code, capture, evaluator)
+        result['duration'] = duration
+        capture.close()
+        return result
+
+    def _execute_batch(self, framework, tests):
+        """Run independent (index, test) pairs as one framed script and evaluate each of them."""
+        if not tests:
+            return []
+        timeout = sum(test.get('timeout', 10) for _, test in tests)
+        captures, evaluators = zip(*(self._new_capture(index, test) for index, test in tests))
+        outcomes = framework.run_commands_framed([test['command'] for _, test in tests], timeout, list(captures))
+        
+        results = []
+        for (_, test), capture, evaluator, (output, exit_code, duration) in zip(tests, captures, evaluators, outcomes):
+            result = self.evaluate_result(output, test.get('expected_output'), test.get('method', 'exact'), test,
+                                          exit_code, capture, evaluator)
+            result['duration'] = duration
+            capture.close()
+            results.append(result)
+        return results
     
-    def evaluate_result(self, output, expected_output, method, test_case):
-        """Evaluate the result of a test case based on the specified method."""
+    def evaluate_result(self, output, expected_output, method, test_case, exit_code=None, capture=None, evaluator=None):
+        """
+        Evaluate the result of a test case based on the specified method and the DUT's exit code.
+
+        With a capture, `output` is its bounded text; `contains` and `regex` then use
+        the verdict of the evaluator that already ran on the streamed output.
+        """
         result = {
             "command": test_case['command'],
             "output": output,
@@ -33,25 +107,38 @@ class TestManager:
             "method": method,
             "success": False,
             "reason": "",
-            "return_code": None
+            "return_code": None,
+            "exit_code": exit_code,
+            "output_file": capture.path if capture else None
         }
 
-        if method == 'exact':
-            result['success'] = output.strip() == expected_output
+        if method in ('exact', 'contains', 'regex') and expected_output is None:
+            result['reason'] = f"Test has no expected_output for method {method}."
+        elif method == 'exact':
+            full_output = capture.read_full() if capture else output
+            result['success'] = full_output.strip() == expected_output
             if not result['success']:
                 result['reason'] = f"Output does not match expected output. Got: {output.strip()}"
         elif method == 'contains':
-            result['success'] = expected_output in output
+            result['success'] = evaluator.finish() if evaluator else expected_output in output
             if not result['success']:
                 result['reason'] = f"Expected output not found in output. Got: {output}"
-        elif method == 'exit_code':
-            process = subprocess.run(test_case['command'], shell=True)
-            result['return_code'] = process.returncode
-            result['success'] = process.returncode == expected_output
+        elif method == 'regex':
+            result['success'] = evaluator.finish() if evaluator else re.search(expected_output, output, re.MULTILINE) is not None
             if not result['success']:
-                result['reason'] = f"Return code does not match expected output. Got: {process.returncode}"
+                result['reason'] = f"Output does not match pattern {expected_output}. Got: {output}"
+        elif method == 'exit_code':
+            result['return_code'] = exit_code
+            result['success'] = exit_code is not None and exit_code == expected_output
+            if exit_code is None:
+                result['reason'] = "No exit code received from the DUT before the timeout."
+            elif not result['success']:
+                result['reason'] = f"Return code does not match expected output. Got: {exit_code}"
         elif method == 'special_judge':
-            result_process = subprocess.run(['./tests/{}_special_judge.sh'.format(test_case['name']), output], capture_output=True)
+            if capture:
+                capture.flush()
+            env = dict(os.environ, BOARDTEST_OUTPUT_FILE=(capture.spill_path or "") if capture else "")
+            result_process = subprocess.run(['./tests/{}_special_judge.sh'.format(test_case['name']), output], capture_output=True, env=env)
             result['return_code'] = result_process.returncode
             result['success'] = result_process.returncode == 0
             if not result['success']:
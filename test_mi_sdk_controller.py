@@ -0,0 +1,41 @@
+import asyncio
+import time
+import unittest
+from mi_sdk_controller import AsyncMiSdkController, FakeMiDevice, MiSdkController, power_many, set_power_many
+
+class TestMiSdkController(unittest.TestCase):
+    def test_power_state_is_confirmed(self):
+        device = FakeMiDevice(delay=0.2)
+        controller = AsyncMiSdkController("token", "10.0.0.1", "plug", device, poll_interval=0.05)
+        result = asyncio.run(controller.turn_on())
+        self.assertTrue(result['success'])
+        self.assertEqual(device.power, "on")
+        self.assertGreaterEqual(result['duration'], 0.2)
+        self.assertLess(result['switched_at'], time.monotonic() - 0.15)  # acknowledged before it was confirmed
+        self.assertGreater(device.commands.count(("get_prop", ["power"])), 1)
+
+    def test_stuck_relay_fails_after_deadline(self):
+        controller = AsyncMiSdkController("token", "10.0.0.2", "plug", FakeMiDevice(stuck=True), confirm_timeout=0.2, poll_interval=0.05)
+        result = asyncio.run(controller.turn_on())
+        self.assertFalse(result['success'])
+        self.assertIn("still off", result['error'])
+
+    def test_rack_switches_concurrently(self):
+        controllers = [AsyncMiSdkController("token", f"10.0.1.{i}", f"plug{i}", FakeMiDevice(delay=0.2), poll_interval=0.02)
+                       for i in range(8)]
+        started = time.monotonic()
+        results = asyncio.run(set_power_many(controllers, "on"))
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(all(result['success'] for result in results.values()))
+        self.assertEqual(sorted(results), sorted(f"plug{i}" for i in range(8)))
+
+    def test_blocking_front_end(self):
+        plugs = [MiSdkController("token", f"10.0.2.{i}", f"plug{i}", FakeMiDevice(delay=0.05)) for i in range(2)]
+        self.assertTrue(plugs[0].turn_on()['success'])
+        self.assertEqual(plugs[0].get_status(), "on")
+        self.assertTrue(plugs[0].power_cycle(off_time=0.05)['success'])
+        self.assertEqual(set(result['success'] for result in power_many(plugs, "off").values()), {True})
+        self.assertEqual(plugs[1].get_status(), "off")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from output_capture import OutputCapture, ContainsEvaluator, RegexEvaluator
+import test_manager
+
+class TestOutputCapture(unittest.TestCase):
+    def test_bounded_head_and_tail_with_spill_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = OutputCapture(os.path.join(tmp, "dmesg.log"), head_size=10, tail_size=10)
+            lines = [f"line {i}\r\n" for i in range(1000)]
+            for line in lines:
+                capture.write(line)
+            self.assertTrue(capture.truncated)
+            self.assertTrue(capture.text.startswith("line 0\r\nli"))
+            self.assertTrue(capture.text.endswith("line 999\r\n"))
+            self.assertLess(len(capture.text), 200)
+            self.assertEqual(capture.read_full(), "".join(lines))
+            capture.close()
+
+    def test_small_output_is_kept_verbatim(self):
+        capture = OutputCapture(head_size=10, tail_size=10)
+        capture.write("Linux k1\r\n")
+        self.assertFalse(capture.truncated)
+        self.assertEqual(capture.text, "Linux k1\r\n")
+
+    def test_spills_to_temporary_file_without_path(self):
+        capture = OutputCapture(head_size=10, tail_size=10)
+        lines = [f"line {i}\r\n" for i in range(1000)]
+        for line in lines:
+            capture.write(line)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(capture.read_full(), "".join(lines))
+        spill_path = capture.spill_path
+        capture.close()
+        self.assertFalse(os.path.exists(spill_path))
+
+class TestManagerEvaluation(unittest.TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix=".toml", delete=False) as file:
+            file.write("tests = []\n")
+        self.manager = test_manager.TestManager(file.name)
+        os.remove(file.name)
+
+    def test_exact_compares_full_output_without_output_dir(self):
+        test = {"name": "../big dmesg", "command": "dmesg", "method": "exact", "expected_output": "x" * 20000}
+        capture, evaluator = self.manager._new_capture(1, test)
+        capture.write("x" * 20000 + "\r\n")
+        result = self.manager.evaluate_result(capture.text, test["expected_output"], "exact", test, 0, capture, evaluator)
+        capture.close()
+        self.assertTrue(result["success"])
+
+    def test_missing_expected_output_fails_the_test(self):
+        test = {"name": "uname", "command": "uname -a", "method": "contains"}
+        capture, evaluator = self.manager._new_capture(1, test)
+        capture.write("None\r\n")
+        result = self.manager.evaluate_result(capture.text, None, "contains", test, 0, capture, evaluator)
+        capture.close()
+        self.assertFalse(result["success"])
+        self.assertIn("no expected_output", result["reason"])
+
+    def test_log_file_name_is_sanitized(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.manager.output_dir = tmp
+            capture, _ = self.manager._new_capture(2, {"name": "../../etc/passwd", "command": "true"})
+            capture.close()
+            self.assertEqual(os.path.dirname(capture.path), tmp)
+            self.assertEqual(os.path.basename(capture.path), "002_etc_passwd.log")
+
+class TestEvaluators(unittest.TestCase):
+    def test_contains_across_pieces(self):
+        evaluator = ContainsEvaluator("rv64imafdcv")
+        evaluator.feed("isa : rv64im")
+        self.assertIsNone(evaluator.verdict)
+        evaluator.feed("afdcv_zicsr\r\n")
+        self.assertTrue(evaluator.verdict)
+        self.assertTrue(evaluator.finish())
+
+    def test_regex_matches_serial_line_endings(self):
+        evaluator = RegexEvaluator(r"^VERSION_ID=\"\d+\.\d+\"$", batch=1)
+        evaluator.feed('NAME="Bianbu"\r\n')
+        self.assertIsNone(evaluator.verdict)
+        evaluator.feed('VERSION_ID="1.0"\r\n')
+        self.assertTrue(evaluator.verdict)
+
+    def test_regex_without_match(self):
+        evaluator = RegexEvaluator(r"panic")
+        evaluator.feed("all good\r\n")
+        self.assertFalse(evaluator.finish())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+from output_log import OutputLog
+
+class TestOutputLog(unittest.TestCase):
+    def test_reads_by_offset_across_blocks(self):
+        log = OutputLog(block_size=8)
+        text = "U-Boot SPL 2022.10\r\n密码：\r\nroot@k1:~# ".encode()
+        for pos in range(0, len(text), 5):
+            log.append(text[pos:pos + 5])
+        self.assertEqual(log.size, len(text))
+        data, offset = log.read(0)
+        self.assertEqual((data, offset), (text, len(text)))
+        # a read ending inside a multi-byte character stops before it
+        cut = text.index("码".encode()) + 1
+        data, offset = log.read(3, cut - 3)
+        self.assertEqual(offset, cut - 1)
+        data, offset = log.read(offset, 6)
+        self.assertEqual(data.decode(), "码：")
+
+    def test_append_wakes_every_watcher(self):
+        async def scenario():
+            log = OutputLog()
+
+            async def watch():
+                position, seen = 0, b""
+                while await log.wait(position) and not (log.closed and position == log.size):
+                    data, position = log.read(position)
+                    seen += data
+                return seen
+
+            watchers = [asyncio.create_task(watch()) for _ in range(50)]
+            await asyncio.sleep(0)
+            self.assertFalse(await log.wait(0, timeout=0.01))
+            for line in (b"Starting kernel ...\r\n", b"k1 login: "):
+                log.append(line)
+                await asyncio.sleep(0)
+            log.close()
+            return await asyncio.gather(*watchers)
+
+        self.assertEqual(set(asyncio.run(scenario())), {b"Starting kernel ...\r\nk1 login: "})
+
+if __name__ == '__main__':
+    unittest.main()
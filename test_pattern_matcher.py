@@ -0,0 +1,27 @@
+import unittest
+from pattern_matcher import PatternMatcher, compile_patterns
+
+class TestPatternMatcher(unittest.TestCase):
+    def test_overlapping_patterns(self):
+        matcher = PatternMatcher().add("he").add("she").add("hers").compile()
+        matches = matcher.scanner().feed(b"ushers")
+        self.assertEqual(sorted(matches), [("he", 4), ("hers", 6), ("she", 4)])
+
+    def test_match_across_chunks_fires_callback(self):
+        fired = []
+        matcher = PatternMatcher()
+        matcher.add("login:", "login", lambda key, end: fired.append((key, end)))
+        matcher.add("密码：", "password", lambda key, end: fired.append((key, end)))
+        scanner = matcher.scanner()
+        self.assertEqual(scanner.feed(b"k1 log"), [])
+        self.assertEqual(scanner.feed(b"in: "), [("login", 9)])
+        data = "密码：".encode('utf-8')
+        scanner.feed(data[:4])
+        scanner.feed(data[4:])
+        self.assertEqual(fired, [("login", 9), ("password", 10 + len(data))])
+
+    def test_compiled_matchers_are_cached(self):
+        self.assertIs(compile_patterns(("Linux", "GNU")), compile_patterns(("Linux", "GNU")))
+
+if __name__ == '__main__':
+    unittest.main()
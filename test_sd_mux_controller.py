@@ -0,0 +1,35 @@
+import time
+import unittest
+from sd_mux_controller import SDMuxController, SDMuxCtrlController, MockSDMuxController, shared_controller
+
+class TestSDMuxController(unittest.TestCase):
+    def test_results_are_structured(self):
+        mux = SDMuxController(controller=MockSDMuxController(fail={"sdwire_bad"}))
+        result = mux.connect_to_ts("sdwire_a")
+        self.assertTrue(result["success"])
+        self.assertEqual((result["serial"], result["operation"], result["error"]), ("sdwire_a", "ts", None))
+        failed = mux.connect_to_dut("sdwire_bad")
+        self.assertFalse(failed["success"])
+        self.assertIn("sdwire_bad", failed["error"])
+
+    def test_switch_many_runs_concurrently(self):
+        mock = MockSDMuxController(delay=0.2, fail={"sdwire_c"})
+        mux = SDMuxController(controller=mock)
+        started = time.monotonic()
+        results = mux.switch_many({"sdwire_a": "ts", "sdwire_b": "dut", "sdwire_c": "ts", "sdwire_d": "ts"})
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual({serial: result["success"] for serial, result in results.items()},
+                         {"sdwire_a": True, "sdwire_b": True, "sdwire_c": False, "sdwire_d": True})
+        self.assertEqual(mock.state, {"sdwire_a": "ts", "sdwire_b": "dut", "sdwire_d": "ts"})
+
+    def test_controller_is_shared(self):
+        self.assertIs(SDMuxController().controller, SDMuxController().controller)
+        self.assertIs(SDMuxController().controller, shared_controller())
+
+    def test_failed_command_is_reported(self):
+        result = SDMuxCtrlController()._run(["sh", "-c", "echo no such device >&2; exit 1"], "sdwire_a", "ts")
+        self.assertFalse(result["success"])
+        self.assertEqual(result["error"], "no such device")
+
+if __name__ == '__main__':
+    unittest.main()
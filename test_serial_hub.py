@@ -0,0 +1,72 @@
+import os
+import pty
+import select
+import tempfile
+import threading
+import tty
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pyautotest_driver import pyautotest_driver
+from serial_hub import SerialHub
+
+PROMPT = b"root@k1:~# "
+
+def fake_duts(masters, stop):
+    """Answer every command line on the pty masters with its board index and a prompt."""
+    pending = {fd: b"" for fd in masters}
+    while not stop.is_set():
+        ready, _, _ = select.select(list(masters), [], [], 0.1)
+        for fd in ready:
+            try:
+                pending[fd] += os.read(fd, 1024)
+            except OSError:
+                return
+            while b"\n" in pending[fd]:
+                line, pending[fd] = pending[fd].split(b"\n", 1)
+                answer = f"board{masters.index(fd)} {line.decode()}\r\n".encode()
+                os.write(fd, line + b"\r\n" + answer + PROMPT)
+
+class TestSerialHub(unittest.TestCase):
+    def test_one_loop_drives_many_ptys(self):
+        ptys = [pty.openpty() for _ in range(4)]
+        for master, slave in ptys:
+            tty.setraw(master)
+            tty.setraw(slave)
+        masters = [master for master, _ in ptys]
+        stop = threading.Event()
+        threading.Thread(target=fake_duts, args=(masters, stop), daemon=True).start()
+
+        with tempfile.TemporaryDirectory() as log_dir, SerialHub() as hub:
+            threads_before = threading.active_count()
+            drivers = []
+            for _, slave in ptys:
+                driver = pyautotest_driver(f"""
+                log_dir = "{log_dir}"
+                [serial]
+                serial_file = "{os.ttyname(slave)}"
+                bund_rate = 115200
+                auto_login = false
+                username = "root"
+                password = "bianbu"
+                stdout_log = false
+                login_prompts = ["login:"]
+                password_prompts = ["Password:"]
+                shell_prompt = "root@k1:~#"
+                """, hub)
+                driver.start()
+                drivers.append(driver)
+            self.assertEqual(threading.active_count(), threads_before)
+
+            with ThreadPoolExecutor(len(drivers)) as pool:
+                outputs = list(pool.map(lambda d: d.run_command("uname -a", 5), drivers))
+            self.assertEqual(outputs, [f"board{i} uname -a\r\n" for i in range(len(drivers))])
+
+            for driver in drivers:
+                driver.stop()
+        stop.set()
+        for master, slave in ptys:
+            os.close(master)
+            os.close(slave)
+
+if __name__ == '__main__':
+    unittest.main()
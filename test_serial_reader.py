@@ -0,0 +1,45 @@
+import os
+import pty
+import threading
+import tty
+import unittest
+import serial
+from serial_reader import RingBuffer, SerialReader
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wraparound_keeps_latest_bytes(self):
+        buffer = RingBuffer(8)
+        buffer.write(b"abcdef")
+        buffer.write(b"ghij")
+        self.assertEqual(buffer.total, 10)
+        self.assertEqual(buffer.read(0), (b"cdefghij", 10))
+        self.assertEqual(buffer.read(7), (b"hij", 10))
+
+    def test_wait_wakes_up_on_write(self):
+        buffer = RingBuffer(16)
+        threading.Timer(0.05, buffer.write, args=(b"x",)).start()
+        self.assertTrue(buffer.wait(0, timeout=2))
+        self.assertFalse(buffer.wait(1, timeout=0.05))
+
+class TestSerialReader(unittest.TestCase):
+    def test_reads_from_pty(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        conn = serial.Serial(os.ttyname(slave), 115200, timeout=1)
+        buffer = RingBuffer(64)
+        reader = SerialReader(lambda: conn, buffer)
+        reader.start()
+        try:
+            os.write(master, b"U-Boot SPL\r\n")
+            self.assertTrue(buffer.wait(0, timeout=2))
+            while buffer.total < 12 and buffer.wait(buffer.total, timeout=1):
+                pass
+            self.assertEqual(buffer.read(0)[0], b"U-Boot SPL\r\n")
+        finally:
+            reader.stop()
+            conn.close()
+            os.close(master)
+            os.close(slave)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from fastapi.testclient import TestClient
+import server
+from output_log import OutputLog
+from test_worker_pool import echo_job
+
+BOARD = "-b ./boards/banana_pi_f3_config.toml"
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        server.JOB_DB_PATH = os.path.join(self.directory.name, "jobs.db")
+        server.JOB_TARGET = echo_job
+        server.JOB_WORKERS = 2
+        self.client = TestClient(server.app)
+        self.client.__enter__()
+        log = OutputLog()
+        log.append("Flashing...\n".encode())
+        log.append("完成\n".encode())
+        log.close()
+        server.outputs["0"] = log
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        server.outputs.clear()
+        self.directory.cleanup()
+
+    def post(self, path, **data):
+        return self.client.post(path, json={"token": server.SECRET_TOKEN, **data})
+
+    def test_output_by_byte_offset(self):
+        first = self.client.get("/test_output/0", params={"length": 0, "max_bytes": 14}).json()
+        self.assertEqual(first, {"output": "Flashing...\n", "length": 12})
+        rest = self.client.get("/test_output/0", params={"length": first["length"]}).json()
+        self.assertEqual(rest["output"], "完成\n")
+
+    def test_stream_resumes_from_last_event_id(self):
+        response = self.client.get("/test_output/0/stream", headers={"Last-Event-ID": "12"})
+        self.assertEqual(response.headers["content-type"].split(";")[0], "text/event-stream")
+        events = [event for event in response.text.split("\n\n") if event]
+        self.assertEqual(events[0], "id: 19\ndata: " + json.dumps("完成\n"))
+        self.assertTrue(events[-1].startswith("event: end"))
+
+    def test_jobs_for_one_board_never_overlap(self):
+        ids = [self.post("/create_test", args=f"{BOARD} -S sdwirec_alpha --no-flash", priority=i).json()["test_id"] for i in range(2)]
+        ids.append(self.post("/create_test", params={"board_config": BOARD.split()[1:]}, priority=2).json()["test_id"])
+        self.assertEqual(self.post(f"/jobs/{ids[0]}/priority", priority=9).json()["priority"], 9)
+        for test_id in ids:
+            self.assertEqual(self.post(f"/start_test/{test_id}").json()["status"], "queued")
+        self.assertEqual(self.post(f"/start_test/{ids[0]}").status_code, 400)
+        
+        deadline = time.monotonic() + 30
+        while any(job["state"] != "completed" for job in self.client.get("/jobs").json()["jobs"]):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        jobs = sorted(self.client.get("/jobs").json()["jobs"], key=lambda job: job["started"])
+        self.assertEqual([str(job["id"]) for job in jobs], [ids[0], ids[2], ids[1]])
+        for earlier, later in zip(jobs, jobs[1:]):
+            self.assertLessEqual(earlier["finished"], later["started"])
+        self.assertIn("'flash': False", self.client.get(f"/test_output/{ids[0]}").json()["output"])
+        self.assertEqual(self.client.get(f"/test_status/{ids[2]}").json()["result"]["spec"]["yes"], True)
+
+    def test_jobs_from_before_a_restart(self):
+        test_id = self.post("/create_test", args=BOARD).json()["test_id"]
+        server.outputs.clear()  # output is not persisted
+        self.assertEqual(self.post(f"/jobs/{test_id}/cancel").json(), {"status": "cancelled"})
+        self.assertEqual(self.client.get(f"/test_output/{test_id}").json(), {"output": "", "length": 0})
+        self.assertTrue(self.client.get(f"/test_output/{test_id}/stream").text.startswith("event: end"))
+
+    def test_invalid_arguments_are_rejected(self):
+        self.assertEqual(self.post("/create_test", args="-b ./boards/missing.toml").status_code, 400)
+        self.assertEqual(self.post("/create_test", args="--no-such-option").status_code, 400)
+        self.assertEqual(self.post("/create_test", params={"no_such_option": 1}).status_code, 400)
+        self.assertEqual(self.client.get("/test_status/nope").status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import time
+import unittest
+from worker_pool import WorkerPool
+
+def echo_job(spec):
+    """Test target: print the spec, sleep (0.2s unless the spec says), and return it."""
+    print(f"job {spec}")
+    os.system("echo from a child process")
+    time.sleep(spec.get("sleep", 0.2) if isinstance(spec, dict) else 0)
+    if spec == "raise":
+        raise Exception("bad job")
+    return {"success": True, "spec": spec}
+
+class TestWorkerPool(unittest.TestCase):
+    def run_pool(self, scenario, size=2):
+        async def main():
+            pool = WorkerPool(echo_job, size)
+            await pool.start()
+            try:
+                return await scenario(pool)
+            finally:
+                await pool.close()
+        return asyncio.run(main())
+
+    def test_warm_worker_streams_output_then_result(self):
+        async def scenario(pool):
+            first_byte = []
+            output = bytearray()
+            def on_output(data):
+                if not first_byte:
+                    first_byte.append(time.monotonic())
+                output.extend(data)
+            submitted = time.monotonic()
+            result = await pool.run(pool.acquire(), {"sleep": 0.3, "board_config": ["a.toml"]}, on_output)
+            return submitted, first_byte[0], bytes(output), result
+        submitted, first_byte, output, result = self.run_pool(scenario)
+        self.assertLess(first_byte - submitted, 0.2)  # no interpreter start or imports
+        self.assertEqual(result, {"success": True, "spec": {"sleep": 0.3, "board_config": ["a.toml"]}})
+        self.assertEqual(output, b"job {'sleep': 0.3, 'board_config': ['a.toml']}\nfrom a child process\n")
+
+    def test_failed_and_stopped_jobs(self):
+        async def scenario(pool):
+            output = bytearray()
+            failed = await pool.run(pool.acquire(), "raise", output.extend)
+            worker = pool.acquire()
+            running = asyncio.ensure_future(pool.run(worker, {"sleep": 30}, output.extend))
+            await asyncio.sleep(0.5)
+            pool.stop(worker)
+            stopped = await running
+            workers = [pool.acquire(), pool.acquire()]
+            after = await pool.run(workers[0], "again", output.extend)
+            return failed, bytes(output), stopped, worker in workers, after
+        failed, output, stopped, reused, after = self.run_pool(scenario)
+        self.assertEqual(failed, {"success": False, "error": "bad job"})
+        self.assertIn(b"Exception: bad job", output)
+        self.assertIsNone(stopped)
+        self.assertFalse(reused)  # the stopped worker was replaced
+        self.assertTrue(after["success"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import traceback
+from multiprocessing.connection import Connection
+
+DEFAULT_WORKERS = int(os.environ.get("BOARDTEST_WORKERS", "4"))
+
+# Imported once by the fork server, so every worker starts with them loaded
+PRELOAD = ["main"]
+
+def _serve(tasks, output, target):
+    """
+    Body of a worker process: run every job spec received on `tasks` with
+    `target` and send back its result.
+
+    stdout and stderr of the worker, and of any command a job runs, go to
+    `output` as raw bytes. They are flushed before the result is sent, so the
+    pool has all output of a job once the result arrives.
+    """
+    os.dup2(output.fileno(), 1)
+    os.dup2(output.fileno(), 2)
+    output.close()
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    while True:
+        try:
+            spec = tasks.recv()
+        except EOFError:
+            return  # pool closed
+        try:
+            result = target(spec)
+        except BaseException as e:
+            traceback.print_exc()
+            result = {"success": False, "error": str(e) or type(e).__name__}
+        sys.stdout.flush()
+        sys.stderr.flush()
+        tasks.send(result)
+
+class Worker:
+    """A long-lived worker process with a message pipe for specs and results and a byte pipe for its output."""
+
+    def __init__(self, context, target):
+        self.tasks, child_tasks = context.Pipe()
+        read_fd, write_fd = os.pipe()
+        output = Connection(write_fd, readable=False)
+        self.process = context.Process(target=_serve, args=(child_tasks, output, target), daemon=True)
+        self.process.start()
+        child_tasks.close()
+        output.close()
+        self.output_fd = read_fd
+        os.set_blocking(read_fd, False)
+
+    def close(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.tasks.close()
+        os.close(self.output_fd)
+
+class WorkerPool:
+    """
+    Warm pool of worker processes that run jobs for the server.
+
+    Workers are forked from a fork server that has imported PRELOAD (main and
+    with it MainController, rich, toml, requests, texttable and miio), and wait
+    for job specs on a pipe. A job therefore starts as soon as its spec
+    arrives, without an interpreter start, imports or CLI parsing. Output is
+    streamed back as it is written and the job's result comes back as a
+    structured object. A worker that dies or is stopped mid-job is replaced.
+    """
+
+    def __init__(self, target, size=DEFAULT_WORKERS, preload=PRELOAD):
+        self.size = size
+        self.target = target
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(preload)
+        self.idle = []
+        self.workers = set()
+
+    async def start(self):
+        """Start the workers; the first start also launches the fork server."""
+        loop = asyncio.get_running_loop()
+        for _ in range(self.size):
+            worker = await loop.run_in_executor(None, Worker, self.context, self.target)
+            self.workers.add(worker)
+            self.idle.append(worker)
+
+    def available(self):
+        return len(self.idle)
+
+    def acquire(self):
+        """Take an idle worker for a job; None if all are busy."""
+        return self.idle.pop() if self.idle else None
+
+    async def run(self, worker, spec, on_output):
+        """
+        Run `spec` on an acquired worker and return the job's result.
+
+        Args:
+            worker (Worker): From acquire(); it goes back to the pool afterwards.
+            spec: The job, passed to the target function as is.
+            on_output (callable): Called with every chunk of output (bytes).
+
+        Returns:
+            The return value of the target, {"success": False, "error": ...} if
+            it raised, or None if the worker exited (stopped or crashed).
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def read_output():
+            try:
+                data = os.read(worker.output_fd, 65536)
+            except BlockingIOError:
+                return
+            if data:
+                on_output(data)
+            else:
+                loop.remove_reader(worker.output_fd)
+
+        def read_result():
+            try:
+                result = worker.tasks.recv()
+            except (EOFError, OSError):
+                result = None
+            loop.remove_reader(worker.tasks.fileno())
+            if not done.done():
+                done.set_result(result)
+
+        loop.add_reader(worker.output_fd, read_output)
+        loop.add_reader(worker.tasks.fileno(), read_result)
+        try:
+            try:
+                worker.tasks.send(spec)
+            except OSError:
+                done.set_result(None)  # died while idle
+            result = await done
+        finally:
+            loop.remove_reader(worker.output_fd)
+            loop.remove_reader(worker.tasks.fileno())
+
+        # The worker flushed before sending the result, so the rest of the output is in the pipe
+        while True:
+            try:
+                data = os.read(worker.output_fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            on_output(data)
+
+        if result is None:
+            self.workers.discard(worker)
+            await loop.run_in_executor(None, worker.close)
+            worker = await loop.run_in_executor(None, Worker, self.context, self.target)
+            self.workers.add(worker)
+        self.idle.append(worker)
+        return result
+
+    def stop(self, worker):
+        """Abort the job running on `worker`; run() returns None and the worker is replaced."""
+        worker.process.terminate()
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        for worker in list(self.workers):
+            await loop.run_in_executor(None, worker.close)
+        self.workers.clear()
+        self.idle.clear()